@@ -0,0 +1,232 @@
+###################################################
+#
+# Offline benchmark of the data pull scripts. Each
+# scenario runs get_*.py scripts, unmodified,
+# against the local stand-in server in server.py
+# and reports wall time, throughput and the peak
+# request rate seen by the server, which must stay
+# within the NOMADS limit of 50 requests a minute.
+#
+#   python bench/run_bench.py [scenario ...] [options]
+#
+# Run with --help for the options, e.g. server
+# latency, bandwidth, injected errors and delayed
+# publication. Note that the pollers sleep at least
+# 30 seconds whenever a file is not yet published,
+# so scenarios with delayed publication are slow.
+#
+# To see how soon the files of a cycle that is still
+# being published are pulled, as the forcing chunks
+# triggered on the progress meter need, run e.g.
+#
+#   python bench/run_bench.py gfs-progress --keep \
+#       --publish-interval 10 --date <3 hours ago>
+#
+# and follow 'Meter hours at' in the kept output.
+#
+###################################################
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+
+import server
+
+WRFHYDRO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "wrfhydro")
+NOMADS_MAX_PER_MINUTE = 50
+
+# name: (script, product served, extra environment, number of processes run at once).
+# {workdir} in the environment is replaced by the scenario's work directory.
+SCENARIOS = {
+    'gfs': ("get_GFS.py", "gfs", {}, 1),
+    'gfs-subset': ("get_GFS.py", "gfs", {'NOMADS_SUBSET': "true"}, 1),
+    'gfs-concurrent': ("get_GFS.py", "gfs", {}, 3),
+    'gfs-cached': ("get_GFS.py", "gfs", {'DOWNLOAD_CACHE_DIR': "{workdir}/download_cache"}, 3),
+    # with --publish-interval, the progress meter should follow the files as they are published
+    'gfs-progress': ("get_GFS.py", "gfs", {'PROGRESS_METER': "hours"}, 1),
+    'cfs': ("get_CFS.py", "cfs", {}, 1),
+    'cfs-ensemble': ("get_CFS.py", "cfs", {'CFS_MEMBERS': "1 2 3 4"}, 1),
+    'wrf-analysis': ("get_WRF_analysis.py", "wrf", {}, 1),
+    'wrf-shortrange': ("get_WRF_shortrange.py", "wrf", {}, 1),
+    'wrf-parallel': ("get_WRF_shortrange.py", "wrf", {'WRF_DOWNLOAD_CONNECTIONS': "4"}, 1),
+}
+
+
+def build_tree(cycle_time, hours, args, start):
+    """
+    Build the files of every product for a cycle
+    """
+    tree = server.Tree()
+    config = server_config(args)
+    server.add_gfs(tree, "gfs", cycle_time, hours, args.grib_size, config, start)
+    server.add_cfs(tree, "cfs", cycle_time, hours, args.grib_size, config, start)
+    server.add_wrf(tree, "wrf", cycle_time, max(hours, 12), args.wrf_size, config, start)
+    # the analysis reads the 12 hour file of the previous 6 hourly cycle
+    server.add_wrf(tree, "wrf", cycle_time - timedelta(hours=6), 12, args.wrf_size, config, start)
+    return tree
+
+
+def server_config(args):
+    return server.ServerConfig(latency=args.latency, bandwidth=args.bandwidth, error_rate=args.error_rate,
+                               error_status=args.error_status, publish_delay=args.publish_delay,
+                               publish_interval=args.publish_interval, rounded_sizes=args.rounded_sizes,
+                               ignore_ranges=args.ignore_ranges)
+
+
+def run_scenario(name, cycle_time, args):
+    """
+    Serve a fresh tree and run one scenario against it
+    :return: A dict of results
+    """
+    script, product, extra_env, processes = SCENARIOS[name]
+    workdir = tempfile.mkdtemp(prefix="bench-%s-" % name)
+    bench = server.BenchServer(build_tree(cycle_time, args.hours, args, time.time()), server_config(args))
+    bench.start()
+
+    env = dict(os.environ)
+    env.update({
+        'FORCING_DATE': cycle_time.strftime("%Y%m%d%H"),
+        'LENGTH_HRS': str(args.hours),
+        'GFS_URL': "%s/gfs" % bench.url,
+        'CFS_URL': "%s/cfs" % bench.url,
+        'WRF_URL': "%s/wrf" % bench.url,
+        'POLL_HISTORY_FILE': os.path.join(workdir, "poll_history.json"),
+        'NOMADS_INDEX_CACHE': os.path.join(workdir, "index_cache"),
+        'METRICS_DIR': os.path.join(workdir, "metrics"),
+        # concurrent pullers share one request limiter, as in the suite
+        'NOMADS_RATE_FILE': os.path.join(workdir, "nomads_rate"),
+    })
+    env.update((k, v.format(workdir=workdir)) for k, v in extra_env.items())
+
+    # each process writes to directories of its own
+    envs = []
+    for i in range(processes):
+        process_env = dict(env, FORCING_INPUTDIR=os.path.join(workdir, "input", str(i)),
+                           FORCING_SCRATCHDIR=os.path.join(workdir, "scratch", str(i)))
+        os.makedirs(process_env['FORCING_INPUTDIR'])
+        os.makedirs(process_env['FORCING_SCRATCHDIR'])
+        envs.append(process_env)
+
+    start = time.time()
+    running = []
+    for i, process_env in enumerate(envs):
+        log_file = open(os.path.join(workdir, "output.%d.log" % i), "w")
+        running.append((subprocess.Popen([sys.executable, script], cwd=WRFHYDRO_DIR, env=process_env,
+                                         stdout=log_file, stderr=subprocess.STDOUT), log_file))
+    returncode = 0
+    for process, log_file in running:
+        try:
+            code = process.wait(timeout=max(1, args.timeout - (time.time() - start)))
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+            code = "timeout"
+        log_file.close()
+        if returncode == 0:
+            returncode = code
+    wall = time.time() - start
+    bench.shutdown()
+    bench.server_close()
+
+    served = bench.stats.summary(product)
+    result = {
+        'scenario': name,
+        'returncode': returncode,
+        'wall_seconds': round(wall, 2),
+        'requests': served['requests'],
+        'statuses': served['statuses'],
+        'bytes_served': served['bytes'],
+        'bytes_per_second': round(served['bytes'] / wall) if wall else 0,
+        'requests_per_second': round(served['requests'] / wall, 2) if wall else 0,
+        'max_requests_per_minute': bench.stats.max_per_minute(product),
+        'files_written': sum(len(files) for d, s, files in os.walk(os.path.join(workdir, "input"))),
+        'task_metrics': read_task_metrics(env['METRICS_DIR']),
+        'workdir': workdir,
+    }
+    # the NOMADS limit only applies to the NOMADS products
+    result['rate_ok'] = product == "wrf" or result['max_requests_per_minute'] <= NOMADS_MAX_PER_MINUTE
+
+    if args.keep:
+        print("Output of %s kept in %s" % (name, workdir))
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+        del result['workdir']
+    return result
+
+
+def read_task_metrics(metrics_dir):
+    """
+    :return: The metrics each process recorded itself, see wrfhydro/metrics.py
+    """
+    try:
+        with open(os.path.join(metrics_dir, "metrics.jsonl")) as f:
+            return [json.loads(line)['metrics'] for line in f]
+    except (IOError, ValueError, KeyError):
+        return []
+
+
+def report(results):
+    print("%-16s %6s %9s %8s %8s %10s %9s %6s" % ("scenario", "exit", "wall s", "requests", "req/s",
+                                                  "MB/s", "max/min", "files"))
+    for r in results:
+        print("%-16s %6s %9.2f %8d %8.2f %10.2f %9d %6d%s" % (
+            r['scenario'], r['returncode'], r['wall_seconds'], r['requests'], r['requests_per_second'],
+            r['bytes_per_second'] / 1e6, r['max_requests_per_minute'], r['files_written'],
+            "" if r['rate_ok'] else "  RATE LIMIT EXCEEDED"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the data pull scripts against a local server")
+    parser.add_argument("scenarios", nargs="*", help="scenarios to run, of %s (default: all)" %
+                        ", ".join(sorted(SCENARIOS)))
+    parser.add_argument("--hours", type=int, default=12, help="forecast length in hours (default 12)")
+    parser.add_argument("--date", help="cycle to request, YYYYMMDDHH (default: 00z yesterday)")
+    parser.add_argument("--grib-size", type=int, default=4 * 2**20, help="bytes per GRIB file")
+    parser.add_argument("--wrf-size", type=int, default=64 * 2**20, help="bytes per WRF file")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--bandwidth", type=int, help="bytes per second per connection")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that fail")
+    parser.add_argument("--error-status", type=int, default=503, choices=[429, 503])
+    parser.add_argument("--publish-delay", type=float, default=0.0,
+                        help="seconds before the first file of a cycle appears")
+    parser.add_argument("--publish-interval", type=float, default=0.0,
+                        help="seconds between the appearance of consecutive forecast hours")
+    parser.add_argument("--rounded-sizes", action="store_true", help="list sizes rounded to K/M like Apache")
+    parser.add_argument("--ignore-ranges", action="store_true",
+                        help="answer range requests with the whole file")
+    parser.add_argument("--timeout", type=float, default=1800, help="seconds before a scenario is stopped")
+    parser.add_argument("--keep", action="store_true", help="keep the output of each scenario")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    if args.date:
+        cycle_time = datetime.strptime(args.date, "%Y%m%d%H")
+    else:
+        cycle_time = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1)
+
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario '%s'" % name)
+
+    results = []
+    for name in args.scenarios or sorted(SCENARIOS):
+        print("Running %s" % name)
+        results.append(run_scenario(name, cycle_time, args))
+    report(results)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
+
+    if not all(r['returncode'] == 0 and r['rate_ok'] for r in results):
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,430 @@
+###################################################
+#
+# Local stand-in for the NOMADS and betravedur.is
+# servers, for benchmarking the data pull scripts
+# offline. Serves Apache-style directory listings
+# in the format parsed by nomads.py, GRIB2 files
+# with .idx inventories, and classic netCDF WRF
+# files, with configurable latency, per-connection
+# bandwidth, error responses and delayed
+# publication. Every request is recorded so request
+# rates can be checked against the NOMADS limit.
+#
+###################################################
+
+import os
+import re
+import time
+import random
+import struct
+import hashlib
+import threading
+from datetime import datetime, timedelta
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LISTING_DATE_FORMAT = "%d-%b-%Y %H:%M"
+WRITE_CHUNK = 64 * 1024
+
+# GRIB2 fields of each fake GFS/CFS file. The Forcing Engine fields are mixed with others
+# so subset downloads need several byte ranges.
+GRIB_FIELDS = ["UFLX:surface", "TMP:2 m above ground", "SPFH:2 m above ground", "LHTFL:surface",
+               "UGRD:10 m above ground", "VGRD:10 m above ground", "SOILW:0-0.1 m below ground",
+               "PRATE:surface", "DSWRF:surface", "DLWRF:surface", "PRES:surface", "TCDC:entire atmosphere"]
+
+WRF_FIXED = ["XLAT", "XLONG"]
+WRF_RECORD = ["T2", "Q2", "U10", "V10", "PSFC", "RAINC", "RAINNC", "SWDOWN", "GLW"]
+
+
+class ServerConfig(object):
+    """
+    Behaviour of the benchmark server
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None, error_rate=0.0, error_status=503,
+                 publish_delay=0.0, publish_interval=0.0, rounded_sizes=False, ignore_ranges=False, seed=0):
+        """
+        :param latency: Seconds to wait before answering each request
+        :param bandwidth: Maximum bytes per second sent on each connection, or None
+        :param error_rate: Fraction of requests answered with error_status
+        :param error_status: 503, or 429 (sent with a Retry-After header)
+        :param publish_delay: Seconds after the server starts before the first file of each
+            product appears
+        :param publish_interval: Seconds between the appearance of consecutive forecast hours
+        :param rounded_sizes: If true, listings show sizes rounded to K/M/G like Apache's
+            default, instead of exact byte counts
+        :param ignore_ranges: If true, answer range requests with the whole file, like a server
+            or proxy without range support
+        :param seed: Seed for the error injection
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.publish_delay = publish_delay
+        self.publish_interval = publish_interval
+        self.rounded_sizes = rounded_sizes
+        self.ignore_ranges = ignore_ranges
+        self.random = random.Random(seed)
+
+
+class Entry(object):
+    """
+    A file of the virtual tree
+    """
+
+    def __init__(self, data, mtime, publish_at=0.0):
+        self.data = data
+        self.mtime = mtime
+        self.publish_at = publish_at
+
+
+class Tree(object):
+    """
+    The files served, by path. Directories are implied by the file paths.
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.content = {}
+
+    def add(self, path, data, publish_at=0.0):
+        self.files[path.strip("/")] = Entry(data, time.time(), publish_at)
+
+    def shared(self, key, make):
+        """
+        Build file content once per key, so many equal-sized files cost memory once
+        """
+        if key not in self.content:
+            self.content[key] = make()
+        return self.content[key]
+
+    def visible(self, path, now):
+        entry = self.files.get(path)
+        if entry is None or entry.publish_at > now:
+            return None
+        return entry
+
+    def listing(self, path, now):
+        """
+        :return: A list of (name, is_dir, entry) of a directory's published children, or None
+        """
+        prefix = path.strip("/") + "/" if path.strip("/") else ""
+        children = {}
+        for p, entry in self.files.items():
+            if not p.startswith(prefix) or entry.publish_at > now:
+                continue
+            rest = p[len(prefix):]
+            if "/" in rest:
+                name = rest.split("/")[0]
+                newest = children.get(name, (True, entry))[1]
+                children[name] = (True, entry if entry.mtime >= newest.mtime else newest)
+            else:
+                children[rest] = (False, entry)
+        if not children:
+            return None
+        return [(name, is_dir, entry) for name, (is_dir, entry) in sorted(children.items())]
+
+
+def grib_file(fields, size):
+    """
+    Build a fake GRIB2 file of about size bytes and its wgrib2 inventory
+    :return: A tuple of (data, idx text)
+    """
+    body = max(0, size // len(fields) - 8)
+    data = bytearray()
+    idx = []
+    for i, field in enumerate(fields):
+        idx.append("%d:%d:d=2000010100:%s:anl:" % (i + 1, len(data), field))
+        data += b"GRIB" + bytes([(i * 7) % 256]) * body + b"7777"
+    return bytes(data), "\n".join(idx) + "\n"
+
+
+def pad4(data):
+    return data + b"\0" * ((4 - len(data) % 4) % 4)
+
+
+def nc_name(name):
+    raw = name.encode()
+    return struct.pack(">I", len(raw)) + pad4(raw)
+
+
+def wrf_file(cycle_time, hours, size):
+    """
+    Build a classic (64-bit offset) netCDF file laid out like a WRF output file, with one
+    Time record per hour
+    :param cycle_time: The first valid time as a datetime
+    :param hours: The number of hours after the first record
+    :param size: Approximate file size in bytes
+    :return: The file content
+    """
+    nrec = hours + 1
+    cells = max(1, size // (4 * (nrec * len(WRF_RECORD) + len(WRF_FIXED))))
+    ny = max(1, int(cells ** 0.5))
+    nx = max(1, cells // ny)
+    dims = [("Time", 0), ("DateStrLen", 19), ("south_north", ny), ("west_east", nx)]
+    field = 4 * nx * ny
+
+    variables = [("Times", [0, 1], 2, 19)]
+    variables += [(n, [2, 3], 5, field) for n in WRF_FIXED]
+    variables += [(n, [0, 2, 3], 5, field) for n in WRF_RECORD]
+
+    def header(begins):
+        h = b"CDF\x02" + struct.pack(">I", nrec)
+        h += struct.pack(">II", 0x0A, len(dims)) + b"".join(nc_name(n) + struct.pack(">I", l) for n, l in dims)
+        title = b"BENCHMARK WRF OUTPUT"
+        h += struct.pack(">II", 0x0C, 1) + nc_name("TITLE") + struct.pack(">II", 2, len(title)) + pad4(title)
+        h += struct.pack(">II", 0x0B, len(variables))
+        for name, dimids, nc_type, nbytes in variables:
+            h += nc_name(name) + struct.pack(">I", len(dimids)) + b"".join(struct.pack(">I", d) for d in dimids)
+            h += struct.pack(">II", 0, 0) + struct.pack(">II", nc_type, (nbytes + 3) & ~3)
+            h += struct.pack(">Q", begins.get(name, 0))
+        return h
+
+    pos = len(header({}))
+    begins = {}
+    for name, dimids, nc_type, nbytes in variables:
+        if dimids[0] != 0:
+            begins[name] = pos
+            pos += (nbytes + 3) & ~3
+    for name, dimids, nc_type, nbytes in variables:
+        if dimids[0] == 0:
+            begins[name] = pos
+            pos += (nbytes + 3) & ~3
+
+    data = bytearray(header(begins))
+    for name, dimids, nc_type, nbytes in variables:
+        if dimids[0] != 0:
+            data += b"\0" * ((nbytes + 3) & ~3)
+    for i in range(nrec):
+        times = (cycle_time + timedelta(hours=i)).strftime("%Y-%m-%d_%H:%M:%S").encode()
+        data += pad4(times)
+        for name in WRF_RECORD:
+            data += bytes([i % 256]) * field
+    return bytes(data)
+
+
+def add_gfs(tree, root, cycle_time, hours, size, config, start):
+    """
+    Add the GFS sflux files of a cycle under root, e.g. 'gfs'
+    """
+    data, idx = tree.shared(("grib", size), lambda: grib_file(GRIB_FIELDS, size))
+    directory = "%s/gfs.%s/%s/atmos" % (root, cycle_time.strftime("%Y%m%d"), cycle_time.strftime("%H"))
+    for h in range(hours + 1):
+        publish_at = start + config.publish_delay + h * config.publish_interval
+        name = "gfs.t%sz.sfluxgrbf%03d.grib2" % (cycle_time.strftime("%H"), h)
+        tree.add("%s/%s" % (directory, name), data, publish_at)
+        tree.add("%s/%s.idx" % (directory, name), idx.encode(), publish_at)
+
+
+def add_cfs(tree, root, cycle_time, hours, size, config, start, members=(1, 2, 3, 4)):
+    """
+    Add the 6 hourly CFSv2 flux files of the ensemble members of a cycle under root, e.g. 'cfs'
+    """
+    data, idx = tree.shared(("grib", size), lambda: grib_file(GRIB_FIELDS, size))
+    for member in members:
+        directory = "%s/cfs.%s/%s/6hrly_grib_%02d" % (root, cycle_time.strftime("%Y%m%d"),
+                                                      cycle_time.strftime("%H"), member)
+        for h in range(0, hours + 1, 6):
+            publish_at = start + config.publish_delay + h * config.publish_interval
+            name = "flxf%s.%02d.%s.grb2" % ((cycle_time + timedelta(hours=h)).strftime("%Y%m%d%H"), member,
+                                             cycle_time.strftime("%Y%m%d%H"))
+            tree.add("%s/%s" % (directory, name), data, publish_at)
+            tree.add("%s/%s.idx" % (directory, name), idx.encode(), publish_at)
+
+
+def add_wrf(tree, root, cycle_time, hours, size, config, start):
+    """
+    Add the single multi-hour betravedur.is WRF file of a cycle under root, e.g. 'wrf'
+    """
+    data = tree.shared(("wrf", cycle_time, hours, size), lambda: wrf_file(cycle_time, hours, size))
+    name = cycle_time.strftime("v3.9.1_wrfout_d02_%Y-%m-%d_%H_island.nc")
+    tree.add("%s/%s" % (root, name), data, start + config.publish_delay)
+
+
+def human_size(size):
+    for unit in ("", "K", "M", "G"):
+        if size < 1024 or unit == "G":
+            return ("%d" % size) if unit == "" else ("%.1f%s" % (size, unit))
+        size /= 1024.0
+
+
+class Stats(object):
+    """
+    Requests served, per top-level directory (product)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.bytes = {}
+        self.statuses = {}
+
+    def record(self, product, status, nbytes):
+        with self.lock:
+            self.requests.setdefault(product, []).append(time.time())
+            self.bytes[product] = self.bytes.get(product, 0) + nbytes
+            key = (product, status)
+            self.statuses[key] = self.statuses.get(key, 0) + 1
+
+    def max_per_minute(self, product):
+        """
+        :return: The largest number of requests for product in any 60 second window
+        """
+        with self.lock:
+            times = sorted(self.requests.get(product, []))
+        best = 0
+        j = 0
+        for i, t in enumerate(times):
+            while times[j] <= t - 60:
+                j += 1
+            best = max(best, i - j + 1)
+        return best
+
+    def summary(self, product):
+        with self.lock:
+            times = self.requests.get(product, [])
+            return {
+                'requests': len(times),
+                'bytes': self.bytes.get(product, 0),
+                'statuses': dict((str(s), n) for (p, s), n in self.statuses.items() if p == product),
+            }
+
+    def reset(self):
+        with self.lock:
+            self.requests = {}
+            self.bytes = {}
+            self.statuses = {}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.handle_request(head=True)
+
+    def do_GET(self):
+        self.handle_request(head=False)
+
+    def handle_request(self, head):
+        server = self.server
+        config = server.config
+        path = self.path.split("?")[0].strip("/")
+        product = path.split("/")[0]
+        now = time.time()
+
+        if config.latency:
+            time.sleep(config.latency)
+
+        if config.error_rate and config.random.random() < config.error_rate:
+            headers = {'Retry-After': "5"} if config.error_status == 429 else {}
+            return self.send(config.error_status, b"", headers, head, product)
+
+        entry = server.tree.visible(path, now)
+        if entry is None:
+            children = server.tree.listing(path, now)
+            if children is None:
+                return self.send(404, b"", {}, head, product)
+            return self.send_listing(path, children, head, product)
+
+        headers = {'Last-Modified': formatdate(entry.mtime, usegmt=True), 'Accept-Ranges': "bytes"}
+        ranges = None if config.ignore_ranges else self.parse_range(len(entry.data))
+        if ranges is None:
+            return self.send(200, entry.data, headers, head, product)
+        if len(ranges) == 1:
+            a, b = ranges[0]
+            headers['Content-Range'] = "bytes %d-%d/%d" % (a, b, len(entry.data))
+            return self.send(206, entry.data[a:b + 1], headers, head, product)
+
+        boundary = "BENCHMARKBOUNDARY"
+        body = bytearray()
+        for a, b in ranges:
+            body += ("\r\n--%s\r\nContent-Type: application/octet-stream\r\nContent-Range: bytes %d-%d/%d\r\n\r\n" %
+                     (boundary, a, b, len(entry.data))).encode()
+            body += entry.data[a:b + 1]
+        body += ("\r\n--%s--\r\n" % boundary).encode()
+        headers['Content-Type'] = "multipart/byteranges; boundary=%s" % boundary
+        return self.send(206, bytes(body), headers, head, product)
+
+    def parse_range(self, size):
+        value = self.headers.get('Range')
+        if not value or not value.startswith("bytes="):
+            return None
+        ranges = []
+        for spec in value[6:].split(","):
+            a, b = spec.strip().split("-")
+            a = int(a)
+            b = min(int(b), size - 1) if b else size - 1
+            ranges.append((a, b))
+        return ranges
+
+    def send_listing(self, path, children, head, product):
+        lines = ["<html><head><title>Index of /%s</title></head><body>" % path, "<pre>"]
+        for name, is_dir, entry in children:
+            href = name + "/" if is_dir else name
+            mtime = datetime.utcfromtimestamp(entry.mtime).strftime(LISTING_DATE_FORMAT)
+            if is_dir:
+                size = "-"
+            elif self.server.config.rounded_sizes:
+                size = human_size(len(entry.data))
+            else:
+                size = "%d" % len(entry.data)
+            lines.append('<a href="%s">%s</a>%s %s  %s' % (href, href, " " * max(1, 50 - len(href)), mtime, size))
+        lines.append("</pre></body></html>")
+        body = "\n".join(lines).encode()
+
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            return self.send(304, b"", {'ETag': etag}, True, product)
+        return self.send(200, body, {'ETag': etag, 'Content-Type': "text/html"}, head, product)
+
+    def send(self, status, body, headers, head, product):
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", "%d" % len(body))
+        self.end_headers()
+
+        sent = 0
+        if not head and status != 304:
+            bandwidth = self.server.config.bandwidth
+            start = time.time()
+            for i in range(0, len(body), WRITE_CHUNK):
+                chunk = body[i:i + WRITE_CHUNK]
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                if bandwidth:
+                    ahead = sent / float(bandwidth) - (time.time() - start)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        self.server.stats.record(product, status, sent)
+
+
+class BenchServer(ThreadingHTTPServer):
+    """
+    The benchmark HTTP server. Run it with serve_forever(), e.g. in a thread.
+    """
+    daemon_threads = True
+
+    def __init__(self, tree, config, port=0):
+        """
+        :param tree: The Tree of files to serve
+        :param config: A ServerConfig
+        :param port: The port to listen on, 0 for any free port
+        """
+        ThreadingHTTPServer.__init__(self, ("127.0.0.1", port), Handler)
+        self.tree = tree
+        self.config = config
+        self.stats = Stats()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
@@ -3,7 +3,7 @@
 #
 ##############################################################################
 
-from ecflow import Defs, Suite, Family, Task, Edit, Trigger, Time, Date 
+from ecflow import Defs, Suite, Family, Task, Edit, Trigger, Time, Date, Limit, InLimit, Meter
 from os.path import join
 import os
 
@@ -18,6 +18,8 @@ ECFLOW_DIR = TOP_DIR
 
 # path to data directory
 WRFHYDRO_JOBDIR = TOP_DIR + '/jobdir'
+# task metrics (JSON records and Prometheus textfiles) are written here
+METRICS_DIR = WRFHYDRO_JOBDIR + '/metrics'
 # path to WRFHydro executable
 MODEL_EXE = TOP_DIR + "/wrfhydro/wrf_hydro_NoahMP.exe"
 # path to WGRIB2 executable
@@ -44,34 +46,108 @@ DOMAINS = {
             'forcing_output': 3,
             'model_output': 3,
             'model_restarts': 3,
-            'logs': 3
+            'logs': 3,
+            # the NOMADS listing cache and the parameter table cache
+            'caches': 30
         }
     }
 }
 
-# path to data display/archive host
+# Ensemble members run per cycle. Inputs are pulled once per cycle and shared by
+# the members, which differ in the CFS member the Forcing Engine processes.
+# 'max_active' caps the number of member forcing and model jobs running at once.
+ENSEMBLES = {
+    'longrange': {'members': [1, 2, 3, 4], 'max_active': 2},
+}
+
+# ensemble members share the cycle length of their cycle
+for domain in DOMAINS.values():
+    for cycle, ensemble in ENSEMBLES.items():
+        if cycle in domain['cycle_length']:
+            for member in ensemble['members']:
+                domain['cycle_length'].setdefault(f"{cycle}_mem{member}", domain['cycle_length'][cycle])
+
+# Forcings of these cycles are produced in chunks of this many forecast hours. Each chunk
+# starts once the data pull's progress meter shows its input is on disk, instead of
+# waiting for the whole data pull to complete
+FORCING_CHUNK_HOURS = {
+    'shortrange': 24,
+    'mediumrange': 72,
+    'longrange': 240,
+}
+# data pull meter holding the highest forecast hour pulled without gaps
+PROGRESS_METER = "hours"
+
+# path to data display/archive host. Set DATA_HOST to "" to push
+# to DATAHOST_DIR on the local file system
 DATA_HOST = "hydro-c1-content.rap.ucar.edu"
 DATAHOST_DIR = "/d5/hydroinspector_data/tmp/iceland"
+# number of parallel transfer streams per cycle
+PUSH_WORKERS = 4
+
+# Model output compacted before it is pushed, per output type. 'complevel' is the
+# deflate level; 'quantize' optionally drops precision of floating point variables
+# first: 'digits=N' keeps N significant decimal digits, 'bits=N' N significant bits
+# and 'lsd=N' rounds to N decimal places. Files are rewritten in place in model-output,
+# the only local copy, so quantization is lossy for good and is left off by default.
+# Types not listed are pushed as written.
+COMPACT_OUTPUT = {
+    'LDASOUT': {'complevel': 4},  # 'quantize': 'digits=4'
+    'RTOUT': {'complevel': 4},  # 'quantize': 'digits=4'
+    'CHRTOUT_GRID': {'complevel': 4},
+}
+# number of files compacted in parallel
+COMPACT_WORKERS = 4
+
+# If True, only the GRIB2 fields used by the Forcing Engine are downloaded
+# from NOMADS, using byte-range requests driven by the .idx inventories
+NOMADS_SUBSET = False
 
 # set to False to skip pushing model/FE output data
 # to another host
 PUSH_DATA = True
 
+# If True, each analysis cycle only runs the hours after the latest restart whose
+# forcings have not been revised since, instead of its whole lookback window
+INCREMENTAL_ANALYSIS = True
+
+# Restart interval in hours of the cycles whose namelists only write a restart at the end,
+# so a run killed at its walltime can be resumed from a mid-run restart (see resume.py)
+RESUME_RESTART_HOURS = {'longrange': 24}
+
 # If true, add a task to delete old files
 DELETE_OLD_FILES = True
-PATH_TO_SCRUB_EXE = TOP_DIR + "/wrfhydro/scrub"
+# number of files deleted in parallel by the janitor
+JANITOR_WORKERS = 8
+# If true, the janitor only reports what it would delete
+JANITOR_DRY_RUN = False
 
 ############### Forcing families ##############################
 
+def progress_meter(cycle, member=None):
+    """
+    :return: The name of the data pull meter the forcings of a cycle wait on. Each member of
+             an ensemble has its own, as the members are pulled one after another
+    """
+    if member is None or len(ENSEMBLES[cycle]['members']) == 1:
+        return PROGRESS_METER
+    return f"{PROGRESS_METER}_mem{member}"
+
+
 def create_forcings_family(cycle,member=None):
     """
     Create a family of forcing tasks
     Forcing tasks are created for all domains for the requested cycle
     :param cycle: The model cycle (e.g. analysis, shortrange, etc)
-    :param member: Ensemble member. Default is None (no ensemble)
+    :param member: Ensemble member. Default is None (no ensemble). Members are created in
+                   a family of their own and wait for the data pull of their cycle
     """
-    forcings_family = Family("forcings", Edit(WRFHYDRO_CYCLE=cycle, WRFHYDRO_ENSEMBLE_MEM="" if not member else member))
     wrfhydro_cycle = cycle if member is None else f"{cycle}_mem{member}"
+    forcings_family = Family("forcings", Edit(WRFHYDRO_CYCLE=wrfhydro_cycle, WRFHYDRO_CONFIG=cycle,
+        WRFHYDRO_ENSEMBLE_MEM="" if not member else member))
+    data_pull = "../../data_pull" if member is None else "../../../data_pull"
+    if member is not None:
+        forcings_family += InLimit("members")
     forcings_family += Edit(WGRIB2_EXE=WGRIB2_EXE)
 
     for domain in DOMAINS:
@@ -90,7 +166,19 @@ def create_forcings_family(cycle,member=None):
         if 'params' in DOMAINS[domain]:
             wrfhydro_family += Edit(**DOMAINS[domain]['params'])
 
-        wrfhydro_family += Task("wrfhydro_forcings", Trigger(f"../../data_pull/{domain}/data_pull == complete"))
+        data_pull_task = f"{data_pull}/{domain}/data_pull"
+        chunk = FORCING_CHUNK_HOURS.get(cycle)
+        if not chunk or cycle_length <= chunk:
+            wrfhydro_family += Task("wrfhydro_forcings", Trigger(f"{data_pull_task} == complete"))
+        else:
+            # one family per chunk, starting once the data pull has reached the end of the chunk
+            meter = progress_meter(cycle, member)
+            for start in range(0, cycle_length, chunk):
+                end = min(start + chunk, cycle_length)
+                wrfhydro_family += Family(f"h{start:03d}",
+                    Trigger(f"{data_pull_task}:{meter} >= {end} or {data_pull_task} == complete"),
+                    Edit(FORCING_OFFSET_HRS=start, LENGTH_HRS=end - start),
+                    Task("wrfhydro_forcings"))
         forcings_family += wrfhydro_family
 
     return forcings_family
@@ -100,7 +188,7 @@ def create_forcings_family(cycle,member=None):
 
 
 def create_model_family(cycle,useda=True,requiresCycle=None, restartCycle=None,
-                        member=None, forcingsCycle=None):
+                        member=None, forcingsCycle=None, incremental=False):
     """
     Create a family of tasks for running WRFHYDRO.
     :param cycle: The model cycle (e.g. analysis, shortrange, etc)
@@ -112,6 +200,9 @@ def create_model_family(cycle,useda=True,requiresCycle=None, restartCycle=None,
     :param forcingsCycle: Forcings are used from this cycle instead of the current cycle. Default is None (use forcings
                             from the current cycle)
     :param member: Ensemble member. Default is None (no ensemble)
+    :param incremental: If True, start from the latest restart of this cycle whose forcings are unchanged
+                        instead of running the whole cycle length. Only for cycles restarting from
+                        themselves. Default is False
     """
     if forcingsCycle is None:
         forcingsCycle = cycle + ("" if member is None else f"_mem{member}")
@@ -120,11 +211,22 @@ def create_model_family(cycle,useda=True,requiresCycle=None, restartCycle=None,
 
     wrfhydro_cycle = cycle if member is None else f"{cycle}_mem{member}"
 
+    # a member's forcings are in its own family
+    if member is not None and forcingsCycle == wrfhydro_cycle:
+        forcings = "../../forcings"
+    else:
+        forcings = f"../../../{forcingsCycle}/forcings"
+
     model_family = Family("wrfhydro_model")
-    model_family += Edit(WRFHYDRO_CYCLE=cycle, WRFHYDRO_BASE_CYCLE=forcingsCycle, MODEL_EXECUTABLE=MODEL_EXE,
-        WRFHYDRO_RESTART_CYCLE=restartCycle)
+    model_family += Edit(WRFHYDRO_CYCLE=wrfhydro_cycle, WRFHYDRO_CONFIG=cycle, WRFHYDRO_BASE_CYCLE=forcingsCycle,
+        MODEL_EXECUTABLE=MODEL_EXE, WRFHYDRO_RESTART_CYCLE=restartCycle)
     model_family += Edit(USE_DA="true" if useda else "false")
+    model_family += Edit(INCREMENTAL="true" if incremental else "false")
+    if cycle in RESUME_RESTART_HOURS:
+        model_family += Edit(RESTART_INTERVAL_HOURS=RESUME_RESTART_HOURS[cycle])
     model_family += Edit(WRFHYDRO_ENSEMBLE_MEM="" if not member else member)
+    if member is not None:
+        model_family += InLimit("members")
 
     for domain in DOMAINS:
         if wrfhydro_cycle not in DOMAINS[domain]['cycle_length']:
@@ -142,7 +244,8 @@ def create_model_family(cycle,useda=True,requiresCycle=None, restartCycle=None,
         if requiresCycle:
             wrfhydro_family += Trigger(f"../../{requiresCycle}/wrfhydro_model/{domain}/wrfhydro_model == complete")
 
-        wrfhydro_family += Task("wrfhydro_model", Trigger(f"../../../{forcingsCycle}/forcings/{domain}/wrfhydro_forcings == complete"))
+        # the forcings may be made in chunks, see create_forcings_family
+        wrfhydro_family += Task("wrfhydro_model", Trigger(f"{forcings}/{domain} == complete"))
 
         model_family += wrfhydro_family
 
@@ -154,10 +257,14 @@ def create_model_family(cycle,useda=True,requiresCycle=None, restartCycle=None,
 def create_data_pull_family(cycle):
     """
     Create a family of tasks for pulling raw data from various sources for
-    input to the Forcing Engine
+    input to the Forcing Engine. The data of all ensemble members of the cycle is pulled
     """
     data_pull_family = Family("data_pull")
     data_pull_family += Edit(WRFHYDRO_CYCLE=cycle)
+    if cycle in ENSEMBLES:
+        data_pull_family += Edit(ENSEMBLE_MEMBERS=" ".join(str(m) for m in ENSEMBLES[cycle]['members']))
+    data_pull_family += Edit(NOMADS_SUBSET="true" if NOMADS_SUBSET else "false")
+    data_pull_family += Edit(PROGRESS_METER=PROGRESS_METER if cycle in FORCING_CHUNK_HOURS else "")
 
     for domain in DOMAINS:
         domain_family = Family(domain,
@@ -170,13 +277,26 @@ def create_data_pull_family(cycle):
         cycle_length = DOMAINS[domain]['cycle_length'][cycle]
         domain_family += Edit(LENGTH_HRS=cycle_length)
 
-        domain_family += Task("data_pull")
+        data_pull_task = Task("data_pull")
+        if cycle in FORCING_CHUNK_HOURS:
+            members = ENSEMBLES[cycle]['members'] if cycle in ENSEMBLES else [None]
+            for meter in sorted(set(progress_meter(cycle, member) for member in members)):
+                data_pull_task += Meter(meter, -1, cycle_length)
+        domain_family += data_pull_task
 
         data_pull_family += domain_family
 
     return data_pull_family
 
 
+def compact_spec():
+    """
+    :return: COMPACT_OUTPUT in the form read by compact.py, e.g. "LDASOUT:4:digits=4 CHRTOUT_GRID:4"
+    """
+    return " ".join("%s:%d:%s" % (t, c['complevel'], c.get('quantize') or '')
+                    for t, c in sorted(COMPACT_OUTPUT.items()))
+
+
 def create_data_push_family(cycle, member=None):
     """
     Create a family of tasks to push output data to a display/archive host
@@ -185,7 +305,7 @@ def create_data_push_family(cycle, member=None):
 
     data_push_family = Family("data_push")
     data_push_family += Edit(WRFHYDRO_CYCLE=wrfhydro_cycle,DATA_HOST=DATA_HOST,
-        DATAHOST_DIR=DATAHOST_DIR)
+        DATAHOST_DIR=DATAHOST_DIR,PUSH_WORKERS=PUSH_WORKERS)
 
     for domain in DOMAINS:
         if wrfhydro_cycle not in DOMAINS[domain]['cycle_length']:
@@ -201,7 +321,11 @@ def create_data_push_family(cycle, member=None):
         if 'params' in DOMAINS[domain]:
             domain_family += Edit(**DOMAINS[domain]['params'])
 
-        domain_family += Task("data_push")
+        if COMPACT_OUTPUT:
+            domain_family += Task("compact", Edit(COMPACT_SPEC=compact_spec(), COMPACT_WORKERS=COMPACT_WORKERS))
+            domain_family += Task("data_push", Trigger("compact == complete"))
+        else:
+            domain_family += Task("data_push")
 
         data_push_family += domain_family
 
@@ -210,28 +334,32 @@ def create_data_push_family(cycle, member=None):
 
 def create_janitor_family(cycles):
     """
-    Create a daily task to clean up old files
+    Create a daily task per domain to clean up old files of all cycles in one pass
     """
-    janitor_family = Family("janitor",Edit(SCRUB_EXE=PATH_TO_SCRUB_EXE))
+    janitor_family = Family("janitor",
+        Edit(JANITOR_WORKERS=JANITOR_WORKERS, JANITOR_DRY_RUN="true" if JANITOR_DRY_RUN else "false"))
+
+    def retention(domain, category):
+        # None keeps all files of the category
+        days = DOMAINS[domain]['data_retention_days'][category]
+        return -9999 if days is None else days
 
     for domain in DOMAINS:
         domain_family = Family(domain,
             Edit(WRFHYDRO_DOMAIN=domain, WRFHYDRO_JOBDIR=join(WRFHYDRO_JOBDIR, domain)))
-        
-        for cycle in cycles:
-            cycle_family = Family(cycle, Edit(WRFHYDRO_CYCLE=cycle))
-            cycle_family += Task("janitor",
-                Edit(FORCING_INPUT_RETENTION_DAYS=DOMAINS[domain]['data_retention_days']['forcing_input'],
-                    FORCING_OUTPUT_RETENTION_DAYS=DOMAINS[domain]['data_retention_days']['forcing_output'],
-                    MODEL_OUTPUT_RETENTION_DAYS=DOMAINS[domain]['data_retention_days']['model_output'],
-                    MODEL_RESTARTS_RETENTION_DAYS=DOMAINS[domain]['data_retention_days']['model_restarts'],
-                    LOG_RETENTION_DAYS=DOMAINS[domain]['data_retention_days']['logs']
-                ),
-                Time("00:00"),
-                Date("*.*.*")
-            )
-
-            domain_family += cycle_family
+
+        domain_family += Task("janitor",
+            Edit(JANITOR_CYCLES=" ".join(cycles),
+                FORCING_INPUT_RETENTION_DAYS=retention(domain, 'forcing_input'),
+                FORCING_OUTPUT_RETENTION_DAYS=retention(domain, 'forcing_output'),
+                MODEL_OUTPUT_RETENTION_DAYS=retention(domain, 'model_output'),
+                MODEL_RESTARTS_RETENTION_DAYS=retention(domain, 'model_restarts'),
+                LOG_RETENTION_DAYS=retention(domain, 'logs'),
+                CACHE_RETENTION_DAYS=retention(domain, 'caches')
+            ),
+            Time("00:00"),
+            Date("*.*.*")
+        )
 
         janitor_family += domain_family
 
@@ -240,6 +368,35 @@ def create_janitor_family(cycles):
 
 ###################### Suite definition ################################
 
+def create_cycle_family(cycle, params, **model_args):
+    """
+    Create the family of a model cycle: the data pull, then the forcings, model and data push,
+    once per ensemble member if the cycle has members
+    :param cycle: The model cycle (e.g. analysis, shortrange, etc)
+    :param params: Variables to set on the family
+    :param model_args: Arguments for create_model_family
+    """
+    cycle_family = Family(cycle, Edit(**params), create_data_pull_family(cycle))
+
+    if cycle not in ENSEMBLES:
+        cycle_family += create_forcings_family(cycle)
+        cycle_family += create_model_family(cycle, **model_args)
+        if PUSH_DATA:
+            cycle_family += create_data_push_family(cycle)
+        return cycle_family
+
+    ensemble = ENSEMBLES[cycle]
+    cycle_family += Limit("members", ensemble['max_active'])
+    for member in ensemble['members']:
+        member_family = Family(f"mem{member}", create_forcings_family(cycle, member=member),
+            create_model_family(cycle, member=member, **model_args))
+        if PUSH_DATA:
+            member_family += create_data_push_family(cycle, member=member)
+        cycle_family += member_family
+
+    return cycle_family
+
+
 def create_suite():
     """
     Create the suite definition for all model configurations 
@@ -247,20 +404,10 @@ def create_suite():
 
     params = ICELAND_PARAMS
 
-    analysis = Family("analysis", Edit(**params),create_data_pull_family("analysis"), create_forcings_family("analysis"),
-            create_model_family("analysis", useda=False))
-    shortrange = Family("shortrange", Edit(**params),create_data_pull_family("shortrange"), create_forcings_family("shortrange"),
-                 create_model_family("shortrange", restartCycle="analysis", useda=False)) 
-    mediumrange = Family("mediumrange", Edit(**params),create_data_pull_family("mediumrange"), create_forcings_family("mediumrange"),
-                 create_model_family("mediumrange", restartCycle="analysis", useda=False)) 
-    longrange = Family("longrange", Edit(**params),create_data_pull_family("longrange"), create_forcings_family("longrange"),
-                 create_model_family("longrange", restartCycle="analysis", useda=False))
-
-    if PUSH_DATA:
-        analysis += create_data_push_family("analysis")
-        shortrange += create_data_push_family("shortrange")
-        mediumrange += create_data_push_family("mediumrange")
-        longrange += create_data_push_family("longrange")
+    analysis = create_cycle_family("analysis", params, useda=False, incremental=INCREMENTAL_ANALYSIS)
+    shortrange = create_cycle_family("shortrange", params, restartCycle="analysis", useda=False)
+    mediumrange = create_cycle_family("mediumrange", params, restartCycle="analysis", useda=False)
+    longrange = create_cycle_family("longrange", params, restartCycle="analysis", useda=False)
 
     # these schedule trigger times for each model configuration.
     # At run time, the system will process the run time of T-LATENCY (hours)
@@ -288,7 +435,8 @@ def create_suite():
                PROJ='p48500028',
                QUEUE='regular',
                RUN_MODE=RUN_MODE,
-               WRFHYDRO_JOBDIR=WRFHYDRO_JOBDIR),
+               WRFHYDRO_JOBDIR=WRFHYDRO_JOBDIR,
+               METRICS_DIR=METRICS_DIR),
           analysis,
           shortrange,
           mediumrange,
@@ -296,7 +444,9 @@ def create_suite():
         )
 
     if DELETE_OLD_FILES is True:
-        suite += create_janitor_family(['analysis','shortrange','mediumrange','longrange'])
+        cycles = ['analysis','shortrange','mediumrange','longrange']
+        cycles += [f"{cycle}_mem{member}" for cycle in cycles for member in ENSEMBLES.get(cycle, {}).get('members', [])]
+        suite += create_janitor_family(cycles)
 
     defs = Defs(suite)
 
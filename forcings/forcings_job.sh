@@ -6,6 +6,11 @@
 #PBS -k oed
 #PBS -l select=2:ncpus=36:mpiprocs=36:mem=109GB
 
+# tell the submitting task when the job left the queue
+if [ -n "$JOB_START_FILE" ]; then
+    date +%s > $JOB_START_FILE
+fi
+
 module purge
 module load intel/18.0.5
 module load impi/2018.4.274
@@ -1,16 +1,210 @@
-from ecflow import Client
-    
-try:
-    print("Reloading suite...")
-    ci = Client()
+###################################################
+#
+# Load the suite definition into the ecflow server.
+# If the suite is already loaded, only what has
+# changed in defs/iceland.def is applied: changed
+# variables and triggers are altered in place, and
+# added, removed or otherwise changed nodes are
+# replaced or deleted one by one. Running jobs and
+# the state of unchanged nodes are kept. Nodes with
+# active or submitted tasks are never replaced or
+# deleted; they are reported and left for a later
+# reload. Variables only set on the server, e.g. by
+# hand in ecflow_ui, are kept. --full deletes and
+# reloads the whole suite instead, as before.
+#
+#   python reload_suite.py [--dry-run] [--full] [--host HOST] [--port PORT]
+#
+# The server defaults to ECF_HOST and ECF_PORT, so a
+# reload can be tried against a local test server,
+# e.g. 'ecflow_server --port 3199' and --port 3199.
+#
+###################################################
+
+import os
+import sys
+import argparse
+
+from ecflow import Client, Defs, Suite, Task
+
+SUITE = "wrf_hydro_iceland"
+DEFS_FILE = "defs/iceland.def"
+# variables changed at run time by the tasks or by hand (see README.usage), never reset by a reload
+RUNTIME_VARIABLES = ["CYCLE_DATE", "CYCLE_TIME", "RESTART"]
+# states of tasks with a job in flight
+BUSY_STATES = ["active", "submitted"]
+# node attributes compared other than variables, triggers and children
+ATTRIBUTE_LISTS = ["times", "todays", "dates", "days", "crons", "limits", "inlimits", "meters", "events",
+                   "labels", "zombies", "verifies"]
+
+
+def children(node):
+    """
+    :return: A dict of the child nodes of node by name
+    """
+    if isinstance(node, Task):
+        return {}
+    return dict((c.name(), c) for c in node.nodes)
+
+
+def variables(node):
+    return dict((v.name(), v.value()) for v in node.variables)
+
+
+def expression(expr):
+    return expr.get_expression() if expr else None
+
+
+def attributes(node):
+    """
+    :return: The definition of node other than its variables, trigger and children, comparable
+        between the server's suite and a defs file
+    """
+    attrs = {
+        'type': type(node).__name__,
+        'complete': expression(node.get_complete()),
+        'defstatus': str(node.get_defstatus()),
+    }
+    repeat = node.get_repeat()
+    attrs['repeat'] = None if repeat.empty() else str(repeat)
+    for name in ATTRIBUTE_LISTS:
+        attrs[name] = sorted(str(a) for a in getattr(node, name, []))
+    return attrs
+
+
+def busy_tasks(node):
+    """
+    :return: The paths of the tasks at or below node with a job in flight
+    """
+    tasks = [node] if isinstance(node, Task) else node.get_all_tasks()
+    return [t.get_abs_node_path() for t in tasks if str(t.get_state()) in BUSY_STATES]
+
+
+def diff(current, new, actions):
+    """
+    Compare a node on the server with the same node of the new definition
+    :param current: The node on the server
+    :param new: The node in the new definition
+    :param actions: List the actions that make current match new are appended to, as tuples of
+        ('alter', path, alter arguments), ('replace', path, reason), ('delete', path, reason)
+        or ('skip', path, reason)
+    """
+    path = new.get_abs_node_path()
+
+    if attributes(current) != attributes(new):
+        if isinstance(new, Suite):
+            actions.append(("skip", path, "suite attributes changed, reload with --full"))
+            return
+        busy = busy_tasks(current)
+        if busy:
+            actions.append(("skip", path, "changed, but %s in flight" % ", ".join(busy)))
+        else:
+            actions.append(("replace", path, "changed"))
+        return
+
+    current_variables = variables(current)
+    for name, value in sorted(variables(new).items()):
+        if name not in current_variables:
+            actions.append(("alter", path, ("add", "variable", name, value)))
+        elif current_variables[name] != value and name not in RUNTIME_VARIABLES:
+            actions.append(("alter", path, ("change", "variable", name, value)))
+
+    current_trigger = expression(current.get_trigger())
+    new_trigger = expression(new.get_trigger())
+    if new_trigger != current_trigger:
+        if new_trigger is None:
+            actions.append(("alter", path, ("delete", "trigger", "", "")))
+        else:
+            actions.append(("alter", path, ("change", "trigger", new_trigger, "")))
+
+    current_children = children(current)
+    new_children = children(new)
+    for name, child in new_children.items():
+        if name in current_children:
+            diff(current_children[name], child, actions)
+        else:
+            actions.append(("replace", child.get_abs_node_path(), "added"))
+    for name, child in current_children.items():
+        if name in new_children:
+            continue
+        busy = busy_tasks(child)
+        if busy:
+            actions.append(("skip", child.get_abs_node_path(), "removed, but %s in flight" % ", ".join(busy)))
+        else:
+            actions.append(("delete", child.get_abs_node_path(), "removed"))
+
+
+def apply(client, defs, actions, dry_run=False):
+    """
+    Apply the actions found by diff
+    :param client: The ecflow Client
+    :param defs: The new definition
+    :param actions: The actions
+    :param dry_run: If True, only print the actions
+    """
+    for action, path, args in actions:
+        if action == "alter":
+            print("alter %s %s %s" % (path, " ".join(args[:2]), " ".join(a for a in args[2:] if a)))
+            if not dry_run:
+                client.alter(path, *args)
+        else:
+            print("%s %s (%s)" % (action, path, args))
+            if dry_run or action == "skip":
+                continue
+            if action == "replace":
+                # begun with the suite, in its default state
+                client.replace(path, defs, True, False)
+            elif action == "delete":
+                client.delete(path)
+
+
+def full_reload(client, defs_file):
     try:
-        ci.delete("/wrf_hydro_iceland", force=True)           # clear out the server
-    except:
+        client.delete("/%s" % SUITE, force=True)           # clear out the server
+    except RuntimeError:
         pass
-    ci.load("defs/iceland.def")       # load the definition into the server
-    
-    ci.begin_suite("wrf_hydro_iceland")    # start the suite
-    #ci.suspend("wrf_hydro_iceland")
-    print("Complete")
-except RuntimeError as e:
-    print("Failed:", e)
+    client.load(defs_file)       # load the definition into the server
+
+    client.begin_suite(SUITE)    # start the suite
+    #client.suspend(SUITE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load or update the suite definition in the ecflow server")
+    parser.add_argument("--defs", default=DEFS_FILE, help="definition file (default %s)" % DEFS_FILE)
+    parser.add_argument("--full", action="store_true",
+                        help="delete and reload the whole suite, resetting the state of every node")
+    parser.add_argument("--dry-run", action="store_true", help="only print what would be changed")
+    parser.add_argument("--host", default=os.environ.get("ECF_HOST", "localhost"))
+    parser.add_argument("--port", default=os.environ.get("ECF_PORT", "3141"))
+    args = parser.parse_args()
+
+    try:
+        print("Reloading suite...")
+        ci = Client(args.host, args.port)
+        ci.sync_local()
+        server_defs = ci.get_defs()
+        current = server_defs.find_suite(SUITE) if server_defs else None
+
+        if args.full or current is None:
+            print("Loading %s" % args.defs)
+            if not args.dry_run:
+                full_reload(ci, args.defs)
+        else:
+            defs = Defs(args.defs)
+            actions = []
+            diff(current, defs.find_suite(SUITE), actions)
+            apply(ci, defs, actions, args.dry_run)
+            skipped = sum(1 for a in actions if a[0] == "skip")
+            print("%d changes, %d skipped" % (len(actions) - skipped, skipped))
+            if skipped:
+                print("Reload again once the jobs in flight have finished, or use --full")
+
+        print("Complete")
+    except RuntimeError as e:
+        print("Failed:", e)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
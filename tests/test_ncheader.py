@@ -0,0 +1,202 @@
+###################################################
+#
+# Round trip of the classic netCDF header parser and
+# encoder through wrf_extract.write_classic_slice.
+# Source files are laid out here from the format
+# specification, independently of ncheader, and each
+# extracted record is checked against the bytes of
+# that record in the source.
+#
+#   python -m pytest tests
+#
+###################################################
+
+import os
+import sys
+import shutil
+import struct
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "wrfhydro"))
+
+import ncheader
+import wrf_extract
+
+NC_CHAR = 2
+NC_SHORT = 3
+NC_FLOAT = 5
+TYPE_SIZES = {NC_CHAR: 1, NC_SHORT: 2, NC_FLOAT: 4}
+
+
+def pad4(n):
+    return (n + 3) & ~3
+
+
+def name_bytes(name):
+    raw = name.encode()
+    return struct.pack(">I", len(raw)) + raw + b"\0" * (pad4(len(raw)) - len(raw))
+
+
+def att_list(atts):
+    """
+    :param atts: A list of (name, text) character attributes
+    """
+    if not atts:
+        return struct.pack(">II", 0, 0)
+    out = struct.pack(">II", ncheader.NC_ATTRIBUTE, len(atts))
+    for name, text in atts:
+        raw = text.encode()
+        out += name_bytes(name) + struct.pack(">II", NC_CHAR, len(raw)) + raw + b"\0" * (pad4(len(raw)) - len(raw))
+    return out
+
+
+def fill(size, seed):
+    return bytes((seed * 31 + i * 7) % 251 for i in range(size))
+
+
+def build_classic(version, dims, variables, numrecs):
+    """
+    Lay out a classic (version 1) or 64-bit offset (version 2) file
+    :param dims: A list of (name, length), length 0 for the record dimension
+    :param variables: A list of (name, dim names, type)
+    :param numrecs: The number of records
+    :return: A tuple of (file bytes, {variable name: [data of each record, or the fixed data]})
+    """
+    dim_ids = dict((name, i) for i, (name, length) in enumerate(dims))
+    lengths = dict(dims)
+    offset_fmt = ">Q" if version == 2 else ">I"
+
+    layout = []
+    for name, dim_names, nc_type in variables:
+        is_record = lengths[dim_names[0]] == 0
+        count = 1
+        for d in dim_names[1 if is_record else 0:]:
+            count *= lengths[d]
+        size = count * TYPE_SIZES[nc_type]
+        layout.append((name, dim_names, nc_type, is_record, size, pad4(size)))
+    record_vars = [v for v in layout if v[3]]
+
+    def header(begins):
+        out = b"CDF" + bytes([version]) + struct.pack(">I", numrecs)
+        out += struct.pack(">II", ncheader.NC_DIMENSION, len(dims))
+        for name, length in dims:
+            out += name_bytes(name) + struct.pack(">I", length)
+        out += att_list([("TITLE", "test file")])
+        out += struct.pack(">II", ncheader.NC_VARIABLE, len(layout))
+        for name, dim_names, nc_type, is_record, size, vsize in layout:
+            out += name_bytes(name) + struct.pack(">I", len(dim_names))
+            out += b"".join(struct.pack(">I", dim_ids[d]) for d in dim_names)
+            out += att_list([("units", "m")])
+            out += struct.pack(">II", nc_type, vsize) + struct.pack(offset_fmt, begins.get(name, 0))
+        return out
+
+    pos = len(header({}))
+    begins = {}
+    for name, dim_names, nc_type, is_record, size, vsize in layout:
+        if not is_record:
+            begins[name] = pos
+            pos += vsize
+    for name, dim_names, nc_type, is_record, size, vsize in record_vars:
+        begins[name] = pos
+        pos += vsize
+
+    data = {}
+    body = header(begins)
+    for i, (name, dim_names, nc_type, is_record, size, vsize) in enumerate(layout):
+        if not is_record:
+            data[name] = [fill(size, i)]
+            body += data[name][0] + b"\0" * (vsize - size)
+    for r in range(numrecs):
+        for i, (name, dim_names, nc_type, is_record, size, vsize) in enumerate(record_vars):
+            record = fill(size, 100 * (r + 1) + i)
+            data.setdefault(name, []).append(record)
+            # a lone record variable is not padded
+            body += record + (b"" if len(record_vars) == 1 else b"\0" * (vsize - size))
+    return body, data
+
+
+class ClassicSliceTest(unittest.TestCase):
+
+    DIMS = [("Time", 0), ("south_north", 3), ("west_east", 2), ("DateStrLen", 5)]
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def slice(self, version, variables, numrecs, index, keep=None):
+        """
+        Extract record index of a file laid out by build_classic
+        :return: A tuple of (source data by variable, extracted bytes, extracted header)
+        """
+        body, data = build_classic(version, self.DIMS, variables, numrecs)
+        source = os.path.join(self.dir, "wrfout.nc")
+        with open(source, "wb") as f:
+            f.write(body)
+
+        with open(source, "rb") as f:
+            header = wrf_extract.read_classic_header(f, len(body))
+        self.assertEqual(header.version, version)
+        self.assertEqual(header.numrecs, numrecs)
+        self.assertEqual(header.data_end(), len(body))
+
+        outfile = os.path.join(self.dir, "wrfout_f%02d.nc" % index)
+        fd = os.open(source, os.O_RDONLY)
+        try:
+            wrf_extract.write_classic_slice(fd, header, outfile, index, keep)
+        finally:
+            os.close(fd)
+        with open(outfile, "rb") as f:
+            out = f.read()
+        return data, out, ncheader.parse_header(out)
+
+    def check(self, data, out, header, index, names):
+        """
+        Check that every variable of the extracted file holds the source's bytes of the record
+        """
+        self.assertEqual(header.numrecs, 1)
+        self.assertEqual([v.name for v in header.variables], names)
+        self.assertEqual(header.data_end(), len(out))
+        for var in header.variables:
+            expected = data[var.name][index if var.is_record else 0]
+            self.assertEqual(out[var.begin:var.begin + len(expected)], expected, var.name)
+
+    def test_several_record_variables(self):
+        variables = [("XLAT", ["south_north", "west_east"], NC_FLOAT),
+                     ("Times", ["Time", "DateStrLen"], NC_CHAR),
+                     ("T2", ["Time", "south_north", "west_east"], NC_FLOAT),
+                     ("LU", ["Time", "south_north"], NC_SHORT)]
+        for version in (1, 2):
+            data, out, header = self.slice(version, variables, 3, 1)
+            self.assertEqual(header.version, version)
+            self.check(data, out, header, 1, ["XLAT", "Times", "T2", "LU"])
+
+    def test_variable_subset(self):
+        variables = [("XLAT", ["south_north", "west_east"], NC_FLOAT),
+                     ("Times", ["Time", "DateStrLen"], NC_CHAR),
+                     ("T2", ["Time", "south_north", "west_east"], NC_FLOAT),
+                     ("LU", ["Time", "south_north"], NC_SHORT)]
+        data, out, header = self.slice(1, variables, 3, 2, keep=["Times", "LU"])
+        self.check(data, out, header, 2, ["Times", "LU"])
+
+    def test_single_record_variable(self):
+        # 6 bytes a record, stored without padding to 8
+        variables = [("XLAT", ["south_north", "west_east"], NC_FLOAT),
+                     ("LU", ["Time", "south_north"], NC_SHORT)]
+        for version in (1, 2):
+            data, out, header = self.slice(version, variables, 3, 2)
+            self.assertEqual(header.recsize, 6)
+            self.check(data, out, header, 2, ["XLAT", "LU"])
+
+    def test_single_record_variable_kept_from_several(self):
+        variables = [("Times", ["Time", "DateStrLen"], NC_CHAR),
+                     ("LU", ["Time", "south_north"], NC_SHORT)]
+        data, out, header = self.slice(1, variables, 3, 1, keep=["LU"])
+        self.assertEqual(header.recsize, 6)
+        self.check(data, out, header, 1, ["LU"])
+
+
+if __name__ == "__main__":
+    unittest.main()
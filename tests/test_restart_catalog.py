@@ -0,0 +1,274 @@
+###################################################
+#
+# Tests of the restart catalog: the completeness
+# checks that decide which restart a run starts
+# from, and when the catalog and the results of
+# those checks are reused.
+#
+#   python -m pytest tests
+#
+###################################################
+
+import os
+import sys
+import shutil
+import struct
+import tempfile
+import unittest
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "wrfhydro"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import ncheader
+import restart_catalog
+from restart_catalog import RestartCatalog, inspect, dims_error
+from test_ncheader import build_classic, NC_FLOAT
+
+DIMS = [("Time", 0), ("south_north", 3), ("west_east", 2)]
+VARIABLES = [("SOIL_T", ["Time", "south_north", "west_east"], NC_FLOAT)]
+
+
+def restart(dims=DIMS):
+    """
+    :return: The bytes of a small complete classic restart
+    """
+    return build_classic(1, dims, VARIABLES, 1)[0]
+
+
+def hdf5(version, eof, size, flags=0, base=0):
+    """
+    Lay out an HDF5 superblock followed by zeros
+    :param version: The superblock version, 0 to 3
+    :param eof: The end of file address the superblock records
+    :param size: The size of the file
+    :param flags: The file consistency flags, of version 2 and 3 superblocks
+    :param base: The base address, the offset of the superblock in the file
+    :return: The file bytes
+    """
+    if version in (0, 1):
+        sb = ncheader.HDF5_SIGNATURE + bytes([version, 0, 0, 0, 0, 8, 8, 0]) + struct.pack("<HHI", 4, 16, 0)
+        if version == 1:
+            sb += struct.pack("<HH", 32, 0)
+        # base, free space, end of file and driver addresses
+        sb += struct.pack("<QQQQ", base, 2 ** 64 - 1, eof, 2 ** 64 - 1)
+    else:
+        sb = ncheader.HDF5_SIGNATURE + bytes([version, 8, 8, flags])
+        # base, superblock extension, end of file and root group addresses, checksum
+        sb += struct.pack("<QQQQI", base, 2 ** 64 - 1, eof, 48, 0)
+    return sb + b"\0" * (size - len(sb))
+
+
+class CatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.run_dir = os.path.join(self.dir, "wrfhydro")
+        os.mkdir(self.run_dir)
+        self.scans = 0
+        self.scan = restart_catalog.scan
+
+        def counting_scan(indir):
+            self.scans += 1
+            return self.scan(indir)
+        restart_catalog.scan = counting_scan
+
+    def tearDown(self):
+        restart_catalog.scan = self.scan
+        shutil.rmtree(self.dir)
+
+    def write(self, name, data):
+        path = os.path.join(self.run_dir, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def write_restarts(self, hour, data=None):
+        """
+        Write the hrldas and hydro restarts valid at hour on 1 October 2021
+        :return: Their paths
+        """
+        data = data if data is not None else restart()
+        return (self.write("RESTART.20211001%02d_DOMAIN1" % hour, data),
+                self.write("HYDRO_RST.2021-10-01_%02d:00_DOMAIN1" % hour, data))
+
+
+class SealTest(CatalogTest):
+
+    def test_sealed_catalog_survives_other_writes(self):
+        self.write_restarts(0)
+        RestartCatalog(self.run_dir).update(sealed=True)
+        self.scans = 0
+
+        # links, logs and output of later cycles
+        os.symlink("/nonexistent", os.path.join(self.run_dir, "FORCING"))
+        self.write("201910010100.CHRTOUT_DOMAIN1", b"")
+        catalog = RestartCatalog(self.run_dir)
+        self.assertEqual(self.scans, 0)
+        self.assertTrue(catalog.best("hydro", datetime(2021, 10, 1, 6)).endswith("HYDRO_RST.2021-10-01_00:00_DOMAIN1"))
+
+    def test_unsealed_catalog_is_rebuilt_when_the_directory_changes(self):
+        self.write_restarts(0)
+        RestartCatalog(self.run_dir).update(sealed=True)
+        RestartCatalog(self.run_dir).unseal()
+        self.scans = 0
+
+        # unchanged directory, the catalog is still good
+        RestartCatalog(self.run_dir)
+        self.assertEqual(self.scans, 0)
+
+        # the model writes restarts
+        self.write_restarts(1)
+        catalog = RestartCatalog(self.run_dir)
+        self.assertEqual(self.scans, 1)
+        self.assertFalse(catalog.sealed)
+        self.assertTrue(catalog.best("hrldas", datetime(2021, 10, 1, 6)).endswith("RESTART.2021100101_DOMAIN1"))
+
+
+class InspectTest(CatalogTest):
+
+    def test_complete_classic(self):
+        self.assertEqual(inspect(self.write("a", restart())), (None, {"south_north": 3, "west_east": 2}))
+
+    def test_short_classic(self):
+        data = restart()
+        error, dims = inspect(self.write("a", data[:-4]))
+        self.assertEqual(error, "truncated, %d of %d bytes" % (len(data) - 4, len(data)))
+        self.assertIsNone(dims)
+
+    def test_truncated_classic_header(self):
+        self.assertEqual(inspect(self.write("a", restart()[:10])), ("truncated header", None))
+
+    def test_classic_not_closed(self):
+        data = restart()
+        data = data[:4] + struct.pack(">I", ncheader.STREAMING) + data[8:]
+        self.assertEqual(inspect(self.write("a", data)), ("file was not closed by its writer", None))
+
+    def test_truncated_hdf5(self):
+        for version in range(4):
+            error, dims = inspect(self.write("a", hdf5(version, 4096, 1024)))
+            self.assertEqual(error, "truncated, 1024 of 4096 bytes", version)
+            self.assertIsNone(dims)
+
+    def test_complete_hdf5(self):
+        if restart_catalog.netCDF4 is not None:
+            self.skipTest("netCDF4 would open the file")
+        for version in range(4):
+            self.assertEqual(inspect(self.write("a", hdf5(version, 1024, 1024))), (None, None), version)
+
+    def test_hdf5_not_closed(self):
+        error, dims = inspect(self.write("a", hdf5(3, 1024, 1024, restart_catalog.HDF5_WRITE_ACCESS)))
+        self.assertEqual(error, "HDF5 file was not closed by its writer")
+
+    def test_hdf5_after_user_block(self):
+        error, dims = inspect(self.write("a", b"\0" * 512 + hdf5(2, 4096, 1024, base=512)))
+        # the end of file address is relative to the base address
+        self.assertEqual(error, "truncated, 1536 of 4608 bytes")
+
+    def test_not_netcdf(self):
+        error, dims = inspect(self.write("a", b"\0" * 1024))
+        self.assertEqual(error, "no HDF5 superblock")
+
+    def test_dims_error(self):
+        expected = {"south_north": 3, "west_east": 2}
+        self.assertIsNone(dims_error({"south_north": 3, "west_east": 2, "soil_layers": 4}, expected))
+        self.assertEqual(dims_error({"south_north": 3, "west_east": 5}, expected), "dimension west_east is 5, expected 2")
+        self.assertEqual(dims_error({"south_north": 3}, expected), "dimension west_east is None, expected 2")
+        self.assertIsNone(dims_error(None, expected))
+        self.assertIsNone(dims_error({"south_north": 4}, None))
+
+
+class BestTest(CatalogTest):
+
+    T = datetime(2021, 10, 1, 6)
+
+    def best(self, type, reference=None):
+        return os.path.basename(RestartCatalog(self.run_dir).best(type, self.T, reference=reference))
+
+    def test_falls_back_past_short_classic(self):
+        self.write_restarts(1)
+        self.write_restarts(2, restart()[:-4])
+        self.write_restarts(3, restart()[:10])
+        self.assertEqual(self.best("hrldas"), "RESTART.2021100101_DOMAIN1")
+        self.assertEqual(self.best("hydro"), "HYDRO_RST.2021-10-01_01:00_DOMAIN1")
+
+    def test_falls_back_past_truncated_hdf5(self):
+        self.write_restarts(1)
+        self.write_restarts(2, hdf5(2, 4096, 1024))
+        self.assertEqual(self.best("hydro"), "HYDRO_RST.2021-10-01_01:00_DOMAIN1")
+
+    def test_falls_back_past_other_domain(self):
+        reference = os.path.join(self.dir, "HYDRO_RESTART.default")
+        with open(reference, "wb") as f:
+            f.write(restart())
+        self.write_restarts(1)
+        self.write_restarts(2, restart([("Time", 0), ("south_north", 4), ("west_east", 2)]))
+        self.assertEqual(self.best("hydro", reference), "HYDRO_RST.2021-10-01_01:00_DOMAIN1")
+        # without a reference the newest complete restart is used
+        self.assertEqual(self.best("hydro"), "HYDRO_RST.2021-10-01_02:00_DOMAIN1")
+
+    def test_nothing_usable(self):
+        self.write_restarts(1, restart()[:-4])
+        self.assertIsNone(RestartCatalog(self.run_dir).best("hydro", self.T))
+        # unless the restarts are not verified
+        self.assertIsNotNone(RestartCatalog(self.run_dir).best("hydro", self.T, verify=False))
+
+
+class CheckTest(CatalogTest):
+
+    def setUp(self):
+        CatalogTest.setUp(self)
+        self.inspected = []
+        self.inspect = restart_catalog.inspect
+
+        def counting_inspect(path):
+            self.inspected.append(os.path.basename(path))
+            return self.inspect(path)
+        restart_catalog.inspect = counting_inspect
+
+    def tearDown(self):
+        restart_catalog.inspect = self.inspect
+        CatalogTest.tearDown(self)
+
+    def test_check_is_remembered(self):
+        path = self.write_restarts(1)[1]
+        catalog = RestartCatalog(self.run_dir)
+        self.assertEqual(catalog.best("hydro", datetime(2021, 10, 1, 6)), path)
+        self.assertEqual(self.inspected, ["HYDRO_RST.2021-10-01_01:00_DOMAIN1"])
+
+        # by the catalog, and by the next one loaded from disk once best() has saved it
+        self.assertEqual(catalog.check(path), (None, {"south_north": 3, "west_east": 2}))
+        RestartCatalog(self.run_dir).best("hydro", datetime(2021, 10, 1, 6))
+        self.assertEqual(len(self.inspected), 1)
+
+    def test_check_keyed_on_mtime_and_size(self):
+        path = self.write_restarts(1)[1]
+        catalog = RestartCatalog(self.run_dir)
+        catalog.check(path)
+        st = os.stat(path)
+
+        # same size and modification time, the earlier result stands
+        data = restart()
+        self.write(os.path.basename(path), b"\0" * len(data))
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        catalog.changed = False
+        self.assertEqual(catalog.check(path)[0], None)
+        self.assertFalse(catalog.changed)
+        self.assertEqual(len(self.inspected), 1)
+
+        # rewritten in place
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+        self.assertIsNotNone(catalog.check(path)[0])
+        self.assertTrue(catalog.changed)
+        self.assertEqual(len(self.inspected), 2)
+
+        # grown since, at the same modification time
+        self.write(os.path.basename(path), data + b"\0" * 4)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+        self.assertEqual(catalog.check(path)[0], None)
+        self.assertEqual(len(self.inspected), 3)
+        self.assertEqual(catalog.checks[os.path.basename(path)][:2], [st.st_mtime_ns + 1000, len(data) + 4])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,201 @@
+import os
+import glob
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+from metrics import TaskMetrics
+
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+
+logging.basicConfig(format="%(levelname)s, %(asctime)s %(message)s", level=logging.DEBUG)
+
+###########################
+#
+# This script compacts model output files in place before they are pushed: each
+# variable is rechunked to one 2-D field per chunk, deflated, and floating point
+# variables are optionally quantized first so they compress better. Files are
+# processed in parallel, one per process.
+#
+# Script configuration is pulled from the environment:
+#
+#   MODEL_OUTPUT_DIR  : the cycle's model output directory
+#   COMPACT_SPEC      : space separated list of TYPE:COMPLEVEL[:QUANTIZE], e.g.
+#                       "LDASOUT:4:digits=3 CHRTOUT_GRID:4". QUANTIZE is one of
+#                       digits=N (significant decimal digits), bits=N (significant
+#                       bits, bit rounding) or lsd=N (least significant decimal digit)
+#   COMPACT_WORKERS   : number of processes (default 4)
+#
+###########################
+
+MODEL_OUTPUT_DIR = os.environ['MODEL_OUTPUT_DIR']
+SPEC = os.environ.get('COMPACT_SPEC', '')
+WORKERS = int(os.environ.get('COMPACT_WORKERS', 4))
+# names of the horizontal dimensions of the model and WRF grids
+HORIZONTAL_DIMS = ["y", "x", "south_north", "west_east"]
+
+
+def parse_spec(spec):
+    """
+    :return: A dict mapping output type to (complevel, quantize), quantize being None or a
+        (kind, value) tuple
+    """
+    result = {}
+    for item in spec.split():
+        parts = item.split(":")
+        quantize = None
+        if len(parts) > 2 and parts[2]:
+            kind, value = parts[2].split("=")
+            if kind not in ("digits", "bits", "lsd"):
+                raise ValueError("Unknown quantization '%s' for %s" % (kind, parts[0]))
+            quantize = (kind, int(value))
+        result[parts[0]] = (int(parts[1]), quantize)
+    return result
+
+
+def chunk_sizes(var):
+    """
+    One chunk per horizontal field: the horizontal dimensions whole, the others one element.
+    The horizontal dimensions are found by name, as LDASOUT has its soil layers between y and
+    x. Variables without them are one chunk if 1-D or 2-D (e.g. per reach), otherwise their
+    last two dimensions are taken as horizontal.
+    """
+    shape = var.shape
+    horizontal = [d in HORIZONTAL_DIMS for d in var.dimensions]
+    if not any(horizontal):
+        if len(shape) <= 2:
+            return [max(1, n) for n in shape]
+        horizontal = [False] * (len(shape) - 2) + [True, True]
+    return [max(1, n) if h else 1 for n, h in zip(shape, horizontal)]
+
+
+def compressible(var):
+    # variable length strings cannot be deflated
+    return var.ndim > 0 and var.dtype != str
+
+
+def is_compacted(src):
+    """
+    :return: True if every variable that can be deflated already is
+    """
+    for var in src.variables.values():
+        if compressible(var) and not var.filters().get('zlib'):
+            return False
+    return True
+
+
+def exact_variables(src):
+    """
+    :return: The names of the variables never quantized: coordinate variables, the variables
+        named by coordinates attributes, and grid mapping and bounds variables
+    """
+    names = set(src.dimensions)
+    for var in src.variables.values():
+        attrs = var.ncattrs()
+        if 'coordinates' in attrs:
+            names.update(str(var.getncattr('coordinates')).split())
+        for attr in ('grid_mapping', 'bounds'):
+            if attr in attrs:
+                names.add(str(var.getncattr(attr)))
+    return names
+
+
+def compact_file(path, complevel, quantize=None):
+    """
+    Rewrite a netCDF file deflated and optionally quantized, replacing the original
+    :param path: The file to compact
+    :param complevel: The deflate level, 1-9
+    :param quantize: None, or a tuple of (kind, value), kind being 'digits', 'bits' or 'lsd'
+    :return: A tuple of (size before, size after)
+    """
+    try:
+        return write_compacted(path, complevel, quantize)
+    except Exception:
+        if os.path.exists(path + ".tmp"):
+            os.remove(path + ".tmp")
+        raise
+
+
+def write_compacted(path, complevel, quantize=None):
+    before = os.path.getsize(path)
+    tmp = path + ".tmp"
+
+    with netCDF4.Dataset(path) as src:
+        if is_compacted(src):
+            return before, before
+        src.set_auto_maskandscale(False)
+
+        # compression needs the HDF5 based format
+        fmt = src.data_model if src.data_model.startswith("NETCDF4") else "NETCDF4_CLASSIC"
+        with netCDF4.Dataset(tmp, "w", format=fmt) as dst:
+            dst.set_auto_maskandscale(False)
+            dst.setncatts({k: src.getncattr(k) for k in src.ncattrs()})
+            for name, dim in src.dimensions.items():
+                dst.createDimension(name, None if dim.isunlimited() else len(dim))
+            exact = exact_variables(src)
+
+            for name, var in src.variables.items():
+                attrs = {k: var.getncattr(k) for k in var.ncattrs()}
+                fill_value = attrs.pop('_FillValue', None)
+
+                options = {}
+                if compressible(var):
+                    options = dict(zlib=True, complevel=complevel, shuffle=True, chunksizes=chunk_sizes(var))
+                    # packed variables are not quantized, their precision is set by scale_factor,
+                    # nor are coordinates, which would shift the grid
+                    if quantize and var.dtype.kind == 'f' and 'scale_factor' not in attrs and name not in exact:
+                        kind, value = quantize
+                        if kind == "lsd":
+                            options['least_significant_digit'] = value
+                        else:
+                            options['significant_digits'] = value
+                            options['quantize_mode'] = "BitRound" if kind == "bits" else "GranularBitRound"
+
+                out = dst.createVariable(name, var.datatype, var.dimensions, fill_value=fill_value, **options)
+                out.setncatts(attrs)
+                if var.ndim > 0:
+                    out[:] = var[:]
+                else:
+                    out.assignValue(var.getValue())
+
+    os.replace(tmp, path)
+    return before, os.path.getsize(path)
+
+
+def run():
+    if not SPEC:
+        return
+    if netCDF4 is None:
+        logging.warning("netCDF4 not available, not compacting output")
+        return
+
+    jobs = []
+    for type, (complevel, quantize) in parse_spec(SPEC).items():
+        for path in sorted(glob.glob("%s/*.%s*" % (MODEL_OUTPUT_DIR, type))):
+            if not path.endswith(".tmp"):
+                jobs.append((path, complevel, quantize))
+
+    total_before = total_after = 0
+    with ProcessPoolExecutor(max_workers=WORKERS) as pool:
+        futures = [pool.submit(compact_file, *job) for job in jobs]
+        for job, future in zip(jobs, futures):
+            try:
+                before, after = future.result()
+            except Exception as e:
+                # the original file is left as it was
+                logging.warning("Unable to compact %s: %s" % (job[0], e))
+                continue
+            total_before += before
+            total_after += after
+
+    logging.info("Compacted %d files from %.1f MB to %.1f MB" % (len(jobs), total_before / 1e6,
+                                                                  total_after / 1e6))
+    metrics = TaskMetrics("compact")
+    metrics.update({'files': len(jobs), 'bytes_before': total_before, 'bytes_after': total_after})
+    metrics.write()
+
+
+if __name__ == "__main__":
+    run()
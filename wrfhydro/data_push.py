@@ -0,0 +1,172 @@
+import os
+import glob
+import json
+import shlex
+import shutil
+import subprocess
+import tempfile
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import TaskMetrics
+
+logging.basicConfig(format="%(levelname)s, %(asctime)s %(message)s", level=logging.DEBUG)
+
+###########################
+#
+# This script pushes selected model output and forcing files of one cycle to a
+# display/archive host. All transfers share one multiplexed ssh connection, and
+# files are sent as a few parallel tar streams instead of one scp per file. A
+# manifest in the model output directory records what was delivered, so a rerun
+# only sends files that are new or have changed.
+#
+# Script configuration is pulled from the environment:
+#
+#   MODEL_OUTPUT_DIR     : the cycle's model output directory
+#   FORCINGS_OUTPUT_DIR  : the cycle's forcing output directory
+#   DATA_HOST            : the host to push to. If empty, PUSH_DEST is a local directory
+#   PUSH_DEST            : the directory to push to
+#   PUSH_WORKERS         : number of parallel tar streams (default 4)
+#
+###########################
+
+MODEL_OUTPUT_TYPES = ["LDASOUT", "RTOUT", "LAKEOUT", "CHRTOUT_GRID"]
+FORCING_TYPES = ["LDASIN"]
+MANIFEST = "push_manifest.json"
+SSH_OPTIONS = ["-o", "BatchMode=yes", "-o", "ServerAliveInterval=30"]
+
+MODEL_OUTPUT_DIR = os.environ['MODEL_OUTPUT_DIR']
+FORCINGS_OUTPUT_DIR = os.environ['FORCINGS_OUTPUT_DIR']
+DATA_HOST = os.environ.get('DATA_HOST', '')
+PUSH_DEST = os.environ['PUSH_DEST']
+WORKERS = int(os.environ.get('PUSH_WORKERS', 4))
+
+
+def find_files():
+    """
+    :return: A list of (directory, file name) of the files to push
+    """
+    files = []
+    for directory, types in [(MODEL_OUTPUT_DIR, MODEL_OUTPUT_TYPES), (FORCINGS_OUTPUT_DIR, FORCING_TYPES)]:
+        for t in types:
+            for path in sorted(glob.glob("%s/*.%s*" % (directory, t))):
+                files.append((directory, os.path.basename(path)))
+    return files
+
+
+def file_key(directory, name):
+    st = os.stat(os.path.join(directory, name))
+    return [st.st_size, st.st_mtime_ns]
+
+
+def load_manifest(path):
+    """
+    :return: A dict mapping file name to [size, mtime] of the files already delivered to PUSH_DEST
+    """
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+        if manifest.get('dest') == "%s:%s" % (DATA_HOST, PUSH_DEST):
+            return manifest['files']
+    except (IOError, ValueError, KeyError):
+        pass
+    return {}
+
+
+def save_manifest(path, delivered):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({'dest': "%s:%s" % (DATA_HOST, PUSH_DEST), 'files': delivered}, f, indent=1)
+    os.replace(tmp, path)
+
+
+def batches(files, n):
+    """
+    Split files into n batches of similar total size
+    """
+    result = [[] for i in range(n)]
+    sizes = [0] * n
+    for directory, name in sorted(files, key=lambda f: -os.path.getsize(os.path.join(*f))):
+        i = sizes.index(min(sizes))
+        result[i].append((directory, name))
+        sizes[i] += os.path.getsize(os.path.join(directory, name))
+    return [b for b in result if b]
+
+
+def send(batch, receiver):
+    """
+    Send a batch of files as one tar stream
+    :param batch: A list of (directory, file name)
+    :param receiver: The command that unpacks the stream at the destination
+    :return: The batch if it was delivered, otherwise None
+    """
+    cmd = ["tar", "-cf", "-"]
+    for directory, name in batch:
+        cmd += ["-C", directory, name]
+
+    tar = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    unpack = subprocess.Popen(receiver, stdin=tar.stdout)
+    tar.stdout.close()
+    unpack.wait()
+    tar.wait()
+
+    if tar.returncode != 0 or unpack.returncode != 0:
+        logging.error("Failed to send %d files (tar %d, receiver %d)" % (len(batch), tar.returncode,
+                                                                        unpack.returncode))
+        return None
+    logging.debug("Sent %d files" % len(batch))
+    return batch
+
+
+def run():
+    metrics = TaskMetrics("data_push")
+    files = find_files()
+    manifest_file = os.path.join(MODEL_OUTPUT_DIR, MANIFEST)
+    delivered = load_manifest(manifest_file)
+
+    # taken before sending, so a file that changes during the push is sent again next time
+    keys = dict((f[1], file_key(*f)) for f in files)
+    pending = [f for f in files if delivered.get(f[1]) != keys[f[1]]]
+    logging.info("%d of %d files to push to %s:%s" % (len(pending), len(files), DATA_HOST, PUSH_DEST))
+    if not pending:
+        metrics.write()
+        return
+
+    unpack = "mkdir -p %s && tar -C %s -xf -" % (shlex.quote(PUSH_DEST), shlex.quote(PUSH_DEST))
+    control_dir = None
+    if DATA_HOST:
+        # one master connection, which every tar stream is multiplexed over
+        control_dir = tempfile.mkdtemp(prefix="push")
+        ssh = ["ssh"] + SSH_OPTIONS + ["-o", "ControlPath=%s/cm" % control_dir]
+        subprocess.check_call(ssh + ["-o", "ControlMaster=yes", "-o", "ControlPersist=yes", "-N", "-f", DATA_HOST])
+        receiver = ssh + [DATA_HOST, unpack]
+    else:
+        receiver = ["sh", "-c", unpack]
+
+    failed = 0
+    try:
+        with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+            for batch in executor.map(send, batches(pending, WORKERS), [receiver] * WORKERS):
+                if batch is None:
+                    failed += 1
+                    continue
+                for f in batch:
+                    delivered[f[1]] = keys[f[1]]
+                save_manifest(manifest_file, delivered)
+    finally:
+        if control_dir:
+            subprocess.call(ssh + ["-O", "exit", DATA_HOST], stderr=subprocess.DEVNULL)
+            shutil.rmtree(control_dir, ignore_errors=True)
+
+    sent = [f for f in pending if delivered.get(f[1]) == keys[f[1]]]
+    metrics.update({'files_pushed': len(sent), 'bytes_pushed': sum(keys[f[1]][0] for f in sent),
+                    'batches_failed': failed})
+    metrics.write("error" if failed else "ok")
+
+    if failed:
+        logging.error("%d batches failed, rerun to send the remaining files" % failed)
+        exit(1)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,181 @@
+###################################################
+#
+# Download cache shared by every puller on a host.
+# Files are stored by a hash of their URL and
+# server version (Last-Modified, or the listing
+# time and size), and linked into each task's
+# input directory, so a file needed by several
+# cycles or domains is fetched once. Fetches of the
+# same file are serialized between processes with
+# a lock per entry. When the cache is over its byte
+# budget the least recently used entries are
+# removed.
+#
+# Configured from the environment:
+#
+#   DOWNLOAD_CACHE_DIR     : the cache directory. No caching if not set
+#   DOWNLOAD_CACHE_MAX_GB  : the byte budget in GB (default 50)
+#
+###################################################
+
+import os
+import time
+import fcntl
+import errno
+import shutil
+import hashlib
+import threading
+import logging as log
+
+# ioctl cloning a file on filesystems with reflinks (btrfs, XFS)
+FICLONE = 0x40049409
+EVICT_LOCK = ".evict.lock"
+
+
+def clone(src, dst):
+    """
+    Copy src to dst, sharing the data blocks if the filesystem supports reflinks
+    """
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            shutil.copyfileobj(s, d, 1 << 20)
+    shutil.copystat(src, dst)
+
+
+def link(src, dst):
+    """
+    Make dst a hard link to src, replacing dst. Falls back to a reflink or a copy where src
+    cannot be hard linked, e.g. on another filesystem.
+    """
+    tmp = "%s.%d.%d.tmp" % (dst, os.getpid(), threading.get_ident())
+    try:
+        os.link(src, tmp)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+        clone(src, tmp)
+    os.replace(tmp, dst)
+
+
+class DownloadCache(object):
+    """
+    Content cache of downloaded files keyed by URL and server version
+    """
+
+    def __init__(self, cache_dir, max_bytes=None):
+        """
+        :param cache_dir: The cache directory. It should be on the same filesystem as the
+            directories files are linked into
+        :param max_bytes: The byte budget, or None for no limit
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.bytes_saved = 0
+
+    def path(self, url, version):
+        key = hashlib.sha256(("%s\n%s" % (url, version)).encode()).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, path, output):
+        """
+        Link a cached file to output
+        :return: True if the file was in the cache
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        link(path, output)
+        # the access time orders entries for eviction
+        os.utime(path, ns=(time.time_ns(), st.st_mtime_ns))
+        with self.lock:
+            self.hits += 1
+            self.bytes_saved += st.st_size
+        log.debug("Linked '%s' from the download cache" % output)
+        return True
+
+    def fetch(self, url, version, output, download):
+        """
+        Get a file from the cache, or download it and add it to the cache. Other processes
+        fetching the same file wait for the download and then link it from the cache.
+        :param url: The URL of the file
+        :param version: The server version of the file, e.g. its Last-Modified time. Files
+            without a version are downloaded and not cached
+        :param output: The path the file is wanted at
+        :param download: Function of the output path that downloads the file there
+        :return: A tuple of (True if the file came from the cache, the result of download or None)
+        """
+        if not version:
+            return False, download(output)
+
+        path = self.path(url, version)
+        if self.get(path, output):
+            return True, None
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self.get(path, output):
+                return True, None
+            result = download(output)
+            if os.path.isfile(output):
+                # read only, as the cache and the task directories may share the file
+                os.chmod(output, 0o444)
+                link(output, path)
+
+        self.evict()
+        return False, result
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache is within its budget.
+        Skipped while another process is evicting.
+        """
+        if not self.max_bytes:
+            return
+
+        with open(os.path.join(self.cache_dir, EVICT_LOCK), "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return
+
+            entries = []
+            for d in os.scandir(self.cache_dir):
+                if not d.is_dir(follow_symlinks=False):
+                    continue
+                for e in os.scandir(d.path):
+                    if e.name.endswith((".lock", ".tmp")):
+                        continue
+                    try:
+                        st = e.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    entries.append((st.st_atime, st.st_size, e.path))
+
+            total = sum(e[1] for e in entries)
+            for atime, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                log.debug("Evicting '%s' from the download cache" % path)
+                for p in (path, path + ".lock"):
+                    try:
+                        os.remove(p)
+                    except OSError:
+                        pass
+                total -= size
+
+
+def from_environment():
+    """
+    :return: The DownloadCache configured by DOWNLOAD_CACHE_DIR and DOWNLOAD_CACHE_MAX_GB, or None
+    """
+    cache_dir = os.environ.get('DOWNLOAD_CACHE_DIR')
+    if not cache_dir:
+        return None
+    max_bytes = int(float(os.environ.get('DOWNLOAD_CACHE_MAX_GB', 50)) * 1e9)
+    return DownloadCache(cache_dir, max_bytes)
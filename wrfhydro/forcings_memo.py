@@ -0,0 +1,197 @@
+###################################################
+#
+# Reuse of Forcing Engine output between runs with
+# the same inputs. A run is fingerprinted by its
+# rendered config, less the processing window and
+# directories, and by the name, size and mtime of
+# every input file. Each forecast cycle directory a
+# run writes is kept under its fingerprint. A later
+# run with the same fingerprint links the cycles
+# already made into its output directory, and only
+# runs the Forcing Engine from the first missing
+# cycle on, or not at all.
+#
+# Which cycles a window yields is learned from the
+# last run over a whole window, so nothing is
+# reused before the first complete run.
+#
+# Usage, from wrfhydro_forcings.ecf:
+#
+#   python forcings_memo.py plan   links what can be reused, narrows the
+#                                  window in FORCING_CONFIG if needed and
+#                                  prints 'skip' or 'run'
+#   python forcings_memo.py save   keeps the cycles the run wrote
+#
+# Script configuration is pulled from the environment:
+#
+#   FORCING_CONFIG      : the rendered Forcing Engine config
+#   FORCING_INPUT_DIR   : the Forcing Engine input directory
+#   FORCING_OUTPUT_DIR  : the Forcing Engine output directory
+#   FORCING_BEGIN_DATE  : the start of the window, YYYYMMDDHHMM
+#   FORCING_END_DATE    : the end of the window, YYYYMMDDHHMM
+#   FORCING_MEMO_DIR    : where output is kept by fingerprint
+#
+###################################################
+
+import os
+import re
+import sys
+import json
+import hashlib
+import logging
+from datetime import datetime, timedelta
+
+logging.basicConfig(format="%(levelname)s, %(asctime)s %(message)s", level=logging.DEBUG,
+                    stream=sys.stderr)
+
+CYCLE_FORMAT = "%Y%m%d%H"
+DATE_FORMAT = "%Y%m%d%H%M"
+# config keys that change with every window or only name directories
+WINDOW_KEYS = ["BDateProc", "EDateProc", "RefcstBDateProc", "RefcstEDateProc", "OutDir", "ScratchDir"]
+# keys holding the start of the window
+BEGIN_KEYS = ["BDateProc", "RefcstBDateProc"]
+KEY_PATTERN = re.compile(r"^\s*(\w+)\s*=")
+PLAN_FILE = ".memo_plan.json"
+CYCLES_FILE = "cycles.json"
+
+CONFIG = os.environ['FORCING_CONFIG']
+INPUT_DIR = os.environ['FORCING_INPUT_DIR']
+OUTPUT_DIR = os.environ['FORCING_OUTPUT_DIR']
+BEGIN = datetime.strptime(os.environ['FORCING_BEGIN_DATE'], DATE_FORMAT)
+END = datetime.strptime(os.environ['FORCING_END_DATE'], DATE_FORMAT)
+MEMO_DIR = os.environ['FORCING_MEMO_DIR']
+
+
+def fingerprint():
+    """
+    :return: The sha256 of the config without its window, and of the input file listing
+    """
+    h = hashlib.sha256()
+    with open(CONFIG) as f:
+        for line in f:
+            match = KEY_PATTERN.match(line)
+            if not match or match.group(1) not in WINDOW_KEYS:
+                h.update(line.encode())
+
+    inputs = []
+    for root, dirs, files in os.walk(INPUT_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            inputs.append("%s %d %d" % (os.path.relpath(path, INPUT_DIR), st.st_size, st.st_mtime_ns))
+    for entry in sorted(inputs):
+        h.update(entry.encode() + b"\n")
+    return h.hexdigest()
+
+
+def link_tree(src, dst):
+    """
+    Hard link the files of directory src into directory dst, replacing files of the same name
+    """
+    os.makedirs(dst, exist_ok=True)
+    for entry in os.scandir(src):
+        if not entry.is_file():
+            continue
+        target = os.path.join(dst, entry.name)
+        try:
+            if os.path.samefile(entry.path, target):
+                continue
+        except OSError:
+            pass
+        tmp = "%s.%d.tmp" % (target, os.getpid())
+        os.link(entry.path, tmp)
+        os.replace(tmp, target)
+
+
+def window_cycles():
+    """
+    :return: The forecast cycles the window yields, as datetimes, or None if not known yet
+    """
+    try:
+        with open(os.path.join(MEMO_DIR, CYCLES_FILE)) as f:
+            offsets = json.load(f)['offsets']
+    except (IOError, ValueError, KeyError):
+        return None
+    return [BEGIN + timedelta(minutes=m) for m in offsets]
+
+
+def set_begin(begin):
+    """
+    Move the start of the window in the config
+    """
+    with open(CONFIG) as f:
+        lines = f.readlines()
+    with open(CONFIG, "w") as f:
+        for line in lines:
+            match = KEY_PATTERN.match(line)
+            if match and match.group(1) in BEGIN_KEYS:
+                line = "%s = %s\n" % (match.group(1), begin.strftime(DATE_FORMAT))
+            f.write(line)
+
+
+def plan():
+    fp = fingerprint()
+    memo = os.path.join(MEMO_DIR, fp)
+    cycles = window_cycles()
+    first_missing = BEGIN
+
+    if cycles:
+        missing = [c for c in cycles if not os.path.isdir(os.path.join(memo, c.strftime(CYCLE_FORMAT)))]
+        for c in cycles:
+            if c not in missing:
+                link_tree(os.path.join(memo, c.strftime(CYCLE_FORMAT)), os.path.join(OUTPUT_DIR, c.strftime(CYCLE_FORMAT)))
+        logging.info("%d of %d forecast cycles reused for inputs %s" % (len(cycles) - len(missing), len(cycles), fp[:12]))
+        if not missing:
+            return "skip"
+        first_missing = min(missing)
+        if first_missing > BEGIN:
+            logging.info("Running the Forcing Engine from %s" % first_missing.strftime(DATE_FORMAT))
+            set_begin(first_missing)
+
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    with open(os.path.join(OUTPUT_DIR, PLAN_FILE), "w") as f:
+        json.dump({'fingerprint': fp, 'begin': BEGIN.strftime(DATE_FORMAT),
+                   'whole_window': first_missing == BEGIN}, f)
+    return "run"
+
+
+def save():
+    with open(os.path.join(OUTPUT_DIR, PLAN_FILE)) as f:
+        run = json.load(f)
+    memo = os.path.join(MEMO_DIR, run['fingerprint'])
+
+    offsets = []
+    for entry in os.scandir(OUTPUT_DIR):
+        try:
+            cycle = datetime.strptime(entry.name, CYCLE_FORMAT)
+        except ValueError:
+            continue
+        if not BEGIN <= cycle <= END or not entry.is_dir() or not os.listdir(entry.path):
+            continue
+        offsets.append(int((cycle - BEGIN).total_seconds() // 60))
+
+        # completed under a temporary name, so a kept cycle is always whole
+        kept = os.path.join(memo, entry.name)
+        if os.path.isdir(kept):
+            continue
+        tmp = "%s.%d.tmp" % (kept, os.getpid())
+        link_tree(entry.path, tmp)
+        os.rename(tmp, kept)
+
+    if run['whole_window'] and offsets:
+        tmp = os.path.join(MEMO_DIR, "%s.%d.tmp" % (CYCLES_FILE, os.getpid()))
+        with open(tmp, "w") as f:
+            json.dump({'offsets': sorted(offsets)}, f)
+        os.replace(tmp, os.path.join(MEMO_DIR, CYCLES_FILE))
+    os.remove(os.path.join(OUTPUT_DIR, PLAN_FILE))
+    logging.info("Kept %d forecast cycles for inputs %s" % (len(offsets), run['fingerprint'][:12]))
+
+
+if __name__ == "__main__":
+    if sys.argv[1] == "plan":
+        print(plan())
+    elif sys.argv[1] == "save":
+        save()
@@ -1,6 +1,7 @@
 import os, sys
 from datetime import datetime, timedelta
-import re
+
+from restart_catalog import RestartCatalog
 
 # get environment vars and command-line args
 
@@ -9,7 +10,7 @@ JOBDIR = os.environ['WRFHYDRO_JOBDIR']
 CYCLE = os.environ['WRFHYDRO_CYCLE']
 DOMAIN = os.environ['WRFHYDRO_DOMAIN']
 
-type = sys.argv[1] # hydro hrldas
+type = sys.argv[1] # hydro hrldas, or 'all' for both (hrldas first)
 cycle_date = sys.argv[2] # 20211105
 cycle_time = sys.argv[3] # 0000
 restart_cycle = sys.argv[4] if len(sys.argv) == 5 else CYCLE
@@ -20,34 +21,15 @@ indir = "%s/%s/wrfhydro" % (JOBDIR, restart_cycle)
 
 default_restart_dir = "%s/wrfhydro/%s/restarts" % (ECF_HOME, DOMAIN)
 
-if type == "hydro":
-    default = "%s/HYDRO_RESTART.default" % default_restart_dir
-    pattern = "HYDRO_RST.%Y-%m-%d_%H:%M_DOMAIN"
-    regex = "^(HYDRO_RST.\d+\-\d+\-\d+_\d+:\d+_DOMAIN)"
-elif type == "hrldas":
-    default = "%s/HRLDAS_RESTART.default" % default_restart_dir
-    pattern = "RESTART.%Y%m%d%H_DOMAIN"
-    regex = "^(RESTART\.\d+_DOMAIN)"
-
-bestfile = None
-besttime = None
-for file in os.listdir(indir):
-    match = re.search(regex, file)
-    if not match:
-        continue
-    try:
-        filetime = datetime.strptime(match.groups()[0], pattern)
-    except:
-        continue
-    if filetime > tm:
-        continue
-
-    if besttime is None or besttime < filetime:
-        besttime = filetime
-        bestfile = file
-
-
-if bestfile is None:
-    print(default)
-else:
-    print("%s/%s" % (indir, bestfile))
+defaults = {
+    "hydro": "%s/HYDRO_RESTART.default" % default_restart_dir,
+    "hrldas": "%s/HRLDAS_RESTART.default" % default_restart_dir,
+}
+
+types = ["hrldas", "hydro"] if type == "all" else [type]
+
+catalog = RestartCatalog(indir)
+for t in types:
+    # restarts that are incomplete or do not match the default restart's grid are skipped
+    bestfile = catalog.best(t, tm, reference=defaults[t])
+    print(bestfile if bestfile else defaults[t])
@@ -1,15 +1,15 @@
-import urllib.request
-import urllib.error
-import socket
 import os
 import logging as log
 from datetime import datetime, timedelta
 import traceback
-import time
 import signal
-import re
-import ssl
-import codecs
+
+from nomads import NomadsProduct, NomadsClient, FORCING_ENGINE_FIELDS, rate_limiter
+from metrics import TaskMetrics
+import download_cache
+import progress
+
+log.basicConfig(format="%(levelname)s, %(asctime)s %(message)s", level=log.DEBUG)
 
 ###################################################
 #
@@ -19,32 +19,42 @@ import codecs
 #
 ###################################################
 
-log.basicConfig(format="%(levelname)s, %(asctime)s %(message)s", level=log.DEBUG)
-
-ssl._create_default_https_context = ssl._create_unverified_context
-
-# Global constants. Modify these if the directory listing
-# format changes on the server
-INDEX_FILE_REGEX = "<a href=\"(.+?)\".+?<\/a>\s+([\w|\d|-]+ [\d|:]+)\s+([\w|\d|\-|\.]+)"
-INDEX_FILE_DATE_FORMAT = "%d-%b-%Y %H:%M"
-
-URL = "http://nomads.ncep.noaa.gov/pub/data/nccf/com/cfs/prod/cfs" 
-
-MAX_REQUESTS_PER_MINUTE = 50
-TIMEOUT = 20
-
-# Global variables used by all functions
-download_times = []
-total_num_files = 0
-total_num_requests = 0
-total_timeouts = 0
-total_errors = 0
-app_starttime = datetime.utcnow()
-
-
+def cfs_product(member):
+    """
+    :param member: The CFS ensemble member, 1-4
+    :return: The NomadsProduct of the member's 6 hourly flux files
+    """
+    return NomadsProduct(
+        name="CFS",
+        # CFS_URL points the script at another server, e.g. the benchmark server
+        url=os.environ.get('CFS_URL', "http://nomads.ncep.noaa.gov/pub/data/nccf/com/cfs/prod/cfs"),
+        day_dir_format="cfs.%Y%m%d/",
+        cycle_subdir="6hrly_grib_%02d" % member,
+        file_regex="^flxf(\d+)\.\d\d\.\d+\.grb2$",
+        valid_time=lambda match, cycletime: datetime.strptime(match.groups()[0], "%Y%m%d%H"),
+        output_name=lambda name: name.replace(".grb2", ".grib2"),
+        timeout=20,
+        subset_fields=FORCING_ENGINE_FIELDS,
+        cycle_delay=timedelta(hours=6),
+        complete_delay=timedelta(hours=8),
+        forecast_hours=lambda length: list(range(0, length + 1, 6)))
+
+
+# files of each member are written to the member's 6hrly_grib_NN subdirectory
 OUTDIR = os.environ['FORCING_INPUTDIR']
 DATE = os.environ['FORCING_DATE']
 LENGTH = os.environ['LENGTH_HRS']
+NUM_WORKERS = int(os.environ.get('NOMADS_WORKERS', 4))
+# if true, only download the GRIB messages used by the Forcing Engine
+SUBSET = os.environ.get('NOMADS_SUBSET', 'false') == 'true'
+# past publication times, used to schedule polling
+HISTORY_FILE = os.environ.get('POLL_HISTORY_FILE')
+# cache of directory listings for conditional requests
+INDEX_CACHE_DIR = os.environ.get('NOMADS_INDEX_CACHE')
+# state file of the request limiter shared by all pullers on the host
+RATE_FILE = os.environ.get('NOMADS_RATE_FILE')
+# space separated ensemble members to download
+MEMBERS = [int(m) for m in os.environ.get('CFS_MEMBERS', '1').split()]
 
 
 def exit_on_sigterm(a,b):
@@ -55,245 +65,33 @@ def exit_on_sigterm(a,b):
 signal.signal(signal.SIGTERM, exit_on_sigterm)
 
 
-def throttle():
-    """
-    Sleep until next minute and reset counts if the maximum number of requests
-    has been reached for this minite
-    :return:
-    """
-    global download_times
-
-    now = datetime.now()
-
-    # purge times longer than a minute ago from our request times list
-    while len(download_times) > 0 and (now-download_times[0]).total_seconds() >= 60:
-        download_times.remove(download_times[0])
-
-    # if the number of requests left in the list exceeds our threshold, sleep a bit
-    if len(download_times) > MAX_REQUESTS_PER_MINUTE:
-        sleep_secs = int(60 - (now - download_times[0]).total_seconds())
-        if sleep_secs <= 0:
-            sleep_secs = 1
-        log.debug("Throttle activated after %d requests since %s. Sleeping %s seconds." %
-              (len(download_times) - 1, download_times[0].strftime("%Y-%m-%d %H:%M:%S"), sleep_secs))
-
-        time.sleep(sleep_secs)
-        throttle()
-
-
-def increment_request_count():
-    """
-    Increment global request counters
-    :return:
-    """
-    global total_num_requests, download_times
-
-    total_num_requests += 1
-    download_times.append(datetime.now())
-
-
-def get_file(url, output, size):
-    """
-    Retrieve a file from the server and preserve server file modification times
-    :param url: The URL of the file on the server
-    :param output: The path of the file to write locally
-    :param size: The expected size of the file in bytes, for logging
-    :return: True on success, false on error
-    """
-    global total_num_files, total_timeouts, total_errors
-
-    throttle()  # wait to make request if we need to slow down
-    log.debug("Downloading file '%s' of size %d bytes to '%s'" % (url, size, output))
-
-    try:
-        increment_request_count()
-        start = datetime.now()
-        ret = urllib.request.urlretrieve(url, output)
-
-        log.debug("Download took %d seconds" % (datetime.now() - start).total_seconds())
-
-        # set file times locally
-        access_time = datetime.strptime(ret[1]['Date'], "%a, %d %b %Y %H:%M:%S %Z").strftime("%s")
-        modified_time = datetime.strptime(ret[1]['Last-Modified'], "%a, %d %b %Y %H:%M:%S %Z").strftime("%s")
-        os.utime(output, (int(access_time), int(modified_time)))
-
-        total_num_files += 1
-
-        return True
-
-    except Exception as e:
-        log.error("Error downloading file '%s': %s" % (url,e))
-        return False
-
-
 def log_and_exit(msg, e):
     log.error("%s: %s" % (msg, e))
     log.error("Done, with errors")
     exit(1)
 
 
-def read_index(url):
-    """
-    Download and parse the HTML index file into a list of files and directories. This may need to be
-    modified if the listing format changes on the server.
-    :param url: The URL of the directory we want to list
-    :return: A list of dicts representing each file or directory name, file size, and modification time
-    """
-    global total_timeouts, total_errors
-
-    # make sure we slow down if needed, even for directory listings which are still considered
-    # a request
-    throttle()
-
-    log.debug("Getting index of %s" % url)
-
-    try:
-        # get the HTML. Assumes UTF-8 format
-        increment_request_count()
-        htmldata = urllib.request.urlopen(url, timeout=TIMEOUT).read()
-        if type(htmldata) is not str:
-            lines = codecs.decode(htmldata, 'utf-8', errors='ignore')
-        else:
-            lines = htmldata
-
-        lines = lines.split("\n")
-
-        files = []
-        # parse each line
-        for l in lines:
-            m = re.search(INDEX_FILE_REGEX, l)
-            if not m:
-                continue
-
-            m = m.groups()
-            name = m[0]
-            # convert file modified string into a Date object
-            modified = datetime.strptime(m[1], INDEX_FILE_DATE_FORMAT)
-
-            # convert file size given in kilobytes (K), megabytes (M), or gigabytes (G)
-            # into number of bytes
-            size = m[2]
-            mult = size[-1]
-            if mult == "K":
-                mult = 1024
-            elif mult == "M":
-                mult = 1024 * 1024
-            elif mult == "G":
-                mult = 1024 * 1024 * 1024
-            else:
-                mult = None
-
-            if mult:
-                size = int(float(size[:-1]) * mult)
-            else:
-                try:
-                    size = int(size)
-                except:
-                    size = 0
-
-            files.append({'name': name, 'modified': modified, 'size': size})
-
-        return files
-
-    except Exception as e:
-        log.error("Error reading index of '%s': %s" % (url, e))
-        return False
-
-
-def get_data(url):
-    got_all = False
-    cycletime = datetime.strptime(DATE, "%Y%m%d%H")
-
-    files = read_index(url)
-    if not files:
-        return False
-
-    for f in files:
-        match = re.search("^flxf(\d+)\.\d\d\.\d+\.grb2$", f['name'])
-        if not match:
-            continue
-
-        dt = datetime.strptime(match.groups()[0],"%Y%m%d%H")
-        if dt > cycletime + timedelta(hours=int(LENGTH)):
-            continue
-        
-        outfile = "%s/%s" % (OUTDIR, f['name'].replace(".grb2",".grib2"))
-        if os.path.isfile(outfile):
-            continue
-
-        success = get_file("%s/%s" % (url, f['name']), outfile, f['size'])    
-
-        if not success:
-            got_all = False
-            continue
-
-        if dt == cycletime + timedelta(hours=int(LENGTH)):
-            got_all = True
-
-    return got_all
-
-
-def run():
-    log.debug("Looking for files for time %s" % DATE )
-    tm = DATE[0:8]
-    hr = DATE[-2:]
-
-    got_all_files = False
-    # loop until our data becomes available
-    while True:
-        dirs = read_index(URL)
-        daydir = None
-        
-        if dirs:
-            log.debug("Looking for files for %s" % DATE)
-            for d in dirs:
-                try:
-                    dt = datetime.strptime(d['name'], "cfs.%Y%m%d/")
-                except:
-                    continue
-                
-                if dt.strftime("%Y%m%d") != tm:
-                    continue
-                daydir = d['name']
-                break
-
-        if not daydir:
-            log.debug("Files not found. Sleeping 5 minutes")
-            time.sleep(300)
-            continue
-
-        # found the day directory, now find the cycle directory
-        dirs = read_index("%s/%s" % (URL, daydir))
-        hourdir = None
-        
-        if dirs:
-            for d in dirs:
-                d = d['name'].replace("/","")
-                if d == hr:
-                    hourdir = d
-                    break
-
-        if not hourdir:
-            log.debug("Files not found. Sleeping 5 minutes")
-            time.sleep(300)
-            continue
-
-        dir = "%s/%s/%s/6hrly_grib_01" % (URL, daydir, hourdir)
-        success = get_data(dir)
-
-        if success:
-            log.debug("Downloaded all files. Exiting")
-            return True    
-
-        log.debug("Waiting for more files")
-        time.sleep(300)
-
-
 if __name__ == "__main__":
+    metrics = TaskMetrics("data_pull", labels={'source': "CFS"})
+    # the members are pulled one after another, sharing one request budget
+    bucket = rate_limiter(RATE_FILE)
+    cache = download_cache.from_environment()
+    clients = []
+    success = False
     try:
-        success = run()
-        if not success:
-            exit(1)
+        for member in MEMBERS:
+            product = cfs_product(member)
+            outdir = os.path.join(OUTDIR, product.cycle_subdir)
+            os.makedirs(outdir, exist_ok=True)
+            clients.append(NomadsClient(product, outdir, DATE, LENGTH, workers=NUM_WORKERS, subset=SUBSET,
+                                        history_file=HISTORY_FILE, index_cache_dir=INDEX_CACHE_DIR,
+                                        bucket=bucket, cache=cache,
+                                        # each member has a meter of its own
+                                        meter=progress.from_environment(member if len(MEMBERS) > 1 else None)))
+            if not clients[-1].run():
+                exit(1)
+
+        success = True
 
         exit(0)
     except KeyboardInterrupt:
@@ -303,3 +101,8 @@ if __name__ == "__main__":
         ex = "%s\n%s" % (e, traceback.format_exc())
         log.error("Uncaught exception: %s" % ex)
         log_and_exit("An error occurred", ex)
+    finally:
+        for client in clients:
+            for name, value in client.metrics().items():
+                metrics.add(name, value)
+        metrics.write("ok" if success else "error")
@@ -1,11 +1,16 @@
 import os
 import subprocess
-from urllib import request
 from datetime import datetime, timedelta
 import time
 import signal
 import logging
 
+from httpclient import ConnectionPool, parallel_download
+from polling import Poller, PublicationHistory
+from metrics import TaskMetrics
+import download_cache
+import wrf_extract
+
 logging.basicConfig(format="%(levelname)s, %(asctime)s %(message)s", level=logging.DEBUG)
 
 ###########################
@@ -22,11 +27,23 @@ logging.basicConfig(format="%(levelname)s, %(asctime)s %(message)s", level=loggi
 #
 ###########################
 
-INURL = "http://www.betravedur.is/lv_island_2km"
+# WRF_URL points the script at another server, e.g. the benchmark server
+INURL = os.environ.get('WRF_URL', "http://www.betravedur.is/lv_island_2km")
 INFILE = "v3.9.1_wrfout_d02_%Y-%m-%d_%H_island.nc"
+TIMEOUT = 60
+# typical time after the cycle at which the file is published, used for
+# polling until there is publication history
+PUBLISH_DELAY = timedelta(hours=5)
 
 OUTDIR = os.environ['FORCING_INPUTDIR']
 SCRATCHDIR = os.environ['FORCING_SCRATCHDIR']
+HISTORY_FILE = os.environ.get('POLL_HISTORY_FILE')
+# number of processes used to split the WRF file into hourly files
+EXTRACT_WORKERS = int(os.environ.get('WRF_EXTRACT_WORKERS', 1))
+# if true, extracted files only keep the variables the Forcing Engine reads
+SUBSET_VARS = os.environ.get('WRF_SUBSET_VARS', 'false') == 'true'
+# number of concurrent connections used to download the WRF file
+CONNECTIONS = int(os.environ.get('WRF_DOWNLOAD_CONNECTIONS', 1))
 LENGTH = 12 
 
 # look for closest 6hr file from the *last* model run
@@ -34,6 +51,11 @@ DATE = datetime.strptime(os.environ['FORCING_DATE'], "%Y%m%d%H") - timedelta(hou
 while DATE.hour not in [0,6,12,18]:
     DATE -= timedelta(hours=1)
 
+pool = ConnectionPool(timeout=TIMEOUT, maxsize=max(8, CONNECTIONS))
+metrics = TaskMetrics("data_pull", labels={'source': "WRF"})
+# the analysis and shortrange pullers fetch the same files, see download_cache.py
+cache = download_cache.from_environment()
+
 def exit_on_sigterm(a,b):
     logging.info("SIGTERM received. Exiting")
     exit(1)
@@ -42,10 +64,15 @@ def exit_on_sigterm(a,b):
 signal.signal(signal.SIGTERM, exit_on_sigterm)
 
 
-def download_file(ftime):
+def download_file(ftime, progress=None):
     """
-    Download the file for the requested time and write to SCRATCHDIR
+    Download the file for the requested time and write to SCRATCHDIR. The file is written
+    to a .part file first and only renamed once complete, so an interrupted download is
+    resumed instead of leaving a truncated file behind. With CONNECTIONS > 1 the file is
+    fetched as concurrent byte ranges. With a download cache, a file another puller has
+    already fetched is linked from the cache instead.
     :param ftime: The requested time as a datetime object
+    :param progress: Optional function called with the partial file path and size as data arrives
     :return: The name of the requested file, or None
     """
     fname = ftime.strftime(INFILE)
@@ -57,44 +84,80 @@ def download_file(ftime):
     if os.path.isfile(output):
         return output
 
-    try:
+    def fetch(out):
         logging.debug("Downloading %s" % url)
-        ret = request.urlretrieve(url, output)
+        metrics.add('requests')
+        start = time.time()
+        transferred = parallel_download(pool, url, out, connections=CONNECTIONS, progress=progress)
+        metrics.add('bytes_downloaded', transferred)
+        metrics.add('download_seconds', round(time.time() - start, 3))
+        metrics.add('files_downloaded')
+
+    try:
+        if not cache:
+            fetch(output)
+            return output
+
+        if cache.fetch(url, last_modified(url), output, fetch)[0]:
+            metrics.add('cache_hits')
+            metrics.add('cache_bytes_saved', os.path.getsize(output))
         return output
-    except:
-        logging.debug("Unable to download %s" % url)
+    except Exception as e:
+        logging.debug("Unable to download %s: %s" % (url, e))
+        metrics.add('errors')
         return None
 
 
+def last_modified(url):
+    """
+    :return: The Last-Modified header of url, the file's version in the download cache
+    """
+    metrics.add('requests')
+    with pool.urlopen(url, method="HEAD") as response:
+        response.read()
+        if response.status != 200:
+            raise IOError("HTTP status %d for '%s'" % (response.status, url))
+        return response.headers.get('Last-Modified')
+
+
 def extract_files(fname):
     """
-    Use NCO to extract times from the provided file. Writes extracted files
+    Extract times from the provided file, opening it only once. Writes extracted files
     to OUTDIR 
     """
-
-    for i in range(0,LENGTH + 1):
-        outfile = "%s/%s_f%02d.nc" % (OUTDIR, os.path.basename(fname)[:-3], i)
-        if os.path.isfile(outfile):
-            continue
-        cmd = "ncks -O -d Time,%s %s %s" % ((i), fname, outfile)
-        os.system(cmd)
+    variables = wrf_extract.FORCING_VARIABLES if SUBSET_VARS else None
+    wrf_extract.extract_files(fname, OUTDIR, LENGTH, variables=variables, workers=EXTRACT_WORKERS)
 
 
 def run():
     logging.debug("Processing files for %s" % DATE.strftime("%Y-%m-%d %H"))
 
+    # hourly files are extracted while the download is still running, where the
+    # file format allows it
+    variables = wrf_extract.FORCING_VARIABLES if SUBSET_VARS else None
+    extractor = wrf_extract.StreamingExtractor("%s/%s" % (SCRATCHDIR, DATE.strftime(INFILE)), OUTDIR, LENGTH,
+                                               variables=variables)
+
+    poller = Poller("WRF", DATE, PublicationHistory(HISTORY_FILE), PUBLISH_DELAY)
     while True:
         logging.debug("Looking for file")
-        fname = download_file(DATE)
+        fname = download_file(DATE, progress=extractor.progress)
         if not fname:
-            logging.debug("Not found. Sleeping 5 minutes")
-            time.sleep(300)
+            metrics.add('poll_wait_seconds', poller.wait())
             continue
+        poller.found()
         break
 
     logging.debug("Extracting files")
+    start = time.time()
     extract_files(fname)
+    metrics.set('extract_seconds', round(time.time() - start, 3))
 
     
 if __name__ == "__main__":
-    run()
+    try:
+        run()
+    except BaseException:
+        metrics.write("error")
+        raise
+    metrics.write()
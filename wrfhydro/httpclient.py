@@ -0,0 +1,510 @@
+###################################################
+#
+# HTTP helpers shared by the data pull scripts:
+# a pool of persistent keep-alive connections and
+# resumable, atomic file downloads, optionally
+# split over several connections.
+#
+###################################################
+
+import http.client
+import json
+import os
+import logging as log
+import re
+import ssl
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit, urljoin
+
+MAX_REDIRECTS = 5
+CHUNK_SIZE = 1024 * 1024
+# files smaller than this are not worth splitting over several connections
+PARALLEL_MIN_SIZE = 64 * 1024 * 1024
+# size of the byte ranges handed out to the connections of a parallel download
+SEGMENT_SIZE = 32 * 1024 * 1024
+
+# server certificates are not verified, matching the original scripts
+SSL_CONTEXT = ssl._create_unverified_context()
+
+
+class PooledResponse(object):
+    """
+    An HTTP response whose connection is handed back to the pool once the
+    body has been read and the response closed.
+    """
+
+    def __init__(self, pool, key, conn, response, url):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.headers = response.msg
+
+    def read(self, amt=None):
+        return self.response.read(amt)
+
+    def close(self):
+        if self.conn is None:
+            return
+
+        # only reuse the connection if the whole body was consumed and the
+        # server is willing to keep it open
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.release(self.key, self.conn)
+            self.conn = None
+        else:
+            self.abandon()
+
+    def abandon(self):
+        """
+        Close the response and its connection without reusing it, e.g. when the body
+        has only been partly read
+        """
+        if self.conn is None:
+            return
+        self.response.close()
+        self.conn.close()
+        self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ConnectionPool(object):
+    """
+    A thread-safe pool of persistent HTTP(S) connections keyed by scheme, host and port
+    """
+
+    def __init__(self, timeout=60, maxsize=8):
+        """
+        :param timeout: Socket timeout in seconds for new connections
+        :param maxsize: Maximum number of idle connections kept per host
+        """
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, key):
+        """
+        Get an idle connection for the host, or open a new one
+        :param key: (scheme, host, port) tuple
+        :return: A tuple of (connection, reused)
+        """
+        with self.lock:
+            conns = self.idle.get(key)
+            if conns:
+                return conns.pop(), True
+
+        return self.connect(key), False
+
+    def connect(self, key):
+        """
+        Open a new connection
+        :param key: (scheme, host, port) tuple
+        :return: An unconnected HTTPConnection or HTTPSConnection
+        """
+        scheme, host, port = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port, timeout=self.timeout, context=SSL_CONTEXT)
+        return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+    def release(self, key, conn):
+        """
+        Return a connection to the pool, closing it if the pool is full
+        """
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.maxsize:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """
+        Close all idle connections
+        """
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+
+    def urlopen(self, url, headers=None, method="GET"):
+        """
+        Make a request over a pooled connection, following redirects
+        :param url: The URL to request
+        :param headers: Optional dict of extra request headers
+        :param method: The HTTP method
+        :return: A PooledResponse. The caller must read the body and close it
+        """
+        for i in range(MAX_REDIRECTS + 1):
+            response = self._request(url, headers, method)
+            if response.status in (301, 302, 303, 307, 308) and response.headers.get('Location'):
+                response.read()
+                response.close()
+                url = urljoin(url, response.headers['Location'])
+                continue
+            return response
+
+        raise http.client.HTTPException("Too many redirects for '%s'" % url)
+
+    def _request(self, url, headers, method):
+        parts = urlsplit(url)
+        default_port = 443 if parts.scheme == "https" else 80
+        key = (parts.scheme, parts.hostname, parts.port or default_port)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        headers = dict(headers or {})
+        headers.setdefault("Connection", "keep-alive")
+
+        conn, reused = self.acquire(key)
+        try:
+            conn.request(method, path, headers=headers)
+            response = conn.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            conn.close()
+            if not reused:
+                raise
+            # the server closed an idle keep-alive connection, retry on a fresh one
+            conn = self.connect(key)
+            try:
+                conn.request(method, path, headers=headers)
+                response = conn.getresponse()
+            except Exception:
+                conn.close()
+                raise
+        except Exception:
+            conn.close()
+            raise
+
+        return PooledResponse(self, key, conn, response, url)
+
+
+def http_time(value):
+    """
+    Convert an HTTP date header (e.g. Last-Modified) to seconds since the epoch
+    """
+    return parsedate_to_datetime(value).timestamp()
+
+
+def content_total(response, offset):
+    """
+    Get the full size of the file on the server from a response
+    :param response: A 200 or 206 response
+    :param offset: The first byte requested
+    :return: The size in bytes, or None if the server did not say
+    """
+    content_range = response.headers.get('Content-Range')
+    if content_range:
+        match = re.search("/(\d+)$", content_range)
+        if match:
+            return int(match.groups()[0])
+
+    length = response.headers.get('Content-Length')
+    if length is not None:
+        return offset + int(length)
+
+    return None
+
+
+def download(pool, url, output, expected_size=None, size_tolerance=0, progress=None):
+    """
+    Download a file to '<output>.part', resuming a previous partial download with an HTTP Range
+    request, and atomically rename it to output once its size has been verified.
+    The server modification time is preserved.
+    :param pool: The ConnectionPool to use
+    :param url: The URL of the file on the server
+    :param output: The path of the file to write locally
+    :param expected_size: Optional size of the file in bytes, e.g. from a directory listing
+    :param size_tolerance: Allowed difference in bytes from expected_size, for listings that
+        round sizes to K, M or G
+    :param progress: Optional function called with the path of the partial file and the number
+        of bytes on disk, each time more data has been written
+    :return: The number of bytes transferred
+    """
+    part = output + ".part"
+    offset = os.path.getsize(part) if os.path.isfile(part) else 0
+
+    if os.path.isfile(part + ".ranges"):
+        # left by parallel_download(): the file is preallocated, so its size says nothing
+        log.debug("Discarding partial parallel download '%s'" % part)
+        os.remove(part + ".ranges")
+        offset = 0
+
+    headers = {}
+    if offset > 0:
+        log.debug("Resuming download of '%s' at byte %d" % (url, offset))
+        headers['Range'] = "bytes=%d-" % offset
+
+    transferred = 0
+    with pool.urlopen(url, headers=headers) as response:
+        if response.status == 416 and offset > 0:
+            # nothing left to send, the partial file may already be complete
+            response.read()
+            total = content_total(response, 0)
+            if total != offset:
+                os.remove(part)
+                raise IOError("Partial file '%s' does not match server size, discarded" % part)
+        elif response.status in (200, 206):
+            if response.status == 200:
+                offset = 0
+            elif not response.headers.get('Content-Range', '').startswith("bytes %d-" % offset):
+                raise IOError("Unexpected Content-Range '%s'" % response.headers.get('Content-Range'))
+
+            total = content_total(response, offset)
+            with open(part, "r+b" if offset > 0 else "wb") as f:
+                f.seek(offset)
+                f.truncate()
+                if progress and offset > 0:
+                    progress(part, offset)
+                while True:
+                    chunk = response.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    transferred += len(chunk)
+                    if progress:
+                        f.flush()
+                        progress(part, offset + transferred)
+        else:
+            response.read()
+            raise http.client.HTTPException("HTTP status %d for '%s'" % (response.status, url))
+
+        response_headers = response.headers
+
+    # a short file is kept so the next attempt can resume it
+    size = os.path.getsize(part)
+    if total is not None and size != total:
+        raise IOError("Downloaded %d of %d bytes of '%s'" % (size, total, url))
+
+    if expected_size and abs(size - expected_size) > size_tolerance:
+        os.remove(part)
+        raise IOError("Size of '%s' is %d bytes, expected %d" % (url, size, expected_size))
+
+    if response_headers.get('Last-Modified'):
+        os.utime(part, (time.time(), http_time(response_headers['Last-Modified'])))
+
+    os.replace(part, output)
+
+    return transferred
+
+
+class RangesNotSupported(Exception):
+    """
+    Raised when the server answers a range request with the whole file
+    """
+    pass
+
+
+class SegmentState(object):
+    """
+    The progress of a parallel download, kept next to the partial file so that an
+    interrupted download can be resumed
+    """
+
+    def __init__(self, path, size, last_modified, segment_size):
+        """
+        :param path: The state file
+        :param size: The size of the file being downloaded
+        :param last_modified: The Last-Modified header of the file, or None
+        :param segment_size: The size of each byte range
+        """
+        self.path = path
+        self.size = size
+        self.last_modified = last_modified
+        self.lock = threading.Lock()
+
+        self.starts = list(range(0, size, segment_size))
+        # each segment is [next byte to fetch, end], in file order
+        self.segments = [[start, min(start + segment_size, size)] for start in self.starts]
+
+        if os.path.isfile(path):
+            try:
+                with open(path) as f:
+                    state = json.load(f)
+                if state['size'] == size and state['last_modified'] == last_modified and \
+                        len(state['segments']) == len(self.segments):
+                    self.segments = state['segments']
+                    log.debug("Resuming parallel download, %d of %d bytes done" % (self.done(), size))
+            except (IOError, ValueError, KeyError) as e:
+                log.debug("Ignoring download state '%s': %s" % (path, e))
+
+    def done(self):
+        """
+        :return: The number of bytes already on disk
+        """
+        return sum(pos - start for (pos, end), start in zip(self.segments, self.starts))
+
+    def contiguous(self):
+        """
+        :return: The number of bytes from the start of the file that are on disk
+        """
+        for pos, end in self.segments:
+            if pos < end:
+                return pos
+        return self.size
+
+    def advance(self, index, pos):
+        """
+        Record that segment 'index' has been written up to pos, and save the state
+        :return: The contiguous size before and after the update
+        """
+        with self.lock:
+            before = self.contiguous()
+            self.segments[index][0] = pos
+            self.save()
+            return before, self.contiguous()
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({'size': self.size, 'last_modified': self.last_modified, 'segments': self.segments}, f)
+        os.replace(tmp, self.path)
+
+
+def fetch_segment(pool, url, fd, state, index, abort, progress, part):
+    """
+    Fetch one byte range of a parallel download and write it at its offset in the file
+    :return: The number of bytes transferred
+    """
+    pos, end = state.segments[index]
+    if pos >= end:
+        return 0
+
+    transferred = 0
+    headers = {'Range': "bytes=%d-%d" % (pos, end - 1)}
+    if state.last_modified:
+        # fail rather than mix two versions of the file
+        headers['If-Range'] = state.last_modified
+
+    with pool.urlopen(url, headers=headers) as response:
+        if response.status == 200:
+            abort.set()
+            raise RangesNotSupported("Server sent the whole of '%s' for a range request" % url)
+        if response.status != 206:
+            response.read()
+            raise http.client.HTTPException("HTTP status %d for range of '%s'" % (response.status, url))
+        if not response.headers.get('Content-Range', '').startswith("bytes %d-" % pos):
+            raise IOError("Unexpected Content-Range '%s'" % response.headers.get('Content-Range'))
+
+        while pos < end and not abort.is_set():
+            chunk = response.read(min(CHUNK_SIZE, end - pos))
+            if not chunk:
+                raise IOError("Connection closed at byte %d of '%s'" % (pos, url))
+            os.pwrite(fd, chunk, pos)
+            pos += len(chunk)
+            transferred += len(chunk)
+
+            before, after = state.advance(index, pos)
+            if progress and after > before:
+                with state.lock:
+                    progress(part, after)
+
+        if abort.is_set():
+            # the connection is not reusable with a partly read body
+            response.abandon()
+
+    return transferred
+
+
+def parallel_download(pool, url, output, connections=4, expected_size=None, size_tolerance=0, progress=None,
+                      min_size=PARALLEL_MIN_SIZE, segment_size=SEGMENT_SIZE):
+    """
+    Download a large file over several connections at once. The file is preallocated and
+    split into byte ranges which are fetched concurrently and written in place at their
+    offsets, so nothing is reassembled afterwards. Progress is kept in '<output>.part.ranges'
+    so an interrupted download resumes where each range stopped. Falls back to a single
+    stream with download() for small files and for servers that do not support ranges.
+    :param pool: The ConnectionPool to use. Its maxsize should be at least connections
+    :param url: The URL of the file on the server
+    :param output: The path of the file to write locally
+    :param connections: The number of concurrent connections
+    :param expected_size: Optional size of the file in bytes
+    :param size_tolerance: Allowed difference in bytes from expected_size
+    :param progress: Optional function called with the path of the partial file and the number
+        of bytes from its start that are on disk, each time that increases
+    :param min_size: Files smaller than this are downloaded with a single stream
+    :param segment_size: The size of each byte range
+    :return: The number of bytes transferred
+    """
+    part = output + ".part"
+    state_file = part + ".ranges"
+
+    if connections <= 1:
+        return download(pool, url, output, expected_size, size_tolerance, progress)
+
+    with pool.urlopen(url, method="HEAD") as response:
+        response.read()
+        status = response.status
+        headers = response.headers
+
+    size = headers.get('Content-Length')
+    if status != 200 or size is None or int(size) < min_size or \
+            headers.get('Accept-Ranges', '').lower() != 'bytes':
+        return download(pool, url, output, expected_size, size_tolerance, progress)
+
+    size = int(size)
+    if expected_size and abs(size - expected_size) > size_tolerance:
+        raise IOError("Size of '%s' is %d bytes, expected %d" % (url, size, expected_size))
+
+    last_modified = headers.get('Last-Modified')
+    state = SegmentState(state_file, size, last_modified, segment_size)
+    if not os.path.isfile(state_file) and os.path.isfile(part):
+        # a single stream partial download, or a stale one
+        os.remove(part)
+
+    log.debug("Downloading '%s' (%d bytes) over %d connections" % (url, size, connections))
+    fd = os.open(part, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except (AttributeError, OSError):
+            # not supported by every file system, the file is extended as it is written
+            os.ftruncate(fd, size)
+        state.save()
+
+        if progress and state.contiguous() > 0:
+            progress(part, state.contiguous())
+
+        abort = threading.Event()
+        pending = [i for i, (pos, end) in enumerate(state.segments) if pos < end]
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            futures = [executor.submit(fetch_segment, pool, url, fd, state, i, abort, progress, part)
+                       for i in pending]
+            transferred = 0
+            error = None
+            for future in futures:
+                try:
+                    transferred += future.result()
+                except Exception as e:
+                    # stop the other connections, the state file keeps what was written
+                    abort.set()
+                    error = error or e
+    finally:
+        os.close(fd)
+
+    if isinstance(error, RangesNotSupported):
+        log.debug("%s, downloading with a single stream" % error)
+        os.remove(state_file)
+        os.remove(part)
+        return download(pool, url, output, expected_size, size_tolerance, progress)
+    if error is not None:
+        raise error
+
+    os.remove(state_file)
+    if last_modified:
+        os.utime(part, (time.time(), http_time(last_modified)))
+    os.replace(part, output)
+
+    return transferred
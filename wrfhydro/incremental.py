@@ -0,0 +1,209 @@
+###################################################
+#
+# Incremental runs of a cycle that restarts from
+# itself, e.g. the hourly analysis with its 3 hour
+# lookback. Each run records the LDASIN content of
+# every hour it simulated, and where that hour's
+# output went. The next run starts from the latest
+# restart whose recorded forcings still match the
+# forcings on disk, instead of re-running hours it
+# would only reproduce, and links the output of
+# the hours it skipped from the earlier cycles.
+# When the forcings of the window have been
+# revised, the whole window is run again.
+#
+# Usage, from wrfhydro_model.ecf:
+#
+#   python incremental.py plan     prints the start date, time and run
+#                                  length in hours to use
+#   python incremental.py record   after the run; records its forcings and
+#                                  links the output of the skipped hours
+#
+# Script configuration is pulled from the environment:
+#
+#   WRF_HYDRO_ROOT  : the run directory, holding the restarts and FORCING
+#   MODEL_START     : the start of the full window, YYYYMMDDHHMM
+#   KHOUR           : the length of the full window in hours
+#   OUTPUT_ROOT     : the cycle's output directory (record only)
+#
+###################################################
+
+import os
+import re
+import sys
+import json
+import hashlib
+import logging
+from datetime import datetime, timedelta
+
+from restart_catalog import RestartCatalog, RESTART_TYPES
+
+logging.basicConfig(format="%(levelname)s, %(asctime)s %(message)s", level=logging.DEBUG,
+                    stream=sys.stderr)
+
+TIME_FORMAT = "%Y%m%d%H%M"
+LDASIN_PATTERN = re.compile(r"^(\d{12})\.LDASIN_DOMAIN\d+$")
+LINEAGE_FILE = "forcing_lineage.json"
+PLAN_FILE = ".incremental_plan.json"
+# hours of lineage kept behind the end of the latest run
+LINEAGE_HOURS = 48
+HASH_BLOCK = 1 << 20
+
+RUN_DIR = os.environ['WRF_HYDRO_ROOT']
+START = datetime.strptime(os.environ['MODEL_START'], TIME_FORMAT)
+END = START + timedelta(hours=int(os.environ['KHOUR']))
+
+
+def sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def hours(begin, end):
+    """
+    :return: The hours from begin to end, both included, formatted with TIME_FORMAT
+    """
+    t = begin
+    while t <= end:
+        yield t.strftime(TIME_FORMAT)
+        t += timedelta(hours=1)
+
+
+def forcings(begin, end):
+    """
+    :return: A dict of the sha256 of each LDASIN file in FORCING valid from begin to end, by valid time
+    """
+    wanted = set(hours(begin, end))
+    found = {}
+    forcing_dir = os.path.join(RUN_DIR, "FORCING")
+    try:
+        names = os.listdir(forcing_dir)
+    except OSError:
+        return found
+    for name in names:
+        match = LDASIN_PATTERN.match(name)
+        if match and match.group(1) in wanted:
+            found[match.group(1)] = sha256(os.path.join(forcing_dir, name))
+    return found
+
+
+def load_lineage():
+    """
+    :return: A dict of {'forcing': sha256 of the LDASIN used, 'output': output directory} by valid time
+        of each hour simulated by the runs behind the restarts in the run directory
+    """
+    try:
+        with open(os.path.join(RUN_DIR, LINEAGE_FILE)) as f:
+            return json.load(f)['hours']
+    except (IOError, ValueError, KeyError):
+        return {}
+
+
+def save_lineage(lineage):
+    oldest = (END - timedelta(hours=LINEAGE_HOURS)).strftime(TIME_FORMAT)
+    lineage = dict((h, v) for h, v in lineage.items() if h >= oldest)
+    path = os.path.join(RUN_DIR, LINEAGE_FILE)
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump({'hours': lineage}, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def has_restarts(catalog, tm):
+    """
+    :return: True if complete restarts of every type valid exactly at tm are in the run directory
+    """
+    for type, (pattern, regex) in RESTART_TYPES.items():
+        best = catalog.best(type, tm)
+        if best is None:
+            return False
+        match = regex.search(os.path.basename(best))
+        if datetime.strptime(match.group(1), pattern) != tm:
+            return False
+    return True
+
+
+def plan():
+    """
+    :return: The time to start the run from, the latest hour of the window whose restarts exist
+        and whose forcings, from the window start on, match those the restarts were made with
+    """
+    lineage = load_lineage()
+    current = forcings(START, END)
+    catalog = RestartCatalog(RUN_DIR)
+
+    start = START
+    t = END - timedelta(hours=1)
+    while t > START:
+        if all(h in current and lineage.get(h, {}).get('forcing') == current[h] for h in hours(START, t)) \
+                and has_restarts(catalog, t):
+            start = t
+            break
+        t -= timedelta(hours=1)
+
+    if start > START:
+        logging.info("Forcings unchanged to %s, running %s to %s" % (start.strftime(TIME_FORMAT),
+                                                                   start.strftime(TIME_FORMAT), END.strftime(TIME_FORMAT)))
+    else:
+        logging.info("Running the whole window %s to %s" % (START.strftime(TIME_FORMAT), END.strftime(TIME_FORMAT)))
+
+    # the restarts after the start are about to be rewritten
+    save_lineage(dict((h, v) for h, v in lineage.items() if h <= start.strftime(TIME_FORMAT)))
+    with open(os.path.join(RUN_DIR, PLAN_FILE), "w") as f:
+        json.dump({'start': start.strftime(TIME_FORMAT)}, f)
+    return start
+
+
+def link_output(src_dir, hour, output_dir):
+    """
+    Hard link the output files of one hour from an earlier cycle's output directory
+    :return: The number of files linked
+    """
+    linked = 0
+    for entry in os.scandir(src_dir):
+        if not entry.name.startswith(hour + ".") or not entry.is_file():
+            continue
+        target = os.path.join(output_dir, entry.name)
+        if os.path.exists(target) and os.path.samefile(entry.path, target):
+            continue
+        tmp = "%s.%d.tmp" % (target, os.getpid())
+        os.link(entry.path, tmp)
+        os.replace(tmp, target)
+        linked += 1
+    return linked
+
+
+def record():
+    output_dir = os.environ['OUTPUT_ROOT']
+    with open(os.path.join(RUN_DIR, PLAN_FILE)) as f:
+        start = datetime.strptime(json.load(f)['start'], TIME_FORMAT)
+    lineage = load_lineage()
+
+    for h in hours(START + timedelta(hours=1), start):
+        src_dir = lineage.get(h, {}).get('output')
+        if not src_dir or not os.path.isdir(src_dir):
+            logging.warning("Output of %s is no longer available" % h)
+            continue
+        logging.debug("Linked %d files of %s from %s" % (link_output(src_dir, h, output_dir), h, src_dir))
+
+    current = forcings(start, END)
+    for h in hours(start, END):
+        entry = lineage.setdefault(h, {})
+        entry['forcing'] = current.get(h)
+        if h > start.strftime(TIME_FORMAT):
+            entry['output'] = output_dir
+
+    save_lineage(lineage)
+    os.remove(os.path.join(RUN_DIR, PLAN_FILE))
+
+
+if __name__ == "__main__":
+    if sys.argv[1] == "plan":
+        start = plan()
+        print("%s %s %d" % (start.strftime("%Y%m%d"), start.strftime("%H%M"),
+                            int((END - start).total_seconds() // 3600)))
+    elif sys.argv[1] == "record":
+        record()
@@ -0,0 +1,222 @@
+###################################################
+#
+# Delete old files of one domain in a single pass.
+# Every retention rule of every cycle is applied
+# during one os.scandir walk of the domain's job
+# directory, and the deletes are then run in
+# parallel. Age is the time since last modification,
+# as with the scrub script this replaces.
+#
+# Script configuration is pulled from the environment:
+#
+#   WRFHYDRO_JOBDIR  : the domain's job directory
+#   JANITOR_CYCLES   : space separated list of cycles to clean
+#   *_RETENTION_DAYS : days to keep each category, -9999 to keep all (see CATEGORIES
+#                      and SHARED_CATEGORIES)
+#   JANITOR_WORKERS  : number of parallel deletes (default 8)
+#   JANITOR_DRY_RUN  : if 'true', only report what would be deleted
+#
+###################################################
+
+import os
+import re
+import time
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import TaskMetrics
+
+logging.basicConfig(format="%(levelname)s, %(asctime)s %(message)s", level=logging.DEBUG)
+
+# retention value meaning that nothing is deleted
+KEEP_ALL = -9999
+
+# (category, subdirectory of the cycle, retention variable, file name regex, remove old directories)
+CATEGORIES = [
+    ("forcing_input", "forcings-input", "FORCING_INPUT_RETENTION_DAYS", None, True),
+    ("forcing_output", "forcings-output", "FORCING_OUTPUT_RETENTION_DAYS", None, True),
+    ("forcing_memo", "forcings-memo", "FORCING_OUTPUT_RETENTION_DAYS", None, True),
+    ("model_output", "model-output", "MODEL_OUTPUT_RETENTION_DAYS", None, True),
+    ("model_restarts", "wrfhydro", "MODEL_RESTARTS_RETENTION_DAYS", "^(HYDRO_RST|RESTART)", False),
+    ("logs", "forcings-scratch", "LOG_RETENTION_DAYS", None, False),
+]
+
+# the same for the caches shared by the cycles, in the job directory itself. Cached
+# parameter tables are touched whenever a run is staged with them, and the cache's
+# index is kept
+SHARED_CATEGORIES = [
+    ("index_cache", "nomads_index_cache", "CACHE_RETENTION_DAYS", None, False),
+    ("param_cache", "param_cache", "CACHE_RETENTION_DAYS", r"^(?!index\.json$)", True),
+]
+# cycle name the shared categories are reported under
+SHARED = "shared"
+
+
+class Rule(object):
+    """
+    A retention rule for the files under one directory
+    """
+
+    def __init__(self, cycle, category, root, days, pattern=None, remove_dirs=False):
+        """
+        :param cycle: The model cycle the directory belongs to
+        :param category: The name of the kind of data, used for reporting
+        :param root: The directory the rule applies to. It is never removed itself
+        :param days: Files last modified more than this many days ago are deleted. May be fractional
+        :param pattern: Optional regex; only names matching it are deleted
+        :param remove_dirs: If true, old directories are removed once empty
+        """
+        self.cycle = cycle
+        self.category = category
+        self.root = root
+        self.max_age = float(days) * 86400
+        self.regex = re.compile(pattern) if pattern else None
+        self.remove_dirs = remove_dirs
+
+
+def walk(rule, path, now, files, dirs, depth=1):
+    """
+    Find the files and directories under path that a rule deletes
+    :param rule: The Rule
+    :param path: The directory to scan
+    :param now: The current time in seconds since the epoch
+    :param files: List to append (rule, path, size) of each file to delete to
+    :param dirs: List to append (rule, path, depth) of each directory to remove to
+    """
+    try:
+        entries = list(os.scandir(path))
+    except OSError as e:
+        logging.warning("Unable to scan %s: %s" % (path, e))
+        return
+
+    for entry in entries:
+        try:
+            st = entry.stat(follow_symlinks=False)
+            is_dir = entry.is_dir(follow_symlinks=False)
+        except OSError:
+            continue
+
+        if is_dir:
+            walk(rule, entry.path, now, files, dirs, depth + 1)
+
+        if rule.regex and not rule.regex.search(entry.name):
+            continue
+        if now - st.st_mtime <= rule.max_age:
+            continue
+
+        if is_dir:
+            if rule.remove_dirs:
+                dirs.append((rule, entry.path, depth))
+        else:
+            files.append((rule, entry.path, st.st_size))
+
+
+def plan(jobdir, cycles, retention, now):
+    """
+    Walk the job directory once and collect everything the retention rules delete
+    :param jobdir: The domain's job directory
+    :param cycles: List of cycle names
+    :param retention: Dict mapping category to days to keep, or KEEP_ALL/None
+    :param now: The current time in seconds since the epoch
+    :return: A tuple of (files, dirs) as filled by walk()
+    """
+    files = []
+    dirs = []
+    for cycle in cycles:
+        for category, subdir, var, pattern, remove_dirs in CATEGORIES:
+            days = retention.get(category)
+            if days is None or float(days) == KEEP_ALL:
+                continue
+            root = os.path.join(jobdir, cycle, subdir)
+            if not os.path.isdir(root):
+                continue
+            walk(Rule(cycle, category, root, days, pattern, remove_dirs), root, now, files, dirs)
+
+    for category, subdir, var, pattern, remove_dirs in SHARED_CATEGORIES:
+        days = retention.get(category)
+        if days is None or float(days) == KEEP_ALL:
+            continue
+        root = os.path.join(jobdir, subdir)
+        if os.path.isdir(root):
+            walk(Rule(SHARED, category, root, days, pattern, remove_dirs), root, now, files, dirs)
+
+    return files, dirs
+
+
+def remove(files, dirs, workers):
+    """
+    Delete files in parallel, then remove directories deepest first. Directories that are
+    not empty are left in place.
+    :return: The number of files that could not be deleted
+    """
+    def unlink(item):
+        try:
+            os.unlink(item[1])
+            return 0
+        except OSError as e:
+            logging.warning("Unable to delete %s: %s" % (item[1], e))
+            return 1
+
+    def rmdir(item):
+        try:
+            os.rmdir(item[1])
+        except OSError:
+            pass
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        failed = sum(executor.map(unlink, files))
+
+        for depth in sorted(set(d[2] for d in dirs), reverse=True):
+            list(executor.map(rmdir, [d for d in dirs if d[2] == depth]))
+
+    return failed
+
+
+def report(files, dirs, dry_run):
+    """
+    Log the number of files and bytes deleted per cycle and category
+    """
+    totals = defaultdict(lambda: [0, 0, 0])
+    for rule, path, size in files:
+        totals[(rule.cycle, rule.category)][0] += 1
+        totals[(rule.cycle, rule.category)][1] += size
+    for rule, path, depth in dirs:
+        totals[(rule.cycle, rule.category)][2] += 1
+
+    verb = "Would delete" if dry_run else "Deleted"
+    for (cycle, category), (nfiles, nbytes, ndirs) in sorted(totals.items()):
+        logging.info("%s %s/%s: %d files, %d directories, %.1f MB" %
+                     (verb, cycle, category, nfiles, ndirs, nbytes / 1e6))
+    logging.info("%s %d files, %.1f MB in total" % (verb, len(files), sum(f[2] for f in files) / 1e6))
+
+
+def run():
+    jobdir = os.environ['WRFHYDRO_JOBDIR']
+    cycles = os.environ['JANITOR_CYCLES'].split()
+    workers = int(os.environ.get('JANITOR_WORKERS', 8))
+    dry_run = os.environ.get('JANITOR_DRY_RUN', 'false') == 'true'
+    retention = dict((category, os.environ.get(var))
+                     for category, subdir, var, pattern, remove_dirs in CATEGORIES + SHARED_CATEGORIES)
+
+    metrics = TaskMetrics("janitor")
+    files, dirs = plan(jobdir, cycles, retention, time.time())
+    metrics.set('scan_seconds', round(time.time() - metrics.start, 3))
+    failed = 0
+    if dry_run:
+        for rule, path, size in files:
+            logging.debug("Would delete %s" % path)
+    else:
+        failed = remove(files, dirs, workers)
+        if failed:
+            logging.warning("%d files could not be deleted" % failed)
+    report(files, dirs, dry_run)
+
+    if not dry_run:
+        metrics.update({'files_deleted': len(files) - failed, 'bytes_deleted': sum(f[2] for f in files),
+                        'delete_errors': failed})
+        metrics.write()
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,145 @@
+###################################################
+#
+# Performance metrics of the workflow tasks. Each
+# task run appends one JSON record to
+# $METRICS_DIR/metrics.jsonl and rewrites a
+# Prometheus textfile per task, domain and cycle,
+# for node_exporter's textfile collector, so the
+# stage that dominates cycle latency can be seen.
+# Nothing is written when METRICS_DIR is not set.
+# metrics.jsonl is renamed to metrics.jsonl.1 once
+# it reaches RECORDS_MAX_BYTES, replacing the older
+# records.
+#
+# From a shell script:
+#
+#   python metrics.py <task> name=value ...
+#
+###################################################
+
+import os
+import sys
+import json
+import time
+import fcntl
+import threading
+import logging as log
+
+METRIC_PREFIX = "wrfhydro_"
+RECORDS_FILE = "metrics.jsonl"
+# size at which the records file is rotated
+RECORDS_MAX_BYTES = 64 * 1024 * 1024
+
+# environment variables recorded as labels of every record
+LABELS = {
+    'domain': 'WRFHYDRO_DOMAIN',
+    'cycle': 'WRFHYDRO_CYCLE',
+    'cycle_time': 'METRICS_CYCLE_TIME',
+}
+
+
+class TaskMetrics(object):
+    """
+    Counters and timings of one task run
+    """
+
+    def __init__(self, task, metrics_dir=None, labels=None):
+        """
+        :param task: The task name, e.g. 'data_pull'
+        :param metrics_dir: Directory to write metrics to. Defaults to $METRICS_DIR
+        :param labels: Optional dict of extra labels. domain, cycle and cycle_time are taken
+            from the environment when set
+        """
+        self.task = task
+        self.metrics_dir = metrics_dir or os.environ.get('METRICS_DIR')
+        self.labels = dict((k, os.environ[v]) for k, v in LABELS.items() if os.environ.get(v))
+        self.labels.update(labels or {})
+        self.start = time.time()
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, value=1):
+        """
+        Add to a counter
+        """
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + value
+
+    def set(self, name, value):
+        with self.lock:
+            self.values[name] = value
+
+    def update(self, values):
+        with self.lock:
+            self.values.update(values)
+
+    def record(self, status):
+        """
+        :return: The JSON record of the run so far
+        """
+        with self.lock:
+            values = dict(self.values)
+        end = time.time()
+        values.setdefault('duration_seconds', round(end - self.start, 3))
+        if values.get('bytes_downloaded') and values.get('download_seconds'):
+            values['throughput_bytes_per_second'] = round(values['bytes_downloaded'] / values['download_seconds'])
+
+        record = {'task': self.task, 'status': status, 'start': round(self.start, 3), 'end': round(end, 3)}
+        record.update(self.labels)
+        record['metrics'] = values
+        return record
+
+    def write(self, status="ok"):
+        """
+        Append the record of the run and rewrite the task's Prometheus textfile.
+        Failures are logged, never raised, so metrics cannot fail a task.
+        :param status: 'ok' or 'error'
+        """
+        if not self.metrics_dir:
+            return
+
+        record = self.record(status)
+        try:
+            os.makedirs(self.metrics_dir, exist_ok=True)
+            path = os.path.join(self.metrics_dir, RECORDS_FILE)
+            with open(path, "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.write(json.dumps(record, sort_keys=True) + "\n")
+                f.flush()
+                # rotated under the lock; a writer waiting on the old file appends to the rotated one
+                if os.fstat(f.fileno()).st_size >= RECORDS_MAX_BYTES:
+                    os.replace(path, path + ".1")
+            self.write_textfile(record)
+        except (IOError, OSError) as e:
+            log.warning("Unable to write metrics to %s: %s" % (self.metrics_dir, e))
+
+    def write_textfile(self, record):
+        # the cycle time is left out, it would make a new series every cycle
+        labels = dict((k, v) for k, v in self.labels.items() if k != 'cycle_time')
+        labels['task'] = self.task
+        label_str = ",".join('%s="%s"' % (k, str(v).replace('"', '')) for k, v in sorted(labels.items()))
+
+        values = dict(record['metrics'], last_run_timestamp_seconds=record['end'],
+                      last_run_success=1 if record['status'] == "ok" else 0)
+        lines = []
+        for name, value in sorted(values.items()):
+            if not isinstance(value, (int, float)):
+                continue
+            lines.append("# TYPE %s%s gauge" % (METRIC_PREFIX, name))
+            lines.append("%s%s{%s} %s" % (METRIC_PREFIX, name, label_str, value))
+
+        # one file per task, domain and cycle, so runs of other cycles are kept
+        name = ".".join([self.task] + [labels[k] for k in ('domain', 'cycle') if k in labels])
+        path = os.path.join(self.metrics_dir, "%s.prom" % name)
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, path)
+
+
+if __name__ == "__main__":
+    metrics = TaskMetrics(sys.argv[1])
+    for arg in sys.argv[2:]:
+        name, value = arg.split("=", 1)
+        metrics.set(name, float(value) if "." in value else int(value))
+    metrics.write()
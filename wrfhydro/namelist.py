@@ -0,0 +1,108 @@
+###################################################
+#
+# Fortran namelist templates. A template is parsed
+# once into its groups and assignments, and can
+# then be rendered any number of times with new
+# values for some keys. Everything else, including
+# comments and layout, is written back unchanged,
+# so rendering the same values always gives the
+# same file.
+#
+###################################################
+
+import re
+
+# a key, optionally with an array index, at the start of a line
+ASSIGNMENT_PATTERN = re.compile(r"^\s*([A-Za-z_]\w*(?:\([\d,\s]*\))?)\s*=")
+GROUP_START_PATTERN = re.compile(r"^\s*&(\w+)")
+
+
+def strip_comment(line):
+    """
+    :return: The line without any trailing '!' comment. '!' inside quoted strings is kept.
+    """
+    quote = None
+    for i, c in enumerate(line):
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in "'\"":
+            quote = c
+        elif c == "!":
+            return line[:i]
+    return line
+
+
+def format_value(value):
+    """
+    Format a Python value as a namelist value. Strings are quoted, booleans become .true./.false.
+    """
+    if isinstance(value, bool):
+        return ".true." if value else ".false."
+    if isinstance(value, str):
+        return '"%s"' % value
+    return str(value)
+
+
+class Namelist(object):
+    """
+    A parsed namelist template
+    """
+
+    def __init__(self, text):
+        """
+        :param text: The template text
+        """
+        self.lines = text.splitlines()
+        # (group, key) to line number of each assignment, keys in upper case
+        self.assignments = {}
+        # group to line number of its closing '/'
+        self.group_ends = {}
+
+        group = None
+        for i, line in enumerate(self.lines):
+            code = strip_comment(line).strip()
+            if group is None:
+                match = GROUP_START_PATTERN.match(code)
+                if match:
+                    group = match.group(1).upper()
+                continue
+            if code == "/":
+                self.group_ends[group] = i
+                group = None
+                continue
+            match = ASSIGNMENT_PATTERN.match(code)
+            if match:
+                key = re.sub(r"\s", "", match.group(1)).upper()
+                self.assignments[(group, key)] = i
+
+    @classmethod
+    def read(cls, path):
+        with open(path) as f:
+            return cls(f.read())
+
+    def render(self, settings):
+        """
+        Render the template with new values
+        :param settings: A dict mapping group name to a dict of key to value. Values are
+            formatted with format_value. Keys not in the template are added at the end of
+            their group.
+        :return: The rendered text
+        """
+        lines = list(self.lines)
+        added = {}
+        for group, values in settings.items():
+            for key, value in values.items():
+                line = "%s = %s" % (key, format_value(value))
+                i = self.assignments.get((group.upper(), key.upper()))
+                if i is not None:
+                    lines[i] = line
+                elif group.upper() in self.group_ends:
+                    added.setdefault(self.group_ends[group.upper()], []).append(line)
+                else:
+                    raise KeyError("Namelist group '%s' not found" % group)
+
+        # insert from the bottom so earlier line numbers stay valid
+        for i in sorted(added, reverse=True):
+            lines[i:i] = added[i]
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,265 @@
+###################################################
+#
+# Minimal reader/writer for the header of netCDF
+# classic (CDF-1) and 64-bit offset (CDF-2) files.
+# Gives the byte layout of every variable so records
+# can be located and copied without a netCDF library,
+# e.g. while the file is still being downloaded.
+#
+###################################################
+
+import struct
+
+NC_DIMENSION = 0x0A
+NC_VARIABLE = 0x0B
+NC_ATTRIBUTE = 0x0C
+STREAMING = 0xFFFFFFFF
+
+# sizes in bytes of the classic external types
+TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 4, 6: 8}
+
+HDF5_SIGNATURE = b"\x89HDF\r\n\x1a\n"
+
+
+class NeedMoreData(Exception):
+    """
+    Raised when the buffer ends before the header does
+    """
+    pass
+
+
+class NotClassicFormat(Exception):
+    """
+    Raised when the file is not a CDF-1 or CDF-2 netCDF file (e.g. netCDF-4/HDF5)
+    """
+    pass
+
+
+def pad4(n):
+    return (n + 3) & ~3
+
+
+class Variable(object):
+    """
+    A variable entry of the header. Attributes are kept as raw bytes.
+    """
+
+    def __init__(self, name, dimids, atts, nc_type, vsize, begin):
+        self.name = name
+        self.dimids = dimids
+        self.atts = atts
+        self.nc_type = nc_type
+        self.vsize = vsize
+        self.begin = begin
+        self.is_record = False
+
+
+class Header(object):
+    """
+    The parsed header of a classic netCDF file
+    """
+
+    def __init__(self, version, numrecs, dims, gatts, variables, size):
+        """
+        :param version: 1 (classic) or 2 (64-bit offset)
+        :param numrecs: The number of records, or STREAMING
+        :param dims: A list of (name, length) tuples, length 0 marking the record dimension
+        :param gatts: The raw bytes of the global attribute list
+        :param variables: A list of Variables
+        :param size: The size of the header in bytes
+        """
+        self.version = version
+        self.numrecs = numrecs
+        self.dims = dims
+        self.gatts = gatts
+        self.variables = variables
+        self.size = size
+
+        for var in variables:
+            var.is_record = bool(var.dimids) and dims[var.dimids[0]][1] == 0
+
+        record_vars = self.record_variables()
+        if len(record_vars) == 1:
+            # a single record variable is not padded
+            var = record_vars[0]
+            count = 1
+            for d in var.dimids[1:]:
+                count *= dims[d][1]
+            self.recsize = count * TYPE_SIZES[var.nc_type]
+        else:
+            self.recsize = sum(v.vsize for v in record_vars)
+
+        self.rec_begin = min([v.begin for v in record_vars]) if record_vars else None
+
+    def record_variables(self):
+        return [v for v in self.variables if v.is_record]
+
+    def fixed_variables(self):
+        return [v for v in self.variables if not v.is_record]
+
+    def dim_index(self, name):
+        for i, (dname, length) in enumerate(self.dims):
+            if dname == name:
+                return i
+        return None
+
+    def record_end(self, index):
+        """
+        :return: The offset of the first byte after record 'index'
+        """
+        return self.rec_begin + (index + 1) * self.recsize
+
+    def data_end(self):
+        """
+        :return: The expected file size given the number of records in the header
+        """
+        ends = [v.begin + v.vsize for v in self.fixed_variables()]
+        if self.rec_begin is not None and self.numrecs != STREAMING:
+            ends.append(self.rec_begin + self.numrecs * self.recsize)
+        return max(ends) if ends else self.size
+
+
+class Reader(object):
+    def __init__(self, data, version):
+        self.data = data
+        self.pos = 0
+        self.offset_size = 8 if version == 2 else 4
+
+    def take(self, n):
+        if self.pos + n > len(self.data):
+            raise NeedMoreData()
+        chunk = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return chunk
+
+    def int32(self):
+        return struct.unpack(">I", self.take(4))[0]
+
+    def offset(self):
+        return struct.unpack(">Q" if self.offset_size == 8 else ">I", self.take(self.offset_size))[0]
+
+    def name(self):
+        n = self.int32()
+        return self.take(pad4(n))[:n].decode("utf-8", errors="replace")
+
+    def att_list(self):
+        start = self.pos
+        tag, nelems = self.int32(), self.int32()
+        if tag not in (0, NC_ATTRIBUTE):
+            raise ValueError("Bad attribute list tag %d" % tag)
+        for i in range(nelems):
+            self.name()
+            nc_type, n = self.int32(), self.int32()
+            if nc_type not in TYPE_SIZES:
+                raise NotClassicFormat("Unsupported attribute type %d" % nc_type)
+            self.take(pad4(n * TYPE_SIZES[nc_type]))
+        return self.data[start:self.pos]
+
+
+def parse_header(data):
+    """
+    Parse the header of a classic or 64-bit offset netCDF file
+    :param data: The first bytes of the file
+    :return: A Header
+    :raises NeedMoreData: if data ends before the header does
+    :raises NotClassicFormat: if the data is not a CDF-1 or CDF-2 file
+    """
+    if len(data) < 4:
+        raise NeedMoreData()
+    if data[:3] != b"CDF" or data[3] not in (1, 2):
+        raise NotClassicFormat("Not a classic or 64-bit offset netCDF file")
+
+    version = data[3]
+    r = Reader(data, version)
+    r.take(4)
+    numrecs = r.int32()
+
+    dims = []
+    tag, nelems = r.int32(), r.int32()
+    if tag not in (0, NC_DIMENSION):
+        raise ValueError("Bad dimension list tag %d" % tag)
+    for i in range(nelems):
+        dims.append((r.name(), r.int32()))
+
+    gatts = r.att_list()
+
+    variables = []
+    tag, nelems = r.int32(), r.int32()
+    if tag not in (0, NC_VARIABLE):
+        raise ValueError("Bad variable list tag %d" % tag)
+    for i in range(nelems):
+        name = r.name()
+        ndims = r.int32()
+        dimids = [r.int32() for j in range(ndims)]
+        atts = r.att_list()
+        nc_type = r.int32()
+        if nc_type not in TYPE_SIZES:
+            raise NotClassicFormat("Unsupported variable type %d" % nc_type)
+        vsize = r.int32()
+        begin = r.offset()
+        variables.append(Variable(name, dimids, atts, nc_type, vsize, begin))
+
+    return Header(version, numrecs, dims, gatts, variables, r.pos)
+
+
+def encode_name(name):
+    raw = name.encode("utf-8")
+    return struct.pack(">I", len(raw)) + raw + b"\0" * (pad4(len(raw)) - len(raw))
+
+
+def encode_header(header, variables, numrecs):
+    """
+    Serialize a header holding only the given variables, with new data offsets.
+    Fixed-size data is laid out first, in order, followed by the records.
+    :param header: The source Header, providing dimensions and global attributes
+    :param variables: The Variables to keep
+    :param numrecs: The number of records of the new file
+    :return: A tuple of (header bytes, {variable name: new begin offset}, new record size)
+    """
+    offset_fmt = ">Q" if header.version == 2 else ">I"
+
+    def encode(begins):
+        out = [b"CDF" + bytes([header.version]), struct.pack(">I", numrecs)]
+        if header.dims:
+            out.append(struct.pack(">II", NC_DIMENSION, len(header.dims)))
+            for name, length in header.dims:
+                out.append(encode_name(name) + struct.pack(">I", length))
+        else:
+            out.append(struct.pack(">II", 0, 0))
+        out.append(header.gatts)
+        if variables:
+            out.append(struct.pack(">II", NC_VARIABLE, len(variables)))
+            for var in variables:
+                out.append(encode_name(var.name))
+                out.append(struct.pack(">I", len(var.dimids)))
+                out.extend(struct.pack(">I", d) for d in var.dimids)
+                out.append(var.atts)
+                out.append(struct.pack(">II", var.nc_type, var.vsize))
+                out.append(struct.pack(offset_fmt, begins.get(var.name, 0)))
+        else:
+            out.append(struct.pack(">II", 0, 0))
+        return b"".join(out)
+
+    # offsets do not change the header length, so lay out the data after a first pass
+    size = len(encode({}))
+    begins = {}
+    pos = size
+    for var in variables:
+        if not var.is_record:
+            begins[var.name] = pos
+            pos += var.vsize
+
+    record_vars = [v for v in variables if v.is_record]
+    if len(record_vars) == 1:
+        count = 1
+        for d in record_vars[0].dimids[1:]:
+            count *= header.dims[d][1]
+        recsize = count * TYPE_SIZES[record_vars[0].nc_type]
+    else:
+        recsize = sum(v.vsize for v in record_vars)
+
+    for var in record_vars:
+        begins[var.name] = pos
+        pos += var.vsize
+
+    return encode(begins), begins, recsize
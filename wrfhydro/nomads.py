@@ -0,0 +1,852 @@
+###################################################
+#
+# Shared NOMADS download client used by get_GFS.py,
+# get_CFS.py and any other product pulled from
+# NOMADS. Throttles the number of requests per minute
+# per NOMADS requirements and reuses HTTP keep-alive
+# connections across requests.
+#
+###################################################
+
+import http.client
+import os
+import logging as log
+from datetime import datetime, timedelta
+import time
+import re
+import codecs
+import json
+import fcntl
+import struct
+import hashlib
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+from httpclient import ConnectionPool, RangesNotSupported, download, http_time
+from polling import Poller, PublicationHistory, LATE_MAX_INTERVAL
+
+# Global constants. Modify these if the directory listing
+# format changes on the server
+INDEX_FILE_REGEX = "<a href=\"(.+?)\".+?<\/a>\s+([\w|\d|-]+ [\d|:]+)\s+([\w|\d|\-|\.]+)"
+INDEX_FILE_DATE_FORMAT = "%d-%b-%Y %H:%M"
+INDEX_FILE_PATTERN = re.compile(INDEX_FILE_REGEX)
+CACHE_DATE_FORMAT = "%Y-%m-%d %H:%M"
+
+MAX_REQUESTS_PER_MINUTE = 50
+
+# GRIB2 fields read by the Forcing Engine from GFS and CFSv2 files, as
+# VARIABLE:level strings from the wgrib2 .idx inventory. Used when only
+# a subset of each file is downloaded.
+FORCING_ENGINE_FIELDS = [
+    "TMP:2 m above ground",
+    "SPFH:2 m above ground",
+    "UGRD:10 m above ground",
+    "VGRD:10 m above ground",
+    "PRATE:surface",
+    "DSWRF:surface",
+    "DLWRF:surface",
+    "PRES:surface"
+]
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket limiting the request rate of all download workers.
+    Tokens refill continuously at (rate - burst) per minute, so that together with a
+    full bucket no 60 second window ever sees more than 'rate' requests.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: The maximum number of requests allowed in any minute
+        :param burst: The number of requests that may be made back to back. Defaults to a tenth of rate
+        """
+        if burst is None:
+            burst = max(1, rate // 10)
+        self.capacity = float(burst)
+        self.fill_rate = max(rate - burst, 1) / 60.0
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token from the bucket, sleeping until one is available
+        :return: The number of seconds spent waiting
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.fill_rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                sleep_secs = (1 - self.tokens) / self.fill_rate
+
+            log.debug("Throttle activated. Sleeping %.1f seconds." % sleep_secs)
+            time.sleep(sleep_secs)
+            waited += sleep_secs
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    Token bucket kept in a file, shared by every process on the host that uses the same
+    file, so concurrent pullers together stay within the rate. The file holds the number
+    of tokens and the time it was last updated, and is locked while a token is taken.
+    """
+    STATE = struct.Struct("<dd")
+
+    def __init__(self, path, rate, burst=None):
+        """
+        :param path: The state file. It is created if it does not exist
+        :param rate: The maximum number of requests allowed in any minute, by all processes together
+        :param burst: The number of requests that may be made back to back. Defaults to a tenth of rate
+        """
+        TokenBucket.__init__(self, rate, burst)
+        self.path = path
+
+    def acquire(self):
+        """
+        Take a token from the shared bucket, sleeping until one is available
+        :return: The number of seconds spent waiting
+        """
+        waited = 0.0
+        while True:
+            # each attempt opens the file, so threads of one process also lock each other out
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                now = time.time()
+                data = os.pread(fd, self.STATE.size, 0)
+                if len(data) == self.STATE.size:
+                    tokens, last = self.STATE.unpack(data)
+                    # wall clock time is shared between processes; a clock step back adds nothing
+                    tokens = min(self.capacity, tokens + max(0.0, now - last) * self.fill_rate)
+                else:
+                    tokens = self.capacity
+                if tokens >= 1:
+                    os.pwrite(fd, self.STATE.pack(tokens - 1, now), 0)
+                    return waited
+                os.pwrite(fd, self.STATE.pack(tokens, now), 0)
+                sleep_secs = (1 - tokens) / self.fill_rate
+            finally:
+                os.close(fd)
+
+            log.debug("Shared throttle activated. Sleeping %.1f seconds." % sleep_secs)
+            time.sleep(sleep_secs)
+            waited += sleep_secs
+
+
+def rate_limiter(rate_file=None, rate=MAX_REQUESTS_PER_MINUTE):
+    """
+    :param rate_file: If set, the state file of a limiter shared with other processes
+    :param rate: The maximum number of requests allowed in any minute
+    :return: A SharedTokenBucket if rate_file is set, otherwise a TokenBucket for this process
+    """
+    if rate_file:
+        return SharedTokenBucket(rate_file, rate)
+    return TokenBucket(rate)
+
+
+class IndexCache(object):
+    """
+    On-disk cache of parsed directory listings keyed by URL, holding the ETag and
+    Last-Modified validators so listings can be re-requested conditionally
+    """
+
+    def __init__(self, cache_dir):
+        """
+        :param cache_dir: Directory to keep the cache in. If None, listings are only cached in memory
+        """
+        self.cache_dir = cache_dir
+        self.entries = {}
+        self.lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode()).hexdigest() + ".json")
+
+    def get(self, url):
+        """
+        :param url: The URL of the listing
+        :return: A dict with the 'etag', 'last_modified' and parsed 'files' of the listing, or None
+        """
+        with self.lock:
+            if url in self.entries:
+                return self.entries[url]
+
+        if not self.cache_dir or not os.path.isfile(self._path(url)):
+            return None
+
+        try:
+            with open(self._path(url)) as f:
+                entry = json.load(f)
+            for file in entry['files']:
+                file['modified'] = datetime.strptime(file['modified'], CACHE_DATE_FORMAT)
+        except (IOError, ValueError, KeyError) as e:
+            log.warning("Ignoring unreadable index cache entry for '%s': %s" % (url, e))
+            return None
+
+        with self.lock:
+            self.entries[url] = entry
+        return entry
+
+    def put(self, url, etag, last_modified, files):
+        """
+        Store a parsed listing along with its validators
+        """
+        entry = {'url': url, 'etag': etag, 'last_modified': last_modified, 'files': files}
+        with self.lock:
+            self.entries[url] = entry
+
+        if not self.cache_dir:
+            return
+
+        serialized = dict(entry, files=[dict(f, modified=f['modified'].strftime(CACHE_DATE_FORMAT)) for f in files])
+        tmp = "%s.%d.tmp" % (self._path(url), threading.get_ident())
+        try:
+            with open(tmp, "w") as f:
+                json.dump(serialized, f)
+            os.replace(tmp, self._path(url))
+        except IOError as e:
+            log.warning("Unable to write index cache entry for '%s': %s" % (url, e))
+
+
+class NomadsProduct(object):
+    """
+    Settings describing where a NOMADS product lives and which files to pull
+    """
+
+    def __init__(self, name, url, day_dir_format, cycle_subdir, file_regex, valid_time,
+                 output_name=None, timeout=60, subset_fields=None,
+                 cycle_delay=timedelta(hours=3), complete_delay=timedelta(hours=5), forecast_hours=None):
+        """
+        :param name: Product name, for logging
+        :param url: URL root of the product on NOMADS
+        :param day_dir_format: strptime format of the day directories (e.g. 'gfs.%Y%m%d/')
+        :param cycle_subdir: Directory below the cycle hour holding the files (e.g. 'atmos')
+        :param file_regex: Regex matching the files to download
+        :param valid_time: Function of (regex match, cycle time) returning the valid time of a file
+        :param output_name: Optional function mapping a server file name to a local file name
+        :param timeout: Request timeout in seconds
+        :param subset_fields: VARIABLE:level strings to keep when downloading file subsets
+        :param cycle_delay: Typical time after the cycle at which the cycle directory appears,
+            used for polling until there is publication history
+        :param complete_delay: Typical time after the cycle at which the last file appears
+        :param forecast_hours: Optional function of the forecast length returning the forecast hours
+            the product has a file for. Default is every hour
+        """
+        self.name = name
+        self.url = url.rstrip("/")
+        self.day_dir_format = day_dir_format
+        self.cycle_subdir = cycle_subdir
+        self.file_regex = file_regex
+        self.file_pattern = re.compile(file_regex)
+        self.valid_time = valid_time
+        self.output_name = output_name if output_name else (lambda name: name)
+        self.timeout = timeout
+        self.subset_fields = subset_fields
+        self.cycle_delay = cycle_delay
+        self.complete_delay = complete_delay
+        self.forecast_hours = forecast_hours if forecast_hours else (lambda length: list(range(0, length + 1)))
+
+
+class NomadsClient(object):
+    """
+    Downloads all files of a NOMADS product for one cycle
+    """
+
+    def __init__(self, product, outdir, date, length, workers=4,
+                 max_requests_per_minute=MAX_REQUESTS_PER_MINUTE, subset=False, history_file=None,
+                 index_cache_dir=None, bucket=None, rate_file=None, cache=None, meter=None):
+        """
+        :param product: A NomadsProduct
+        :param outdir: Directory to write downloaded files to
+        :param date: The cycle to download as YYYYMMDDHH
+        :param length: The forecast length in hours
+        :param workers: The number of concurrent downloads
+        :param max_requests_per_minute: Request cap shared by all workers
+        :param subset: If True, only download the product's subset_fields using the .idx inventories
+        :param history_file: JSON file of past publication times used to schedule polling
+        :param index_cache_dir: Directory for the conditional-request cache of directory listings
+        :param bucket: Optional TokenBucket shared with other clients. Defaults to one of
+            max_requests_per_minute for this client
+        :param rate_file: Optional state file of a rate limiter shared with other processes,
+            used when no bucket is given
+        :param cache: Optional download_cache.DownloadCache files are linked from when another
+            cycle or domain has already downloaded them
+        :param meter: Optional progress.EcflowMeter set to the highest forecast hour up to which
+            every file is on disk
+        """
+        self.product = product
+        self.outdir = outdir
+        self.date = date
+        self.length = int(length)
+        self.workers = workers
+        self.subset = subset and bool(product.subset_fields)
+        self.pool = ConnectionPool(timeout=product.timeout, maxsize=workers + 1)
+        self.bucket = bucket if bucket else rate_limiter(rate_file, max_requests_per_minute)
+        self.history = PublicationHistory(history_file)
+        self.index_cache = IndexCache(index_cache_dir)
+        self.cycle_url = None
+        # set once the server has answered a range request with the whole file
+        self.ranges_ignored = False
+        self.cache = cache
+        self.meter = meter
+
+        self.counter_lock = threading.Lock()
+        self.total_num_files = 0
+        self.total_num_requests = 0
+        self.total_timeouts = 0
+        self.total_errors = 0
+        self.total_bytes = 0
+        self.total_download_seconds = 0.0
+        self.total_throttle_wait = 0.0
+        self.total_poll_wait = 0.0
+        self.app_starttime = datetime.utcnow()
+
+    def throttle(self):
+        """
+        Wait until the token bucket allows another request to the server
+        :return:
+        """
+        waited = self.bucket.acquire()
+        if waited:
+            with self.counter_lock:
+                self.total_throttle_wait += waited
+
+    def increment_request_count(self):
+        """
+        Increment request counters
+        :return:
+        """
+        with self.counter_lock:
+            self.total_num_requests += 1
+
+    def get_file(self, url, output, size, size_tolerance=0):
+        """
+        Retrieve a file from the server and preserve server file modification times.
+        Interrupted downloads are resumed from the partial file on the next attempt.
+        :param url: The URL of the file on the server
+        :param output: The path of the file to write locally
+        :param size: The expected size of the file in bytes
+        :param size_tolerance: Allowed difference from the expected size, as listings round sizes
+        :return: True on success, false on error
+        """
+        self.throttle()  # wait to make request if we need to slow down
+        log.debug("Downloading file '%s' of size %d bytes to '%s'" % (url, size, output))
+
+        try:
+            self.increment_request_count()
+            start = datetime.now()
+            transferred = download(self.pool, url, output, expected_size=size, size_tolerance=size_tolerance)
+
+            elapsed = (datetime.now() - start).total_seconds()
+            log.debug("Download took %d seconds" % elapsed)
+
+            with self.counter_lock:
+                self.total_num_files += 1
+                self.total_bytes += transferred
+                self.total_download_seconds += elapsed
+
+            return True
+
+        except Exception as e:
+            log.error("Error downloading file '%s': %s" % (url,e))
+            with self.counter_lock:
+                self.total_errors += 1
+                if isinstance(e, TimeoutError):
+                    self.total_timeouts += 1
+            return False
+
+    def read_inventory(self, url):
+        """
+        Download and parse the wgrib2 .idx inventory of a GRIB2 file
+        :param url: The URL of the GRIB2 file (not the .idx)
+        :return: A list of dicts with the field, start byte and end byte (None for the last message)
+            of each GRIB message, or False on error
+        """
+        self.throttle()
+
+        try:
+            self.increment_request_count()
+            with self.pool.urlopen(url + ".idx") as response:
+                if response.status != 200:
+                    raise http.client.HTTPException("HTTP status %d" % response.status)
+                lines = codecs.decode(response.read(), 'utf-8', errors='ignore').split("\n")
+
+            return parse_inventory(lines)
+
+        except Exception as e:
+            log.error("Error reading inventory of '%s': %s" % (url, e))
+            with self.counter_lock:
+                self.total_errors += 1
+            return False
+
+    def get_file_subset(self, url, output, size, size_tolerance=0):
+        """
+        Retrieve only the GRIB messages listed in the product's subset_fields, using HTTP Range
+        requests, and write them to a reduced GRIB2 file
+        :param url: The URL of the file on the server
+        :param output: The path of the file to write locally
+        :param size: The size of the full file on the server in bytes, for logging
+        :param size_tolerance: Unused, the reduced file is checked against the inventory instead
+        :return: True on success, false on error
+        :raises RangesNotSupported: if the server answers the range request with the whole file
+        """
+        messages = self.read_inventory(url)
+        if not messages:
+            return False
+
+        wanted = [m for m in messages if m['field'] in self.product.subset_fields]
+        if not wanted:
+            log.error("None of the requested fields found in inventory of '%s'" % url)
+            return False
+
+        ranges = merge_ranges([(m['start'], m['end']) for m in wanted])
+        header = "bytes=" + ",".join("%d-%s" % (a, "" if b is None else b) for a, b in ranges)
+
+        self.throttle()
+        log.debug("Downloading %d of %d messages of file '%s' (%d bytes) to '%s'" %
+                  (len(wanted), len(messages), url, size, output))
+
+        try:
+            self.increment_request_count()
+            start = datetime.now()
+            with self.pool.urlopen(url, headers={"Range": header}) as response:
+                if response.status == 200:
+                    # the body is the whole file, left unread
+                    raise RangesNotSupported("Server sent the whole of '%s' for a range request" % url)
+                if response.status != 206:
+                    raise http.client.HTTPException("HTTP status %d for range request" % response.status)
+                parts = read_byteranges(response)
+                headers = response.headers
+
+            data = b"".join(slice_range(parts, offset, end) for offset, end in ranges)
+            if not data.startswith(b"GRIB") or not data.endswith(b"7777"):
+                raise ValueError("Reduced file does not start and end on GRIB message boundaries")
+
+            tmp = output + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.rename(tmp, output)
+
+            elapsed = (datetime.now() - start).total_seconds()
+            log.debug("Download of %d bytes took %d seconds" % (len(data), elapsed))
+
+            os.utime(output, (time.time(), http_time(headers['Last-Modified'])))
+
+            with self.counter_lock:
+                self.total_num_files += 1
+                self.total_bytes += len(data)
+                self.total_download_seconds += elapsed
+
+            return True
+
+        except RangesNotSupported:
+            # left to fetch(), which downloads the whole file instead
+            raise
+
+        except Exception as e:
+            log.error("Error downloading subset of file '%s': %s" % (url, e))
+            with self.counter_lock:
+                self.total_errors += 1
+                if isinstance(e, TimeoutError):
+                    self.total_timeouts += 1
+            return False
+
+    def read_index(self, url):
+        """
+        Download and parse the HTML index file into a list of files and directories. This may need to be
+        modified if the listing format changes on the server. If the listing was seen before, it is
+        requested with If-None-Match/If-Modified-Since and the cached entries are reused when the server
+        answers 304 Not Modified.
+        :param url: The URL of the directory we want to list
+        :return: A list of dicts representing each file or directory name, file size, and modification time
+        """
+        # make sure we slow down if needed, even for directory listings which are still considered
+        # a request
+        self.throttle()
+
+        log.debug("Getting index of %s" % url)
+
+        try:
+            cached = self.index_cache.get(url)
+            headers = {}
+            if cached and cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached and cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
+
+            # get the HTML. Assumes UTF-8 format
+            self.increment_request_count()
+            with self.pool.urlopen(url, headers=headers) as response:
+                htmldata = response.read()
+                if response.status == 304 and cached:
+                    log.debug("Index of %s not modified" % url)
+                    return cached['files']
+                if response.status != 200:
+                    raise http.client.HTTPException("HTTP status %d" % response.status)
+                etag = response.headers.get('ETag')
+                last_modified = response.headers.get('Last-Modified')
+
+            files = parse_index(codecs.decode(htmldata, 'utf-8', errors='ignore'))
+            if etag or last_modified:
+                self.index_cache.put(url, etag, last_modified, files)
+
+            return files
+
+        except Exception as e:
+            log.error("Error reading index of '%s': %s" % (url, e))
+            with self.counter_lock:
+                self.total_errors += 1
+                if isinstance(e, TimeoutError):
+                    self.total_timeouts += 1
+            return False
+
+    def report_progress(self, listed):
+        """
+        Set the meter to the highest forecast hour up to which the file of every hour the
+        product has is on disk. An hour not listed yet counts as missing.
+        :param listed: A dict of the local path of each listed file by forecast hour
+        """
+        if not self.meter:
+            return
+        contiguous = -1
+        for hour in self.product.forecast_hours(self.length):
+            outfile = listed.get(hour)
+            if outfile is None or not os.path.isfile(outfile):
+                break
+            contiguous = hour
+        if contiguous >= 0:
+            self.meter.set(contiguous)
+
+    def get_data(self, url):
+        """
+        Download all files for the cycle found in the directory listing, using a pool of
+        worker threads. All workers share the same request throttle and connection pool.
+        :param url: The URL of the cycle directory
+        :return: True if every file up to the end of the forecast is on disk
+        """
+        cycletime = datetime.strptime(self.date, "%Y%m%d%H")
+        endtime = cycletime + timedelta(hours=self.length)
+
+        files = self.read_index(url)
+        if not files:
+            return False
+
+        jobs = []
+        listed = {}
+        got_last = False
+        for f in files:
+            match = self.product.file_pattern.search(f['name'])
+            if not match:
+                continue
+
+            dt = self.product.valid_time(match, cycletime)
+            if dt > endtime:
+                continue
+
+            if dt == endtime:
+                got_last = True
+
+            outfile = "%s/%s" % (self.outdir, self.product.output_name(f['name']))
+            listed[int((dt - cycletime).total_seconds() // 3600)] = outfile
+            if os.path.isfile(outfile):
+                continue
+
+            jobs.append(("%s/%s" % (url, f['name']), outfile, f['size'], f['size_tolerance'], f['modified']))
+
+        self.report_progress(listed)
+
+        def fetch(job):
+            result = self.fetch(*job)
+            if result:
+                self.report_progress(listed)
+            return result
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            results = list(pool.map(fetch, jobs))
+
+        return got_last and all(results)
+
+    def fetch(self, url, output, size, size_tolerance, modified):
+        """
+        Get a file from the download cache, or download it (or its subset) from the server.
+        If the server ignores range requests, the whole file is downloaded instead, and so
+        are the files after it.
+        :param modified: The modification time of the file in the directory listing
+        :return: True on success, false on error
+        """
+        if self.subset and not self.ranges_ignored:
+            try:
+                return self.fetch_version(url, output, size, size_tolerance, modified, True)
+            except RangesNotSupported as e:
+                # a server or proxy ignoring Range would answer every subset request the same way
+                log.warning("%s, downloading whole files from now on" % e)
+                self.ranges_ignored = True
+        return self.fetch_version(url, output, size, size_tolerance, modified, False)
+
+    def fetch_version(self, url, output, size, size_tolerance, modified, subset):
+        """
+        Get a file from the download cache, or download it from the server
+        :param subset: If True, get only the product's subset_fields
+        :return: True on success, false on error
+        """
+        get_file = self.get_file_subset if subset else self.get_file
+        if not self.cache:
+            return get_file(url, output, size, size_tolerance)
+
+        # listings give the time to the minute, so the size is part of the version too
+        version = "%s %d" % (modified.strftime(CACHE_DATE_FORMAT), size)
+        if subset:
+            version += " subset=%s" % ",".join(sorted(self.product.subset_fields))
+        hit, result = self.cache.fetch(url, version, output, lambda out: get_file(url, out, size, size_tolerance))
+        return hit or result
+
+    def find_cycle_dir(self):
+        """
+        Look for the cycle directory on the server
+        :return: The URL of the directory holding the cycle's files, or None if not yet available
+        """
+        tm = self.date[0:8]
+        hr = self.date[-2:]
+
+        dirs = self.read_index(self.product.url + "/")
+        daydir = None
+
+        if dirs:
+            log.debug("Looking for files for %s" % self.date)
+            for d in dirs:
+                try:
+                    dt = datetime.strptime(d['name'], self.product.day_dir_format)
+                except:
+                    continue
+                if dt.strftime("%Y%m%d") != tm:
+                    continue
+                daydir = d['name']
+                break
+
+        if not daydir:
+            return None
+
+        # found the day directory, now find the cycle directory
+        dirs = self.read_index("%s/%s" % (self.product.url, daydir))
+        hourdir = None
+
+        if dirs:
+            for d in dirs:
+                d = d['name'].replace("/","")
+                if d == hr:
+                    hourdir = d
+                    break
+
+        if not hourdir:
+            return None
+
+        return "%s/%s%s/%s" % (self.product.url, daydir, hourdir, self.product.cycle_subdir)
+
+    def run(self):
+        """
+        Loop until all files for the cycle have been downloaded. Polling is scheduled around
+        the times the cycle directory and the last file were published in past cycles.
+        :return: True when all files are on disk
+        """
+        log.debug("Looking for %s files for time %s" % (self.product.name, self.date))
+
+        cycletime = datetime.strptime(self.date, "%Y%m%d%H")
+        cycle_poller = Poller(self.product.name + ".cycle", cycletime, self.history, self.product.cycle_delay)
+        # only used once the cycle directory exists, so files may appear at any time. The last file
+        # of each forecast length appears at a different time, so each has its own history
+        files_poller = Poller("%s.complete.%dh" % (self.product.name, self.length), cycletime, self.history,
+                              self.product.complete_delay, max_interval=LATE_MAX_INTERVAL)
+
+        # loop until our data becomes available. Once the cycle directory has been
+        # found only its listing is requested again
+        while True:
+            if not self.cycle_url:
+                self.cycle_url = self.find_cycle_dir()
+            url = self.cycle_url
+            if not url:
+                self.total_poll_wait += cycle_poller.wait()
+                continue
+
+            cycle_poller.found()
+            downloaded = self.total_num_files
+            success = self.get_data(url)
+
+            if success:
+                files_poller.found()
+                log.debug("Downloaded all files. Exiting")
+                return True
+
+            # poll densely while files are being published
+            log.debug("Waiting for more files")
+            self.total_poll_wait += files_poller.wait(arriving=self.total_num_files > downloaded)
+
+    def metrics(self):
+        """
+        :return: A dict of the client's counters, for metrics.TaskMetrics
+        """
+        with self.counter_lock:
+            return {
+                'files_downloaded': self.total_num_files,
+                'requests': self.total_num_requests,
+                'timeouts': self.total_timeouts,
+                'errors': self.total_errors,
+                'bytes_downloaded': self.total_bytes,
+                'download_seconds': round(self.total_download_seconds, 3),
+                'throttle_wait_seconds': round(self.total_throttle_wait, 3),
+                'poll_wait_seconds': round(self.total_poll_wait, 3),
+                'cache_hits': self.cache.hits if self.cache else 0,
+                'cache_bytes_saved': self.cache.bytes_saved if self.cache else 0,
+            }
+
+
+@lru_cache(maxsize=4096)
+def parse_index_date(value):
+    """
+    Parse a listing modification time. Memoized, since most entries of a
+    listing share a handful of distinct times.
+    """
+    return datetime.strptime(value, INDEX_FILE_DATE_FORMAT)
+
+
+def parse_index(html):
+    """
+    Parse an Apache-style HTML directory listing
+    :param html: The listing as a string
+    :return: A list of dicts with the file or directory name, file size and modification time
+    """
+    files = []
+    # parse each line
+    for l in html.split("\n"):
+        if "<a href" not in l:
+            continue
+        m = INDEX_FILE_PATTERN.search(l)
+        if not m:
+            continue
+
+        m = m.groups()
+        name = m[0]
+        # convert file modified string into a Date object
+        modified = parse_index_date(m[1])
+
+        # convert file size given in kilobytes (K), megabytes (M), or gigabytes (G)
+        # into number of bytes
+        size = m[2]
+        mult = size[-1]
+        if mult == "K":
+            mult = 1024
+        elif mult == "M":
+            mult = 1024 * 1024
+        elif mult == "G":
+            mult = 1024 * 1024 * 1024
+        else:
+            mult = None
+
+        # sizes with a unit are rounded by the server, so allow for that when
+        # checking downloads against them
+        if mult:
+            size = int(float(size[:-1]) * mult)
+            size_tolerance = mult
+        else:
+            try:
+                size = int(size)
+            except:
+                size = 0
+            size_tolerance = 0
+
+        files.append({'name': name, 'modified': modified, 'size': size, 'size_tolerance': size_tolerance})
+
+    return files
+
+
+def parse_inventory(lines):
+    """
+    Parse the lines of a wgrib2 .idx inventory, e.g.
+
+        5:1223414:d=2021100900:TMP:2 m above ground:3 hour fcst:
+
+    :param lines: The inventory lines
+    :return: A list of dicts with the VARIABLE:level field, start byte and end byte (inclusive, None for
+        the last message) of each GRIB message
+    """
+    messages = []
+    for l in lines:
+        fields = l.split(":")
+        if len(fields) < 5:
+            continue
+        try:
+            offset = int(fields[1])
+        except ValueError:
+            continue
+        if messages:
+            messages[-1]['end'] = offset - 1
+        messages.append({'field': "%s:%s" % (fields[3], fields[4]), 'start': offset, 'end': None})
+
+    return messages
+
+
+def merge_ranges(ranges):
+    """
+    Merge adjacent byte ranges so fewer ranges need to be requested
+    :param ranges: A sorted list of (start, end) tuples. An end of None means end of file
+    :return: The merged list of (start, end) tuples
+    """
+    merged = []
+    for start, end in ranges:
+        if merged and merged[-1][1] is not None and merged[-1][1] + 1 == start:
+            merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def slice_range(parts, start, end):
+    """
+    Get the data of a requested byte range from the ranges returned by the server, which
+    may have coalesced several requested ranges into one
+    :param parts: A dict mapping start bytes to data, as returned by read_byteranges
+    :param start: The first byte of the requested range
+    :param end: The last byte of the requested range (inclusive), or None for the end of the file
+    :return: The data of the requested range
+    """
+    for offset, data in parts.items():
+        if offset <= start and (end is None or offset + len(data) > end):
+            return data[start - offset:None if end is None else end - offset + 1]
+
+    raise ValueError("Server did not return byte range %s-%s" % (start, end))
+
+
+def read_byteranges(response):
+    """
+    Read the body of a 206 Partial Content response, which is either a single range
+    or a multipart/byteranges document
+    :param response: The response to read
+    :return: A dict mapping the start byte of each returned range to its data
+    """
+    content_type = response.headers.get('Content-Type', '')
+    body = response.read()
+
+    if not content_type.startswith("multipart/byteranges"):
+        start = int(re.search("bytes (\\d+)-", response.headers['Content-Range']).groups()[0])
+        return {start: body}
+
+    boundary = re.search("boundary=\"?([^\";]+)", content_type).groups()[0].encode()
+    parts = {}
+    for part in body.split(b"--" + boundary)[1:]:
+        if part.startswith(b"--"):
+            break
+        head, _, data = part.partition(b"\r\n\r\n")
+        match = re.search(b"Content-Range: *bytes (\\d+)-(\\d+)", head, re.IGNORECASE)
+        if not match:
+            continue
+        start, end = int(match.groups()[0]), int(match.groups()[1])
+        parts[start] = data[:end - start + 1]
+
+    return parts
@@ -0,0 +1,178 @@
+###################################################
+#
+# Publication-schedule-aware polling for the data
+# pull scripts. Records when each data source
+# actually published in past cycles and polls
+# sparsely long before the expected time, densely
+# around it, and backs off when a source is late.
+#
+###################################################
+
+import os
+import json
+import fcntl
+import logging as log
+from datetime import datetime, timedelta
+import time
+
+# seconds between polls around the expected publication time
+MIN_INTERVAL = 30
+# longest sleep while waiting for the expected publication time
+MAX_INTERVAL = 1800
+# longest sleep once a source is later than expected
+LATE_MAX_INTERVAL = 300
+# minimum half-width of the dense polling window around the expected time
+WINDOW = timedelta(minutes=15)
+# number of past publications kept per source and cycle hour
+HISTORY_LENGTH = 20
+
+
+class PublicationHistory(object):
+    """
+    Publication delays (minutes after the nominal cycle time) of past cycles, per source
+    and cycle hour, kept in a JSON file shared by all data pull tasks
+    """
+
+    def __init__(self, path):
+        """
+        :param path: The JSON file to keep the history in. If None, nothing is remembered
+        """
+        self.path = path
+
+    def _key(self, source, cycle_time):
+        return "%s.%02d" % (source, cycle_time.hour)
+
+    def load(self):
+        """
+        :return: A dict mapping '<source>.<cycle hour>' to a list of delays in minutes
+        """
+        if not self.path or not os.path.isfile(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                return json.load(f)
+        except (IOError, ValueError) as e:
+            log.warning("Unable to read publication history '%s': %s" % (self.path, e))
+            return {}
+
+    def delays(self, source, cycle_time):
+        """
+        Get past delays for a source, preferring those for the same cycle hour
+        :param source: The data source name, e.g. 'GFS.cycle'
+        :param cycle_time: The nominal cycle time as a datetime
+        :return: A sorted list of delays in minutes, possibly empty
+        """
+        history = self.load()
+        delays = history.get(self._key(source, cycle_time))
+        if not delays:
+            delays = [d for k, v in history.items() if k.rsplit(".", 1)[0] == source for d in v]
+        return sorted(delays)
+
+    def record(self, source, cycle_time, published):
+        """
+        Remember when a source published a cycle
+        :param source: The data source name
+        :param cycle_time: The nominal cycle time as a datetime
+        :param published: When the data was found as a datetime (UTC)
+        """
+        if not self.path:
+            return
+
+        delay = (published - cycle_time).total_seconds() / 60.0
+        key = self._key(source, cycle_time)
+
+        try:
+            with open(self.path, "a+") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0)
+                try:
+                    history = json.loads(f.read() or "{}")
+                except ValueError:
+                    history = {}
+                history[key] = (history.get(key, []) + [round(delay, 1)])[-HISTORY_LENGTH:]
+                f.seek(0)
+                f.truncate()
+                json.dump(history, f, indent=1, sort_keys=True)
+        except IOError as e:
+            log.warning("Unable to update publication history '%s': %s" % (self.path, e))
+
+
+class Poller(object):
+    """
+    Decides how long to sleep between checks for a data source that has not yet published
+    """
+
+    def __init__(self, source, cycle_time, history, default_delay, max_interval=MAX_INTERVAL):
+        """
+        :param source: The data source name, e.g. 'GFS.cycle'
+        :param cycle_time: The nominal cycle time of the data as a datetime (UTC)
+        :param history: A PublicationHistory
+        :param default_delay: Expected publication delay as a timedelta, used until there is history
+        :param max_interval: Longest sleep before the expected time, e.g. LATE_MAX_INTERVAL once
+            some of the data has been published
+        """
+        self.source = source
+        self.max_interval = max_interval
+        self.cycle_time = cycle_time
+        self.history = history
+        self.misses = 0
+        self.late_polls = 0
+        self.total_wait = 0.0
+
+        delays = history.delays(source, cycle_time)
+        if delays:
+            median = delays[len(delays) // 2]
+            spread = delays[(3 * len(delays)) // 4] - delays[len(delays) // 4]
+            self.expected = cycle_time + timedelta(minutes=median)
+            self.window = max(WINDOW, timedelta(minutes=spread))
+        else:
+            self.expected = cycle_time + default_delay
+            self.window = WINDOW
+
+    def next_interval(self, now=None, arriving=False):
+        """
+        :param now: The current time (UTC). Defaults to now
+        :param arriving: True if the last check found new data, so more is on its way
+        :return: The number of seconds to sleep before checking again
+        """
+        if arriving:
+            return MIN_INTERVAL
+
+        if now is None:
+            now = datetime.utcnow()
+
+        window_start = self.expected - self.window
+        if now < window_start:
+            # poll sparsely until the dense window opens
+            return max(MIN_INTERVAL, min(self.max_interval, (window_start - now).total_seconds()))
+
+        if now <= self.expected + self.window:
+            return MIN_INTERVAL
+
+        # the source is late, back off
+        self.late_polls += 1
+        return min(LATE_MAX_INTERVAL, MIN_INTERVAL * 2 ** self.late_polls)
+
+    def wait(self, arriving=False):
+        """
+        Sleep until the next check
+        :param arriving: True if the last check found new data
+        :return: The number of seconds slept
+        """
+        self.misses += 1
+        secs = self.next_interval(arriving=arriving)
+        log.debug("%s not available (expected around %s). Sleeping %d seconds" %
+                  (self.source, self.expected.strftime("%Y-%m-%d %H:%M"), secs))
+        time.sleep(secs)
+        self.total_wait += secs
+        return secs
+
+    def found(self):
+        """
+        Record that the source has published. Only recorded once, and only if at least one
+        check missed, since otherwise the data could have been there for a long time.
+        """
+        if self.misses > 0:
+            self.history.record(self.source, self.cycle_time, datetime.utcnow())
+            self.misses = 0
@@ -0,0 +1,70 @@
+###################################################
+#
+# Progress of a data pull, reported as an ecFlow
+# meter of the running task: the highest forecast
+# hour up to which every input file is on disk.
+# Forcing families triggered on the meter can then
+# start on the early hours while later hours are
+# still downloading.
+#
+# Configured from the environment:
+#
+#   PROGRESS_METER : the name of the meter. No meter is set if empty
+#
+# The ecflow_client connection variables (ECF_NAME,
+# ECF_PASS, ...) are those exported by head.h.
+#
+###################################################
+
+import os
+import threading
+import subprocess
+import logging as log
+
+# seconds to wait for the ecflow server
+CLIENT_TIMEOUT = 60
+
+
+class EcflowMeter(object):
+    """
+    A meter of the running ecFlow task, only ever moved forward
+    """
+
+    def __init__(self, name):
+        """
+        :param name: The meter name, as defined on the task
+        """
+        self.name = name
+        self.value = None
+        self.lock = threading.Lock()
+
+    def set(self, value):
+        """
+        Set the meter, unless it is already at value or beyond. Failures are logged, not raised,
+        as the meter only lets downstream tasks start early.
+        """
+        with self.lock:
+            if self.value is not None and value <= self.value:
+                return
+            self.value = value
+            log.debug("Meter %s at %d" % (self.name, value))
+            if not os.environ.get('ECF_NAME') or os.environ.get('NO_ECF'):
+                return
+            try:
+                subprocess.run(["ecflow_client", "--meter=%s" % self.name, str(value)], check=True,
+                               timeout=CLIENT_TIMEOUT)
+            except (OSError, subprocess.SubprocessError) as e:
+                log.warning("Unable to set meter %s: %s" % (self.name, e))
+
+
+def from_environment(member=None):
+    """
+    :param member: Optional ensemble member, whose meter is PROGRESS_METER_memN
+    :return: The EcflowMeter named by PROGRESS_METER, or None
+    """
+    name = os.environ.get('PROGRESS_METER')
+    if not name:
+        return None
+    if member is not None:
+        name = "%s_mem%d" % (name, member)
+    return EcflowMeter(name)
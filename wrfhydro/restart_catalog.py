@@ -0,0 +1,337 @@
+###################################################
+#
+# Catalog of the HYDRO_RST and RESTART files in a
+# cycle's wrfhydro directory, kept as a small JSON
+# index next to the directory so that finding the
+# best restart does not list and parse every file
+# the model has written. The catalog is rebuilt
+# and sealed when the model task has finished with
+# the directory. Restarts are only written by the
+# model, so a sealed catalog stays valid while the
+# directory gets links, logs and output of later
+# cycles. The model task unseals it before the
+# model runs; an unsealed catalog is rebuilt
+# whenever the directory has changed since it was
+# written. Restarts are checked to be complete
+# before one is chosen, and the results are
+# remembered per file modification time.
+#
+# Usage: python restart_catalog.py <wrfhydro dir> [unseal]
+#
+# Restarts copied into a directory by hand are only
+# seen once it is indexed again, e.g. with
+# python restart_catalog.py <wrfhydro dir>
+#
+###################################################
+
+import os
+import sys
+import re
+import json
+import bisect
+import struct
+import logging as log
+from datetime import datetime
+
+import ncheader
+
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+
+TIME_FORMAT = "%Y%m%d%H%M"
+# offsets searched for an HDF5 superblock, which may follow a user block
+HDF5_SUPERBLOCK_OFFSETS = [0] + [512 * 2 ** i for i in range(12)]
+# bit of the version 3 superblock flags set while a writer has the file open
+HDF5_WRITE_ACCESS = 0x1
+
+# file name pattern and regex of each restart type
+RESTART_TYPES = {
+    "hydro": ("HYDRO_RST.%Y-%m-%d_%H:%M_DOMAIN", re.compile("^(HYDRO_RST.\d+\-\d+\-\d+_\d+:\d+_DOMAIN)")),
+    "hrldas": ("RESTART.%Y%m%d%H_DOMAIN", re.compile("^(RESTART\.\d+_DOMAIN)")),
+}
+
+
+def catalog_path(indir):
+    """
+    The catalog is kept beside the directory, not in it, so writing it does not change
+    the directory modification time it records
+    :return: The path of the catalog of indir
+    """
+    return "%s.restarts.json" % indir.rstrip("/")
+
+
+def dir_mtime(indir):
+    return os.stat(indir).st_mtime_ns
+
+
+def scan(indir):
+    """
+    List the restart files of a directory
+    :param indir: The wrfhydro run directory
+    :return: A dict mapping restart type to a list of [valid time, file name] sorted by time,
+        valid times formatted with TIME_FORMAT
+    """
+    entries = dict((t, []) for t in RESTART_TYPES)
+    for entry in os.scandir(indir):
+        for type, (pattern, regex) in RESTART_TYPES.items():
+            match = regex.search(entry.name)
+            if not match:
+                continue
+            try:
+                filetime = datetime.strptime(match.groups()[0], pattern)
+            except ValueError:
+                continue
+            entries[type].append([filetime.strftime(TIME_FORMAT), entry.name])
+            break
+
+    for type in entries:
+        entries[type].sort()
+    return entries
+
+
+def hdf5_error(f, size):
+    """
+    Check that an HDF5 file was closed and is as long as its superblock says
+    :param f: The open file
+    :param size: The size of the file
+    :return: None if the file looks complete, otherwise the reason it is not
+    """
+    for offset in HDF5_SUPERBLOCK_OFFSETS:
+        if offset >= size:
+            break
+        f.seek(offset)
+        sb = f.read(96)
+        if sb[:8] != ncheader.HDF5_SIGNATURE:
+            continue
+
+        version = sb[8]
+        if version in (0, 1):
+            offset_size = sb[13]
+            pos = 24 + (4 if version == 1 else 0)
+            flags = 0
+        elif version in (2, 3):
+            offset_size = sb[9]
+            pos = 12
+            flags = sb[11]
+        else:
+            return "unknown HDF5 superblock version %d" % version
+
+        fmt = {4: "<I", 8: "<Q"}.get(offset_size)
+        if fmt is None:
+            return "unsupported HDF5 offset size %d" % offset_size
+        base = struct.unpack_from(fmt, sb, pos)[0]
+        eof = struct.unpack_from(fmt, sb, pos + 2 * offset_size)[0]
+
+        if version == 3 and flags & HDF5_WRITE_ACCESS:
+            return "HDF5 file was not closed by its writer"
+        if size < base + eof:
+            return "truncated, %d of %d bytes" % (size, base + eof)
+        return None
+
+    return "no HDF5 superblock"
+
+
+def inspect(path):
+    """
+    Cheaply check that a restart is a complete netCDF file
+    :param path: The restart file
+    :return: A tuple of (error, dims). error is None if the file looks complete, and dims
+        maps fixed dimension names to lengths, or is None if they cannot be read
+    """
+    try:
+        size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            magic = f.read(8)
+
+            # an HDF5 superblock may follow a user block, a classic file starts with its magic
+            if not magic.startswith(b"CDF"):
+                error = hdf5_error(f, size)
+                if error or netCDF4 is None:
+                    return error, None
+                with netCDF4.Dataset(path) as nc:
+                    return None, dict((n, len(d)) for n, d in nc.dimensions.items() if not d.isunlimited())
+
+            # read until the whole classic header is in memory
+            f.seek(0)
+            data = f.read(65536)
+            while True:
+                try:
+                    header = ncheader.parse_header(data)
+                    break
+                except ncheader.NeedMoreData:
+                    if len(data) >= size:
+                        return "truncated header", None
+                    data += f.read(len(data))
+
+            if header.numrecs == ncheader.STREAMING:
+                return "file was not closed by its writer", None
+            if size < header.data_end():
+                return "truncated, %d of %d bytes" % (size, header.data_end()), None
+            return None, dict((n, l) for n, l in header.dims if l != 0)
+
+    except ncheader.NotClassicFormat as e:
+        return "not a netCDF file: %s" % e, None
+    except Exception as e:
+        return "unreadable: %s" % e, None
+
+
+def dims_error(dims, expected):
+    """
+    :param dims: The fixed dimensions of a restart, or None if unknown
+    :param expected: The fixed dimensions it should have, or None
+    :return: None if the dimensions match, otherwise the difference
+    """
+    if dims is None or expected is None:
+        return None
+    for name, length in expected.items():
+        if dims.get(name) != length:
+            return "dimension %s is %s, expected %d" % (name, dims.get(name), length)
+    return None
+
+
+class RestartCatalog(object):
+    """
+    The restart files of one wrfhydro run directory, by type and valid time
+    """
+
+    def __init__(self, indir):
+        """
+        Load the catalog of indir, rebuilding it if it is missing or older than the directory
+        :param indir: The wrfhydro run directory
+        """
+        self.indir = indir
+        self.mtime = None
+        self.entries = None
+        self.sealed = False
+        self.changed = False
+        # file name -> [mtime, size, error, dims] of restarts already checked
+        self.checks = {}
+
+        try:
+            mtime = dir_mtime(indir)
+        except OSError:
+            # no run directory yet, so no restarts
+            self.entries = dict((t, []) for t in RESTART_TYPES)
+            return
+
+        try:
+            with open(catalog_path(indir)) as f:
+                catalog = json.load(f)
+            self.checks = catalog.get('checks', {})
+            if catalog.get('sealed') or catalog.get('mtime') == mtime:
+                self.mtime = catalog.get('mtime')
+                self.entries = catalog['entries']
+                self.sealed = bool(catalog.get('sealed'))
+            else:
+                log.debug("Restart catalog of %s is stale" % indir)
+        except (IOError, ValueError, KeyError):
+            pass
+
+        if self.entries is None:
+            self.update()
+
+    def update(self, sealed=False):
+        """
+        Rescan the directory and write the catalog
+        :param sealed: If True, the catalog stays valid until it is unsealed, e.g. when the
+            model has finished writing restarts
+        """
+        # read the modification time first, so a file added during the scan makes the catalog stale
+        self.mtime = dir_mtime(self.indir)
+        self.entries = scan(self.indir)
+        self.sealed = sealed
+
+        names = set(e[1] for entries in self.entries.values() for e in entries)
+        self.checks = dict((k, v) for k, v in self.checks.items() if k in names)
+        self.save()
+
+    def unseal(self):
+        """
+        Mark the catalog as valid only while the directory is unchanged, before restarts are written
+        """
+        if self.sealed:
+            self.sealed = False
+            self.save()
+
+    def save(self):
+        """
+        Write the catalog
+        """
+        path = catalog_path(self.indir)
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            with open(tmp, "w") as f:
+                json.dump({'mtime': self.mtime, 'sealed': self.sealed, 'entries': self.entries,
+                           'checks': self.checks}, f, indent=1)
+            os.replace(tmp, path)
+        except IOError as e:
+            log.warning("Unable to write restart catalog '%s': %s" % (path, e))
+
+    def candidates(self, type, tm):
+        """
+        :param type: The restart type, 'hydro' or 'hrldas'
+        :param tm: The latest acceptable valid time as a datetime
+        :return: The paths of restarts valid at or before tm, newest first
+        """
+        entries = self.entries.get(type, [])
+        end = bisect.bisect_right([e[0] for e in entries], tm.strftime(TIME_FORMAT))
+        return ["%s/%s" % (self.indir, e[1]) for e in reversed(entries[:end])]
+
+    def check(self, path):
+        """
+        Check a restart, reusing the result of an earlier check if the file has not changed
+        :return: A tuple of (error, dims) as returned by inspect()
+        """
+        name = os.path.basename(path)
+        st = os.stat(path)
+        cached = self.checks.get(name)
+        if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+            return cached[2], cached[3]
+
+        error, dims = inspect(path)
+        self.checks[name] = [st.st_mtime_ns, st.st_size, error, dims]
+        self.changed = True
+        return error, dims
+
+    def best(self, type, tm, reference=None, verify=True):
+        """
+        :param type: The restart type, 'hydro' or 'hrldas'
+        :param tm: The latest acceptable valid time as a datetime
+        :param reference: Optional restart of the same type whose dimensions the restart must match,
+            e.g. the domain's default restart
+        :param verify: If true, skip restarts that are incomplete or do not match the reference
+        :return: The path of the newest usable restart valid at or before tm, or None
+        """
+        expected = None
+        if verify and reference and os.path.isfile(reference):
+            expected = inspect(reference)[1]
+
+        self.changed = False
+        best = None
+        for path in self.candidates(type, tm):
+            if not verify:
+                best = path
+                break
+            try:
+                error, dims = self.check(path)
+            except OSError as e:
+                error, dims = "unreadable: %s" % e, None
+            error = error or dims_error(dims, expected)
+            if error is None:
+                best = path
+                break
+            log.warning("Skipping restart %s: %s" % (path, error))
+
+        if self.changed:
+            self.save()
+        return best
+
+
+if __name__ == "__main__":
+    catalog = RestartCatalog(sys.argv[1])
+    if len(sys.argv) > 2 and sys.argv[2] == "unseal":
+        catalog.unseal()
+    else:
+        catalog.update(sealed=True)
@@ -0,0 +1,160 @@
+###################################################
+#
+# Warm resume of a model run that did not finish,
+# e.g. a long range run killed at its walltime or
+# by a node failure. Before the model is submitted
+# the window it runs is recorded in the run
+# directory, and the record is removed once its
+# output has been moved. If the task is rerun for
+# the same window, the run starts again from the
+# latest complete restart the earlier attempts
+# wrote, and only the remaining hours are run.
+# The output of the hours already run is still in
+# the run directory, so the usual move stitches
+# both attempts into the cycle's output directory.
+#
+# Usage, from wrfhydro_model.ecf:
+#
+#   python resume.py plan     prints the start date, time, run length in
+#                             hours and the hrldas and hydro restarts to
+#                             resume from, or nothing to run the window
+#   python resume.py submit   before the model is submitted
+#   python resume.py done     once the output has been moved
+#
+# Script configuration is pulled from the environment:
+#
+#   WRF_HYDRO_ROOT   : the run directory the model writes its restarts to
+#   MODEL_START      : the start of the window, YYYYMMDDHHMM
+#   KHOUR            : the length of the window in hours
+#   ECF_HOME         : for the domain's default restarts
+#   WRFHYDRO_DOMAIN  : the domain
+#
+###################################################
+
+import os
+import sys
+import json
+import time
+import logging
+from datetime import datetime, timedelta
+
+from restart_catalog import RestartCatalog, RESTART_TYPES
+
+logging.basicConfig(format="%(levelname)s, %(asctime)s %(message)s", level=logging.DEBUG,
+                    stream=sys.stderr)
+
+TIME_FORMAT = "%Y%m%d%H%M"
+RUN_FILE = ".model_run.json"
+
+RUN_DIR = os.environ['WRF_HYDRO_ROOT']
+START = datetime.strptime(os.environ['MODEL_START'], TIME_FORMAT)
+KHOUR = int(os.environ['KHOUR'])
+END = START + timedelta(hours=KHOUR)
+
+default_restart_dir = "%s/wrfhydro/%s/restarts" % (os.environ['ECF_HOME'], os.environ['WRFHYDRO_DOMAIN'])
+DEFAULTS = {
+    "hydro": "%s/HYDRO_RESTART.default" % default_restart_dir,
+    "hrldas": "%s/HRLDAS_RESTART.default" % default_restart_dir,
+}
+
+
+def load_run():
+    """
+    :return: The recorded run of this window, or None if the last run recorded was another window
+    """
+    try:
+        with open(os.path.join(RUN_DIR, RUN_FILE)) as f:
+            run = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if run.get('start') != START.strftime(TIME_FORMAT) or run.get('khour') != KHOUR:
+        return None
+    return run
+
+
+def valid_time(path):
+    """
+    :return: The valid time of a restart file as a datetime
+    """
+    name = os.path.basename(path)
+    for type, (pattern, regex) in RESTART_TYPES.items():
+        match = regex.search(name)
+        if match:
+            return datetime.strptime(match.group(1), pattern)
+    return None
+
+
+def latest_restarts(catalog, submitted):
+    """
+    :param catalog: The RestartCatalog of the run directory
+    :param submitted: When the first attempt at the window was submitted, in seconds since the epoch
+    :return: A tuple of (valid time, {type: path}) of the latest complete restarts of every type
+        valid at the same time within the window and written since submitted, or None
+    """
+    t = END - timedelta(hours=1)
+    while t > START:
+        found = {}
+        for type in RESTART_TYPES:
+            best = catalog.best(type, t, reference=DEFAULTS[type])
+            if best is None or os.stat(best).st_mtime < submitted:
+                # nothing this window's runs wrote is left at or before t
+                return None
+            found[type] = best
+        times = [valid_time(path) for path in found.values()]
+        if all(tm == t for tm in times):
+            return t, found
+        # step back to the latest time both types may have in common
+        t = min(times)
+    return None
+
+
+def plan():
+    """
+    :return: A tuple of (start, {type: path}) to resume the window from, or None
+    """
+    run = load_run()
+    if run is None:
+        return None
+
+    resume = latest_restarts(RestartCatalog(RUN_DIR), run['submitted'])
+    if resume is None:
+        logging.info("No restarts left by the earlier run of %s, running the whole window"
+                     % START.strftime(TIME_FORMAT))
+        return None
+    logging.info("Resuming the run of %s from %s, %d of %d hours left"
+                 % (START.strftime(TIME_FORMAT), resume[0].strftime(TIME_FORMAT),
+                    (END - resume[0]).total_seconds() // 3600, KHOUR))
+    return resume
+
+
+def submit():
+    """
+    Record the window before the model is submitted, keeping the time of the first attempt
+    """
+    run = load_run() or {'start': START.strftime(TIME_FORMAT), 'khour': KHOUR, 'submitted': time.time()}
+    path = os.path.join(RUN_DIR, RUN_FILE)
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(run, f)
+    os.replace(tmp, path)
+
+
+def done():
+    try:
+        os.remove(os.path.join(RUN_DIR, RUN_FILE))
+    except OSError:
+        pass
+
+
+if __name__ == "__main__":
+    if sys.argv[1] == "plan":
+        resume = plan()
+        if resume:
+            start, restarts = resume
+            print("%s %s %d %s %s" % (start.strftime("%Y%m%d"), start.strftime("%H%M"),
+                                      int((END - start).total_seconds() // 3600),
+                                      restarts["hrldas"], restarts["hydro"]))
+    elif sys.argv[1] == "submit":
+        submit()
+    elif sys.argv[1] == "done":
+        done()
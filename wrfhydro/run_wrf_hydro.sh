@@ -16,4 +16,9 @@ module load impi/2018.4.274
 
 export MPI_IB_CONGESTED=0
 
+# tell the submitting task when the job left the queue
+if [ -n "$JOB_START_FILE" ]; then
+    date +%s > $JOB_START_FILE
+fi
+
 time mpiexec $WRF_HYDRO_ROOT/wrf_hydro.exe
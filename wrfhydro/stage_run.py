@@ -0,0 +1,205 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+from datetime import datetime
+
+from namelist import Namelist
+
+logging.basicConfig(format="%(levelname)s, %(asctime)s %(message)s", level=logging.DEBUG)
+
+###########################
+#
+# This script stages a cycle's WRF-Hydro run directory. Parameter tables are
+# copied once into a content-addressed cache and linked from there, so a cycle
+# costs a few symlinks instead of a copy of every table, and a table edited while
+# a model runs does not change under it. The cycle's namelist templates are
+# rendered with the start time, run length, restart links and output
+# configuration in one write each, and the hashes of everything staged are
+# recorded in the run directory.
+#
+# Script configuration is pulled from the environment:
+#
+#   WRF_HYDRO_ROOT     : the run directory
+#   PARAMS_DIR         : the domain's parameter tables
+#   NAMELIST_DIR       : the cycle's namelist templates
+#   PARAM_CACHE_DIR    : the content-addressed parameter cache
+#   MODEL_START        : the model start time, YYYYMMDDHHMM
+#   KHOUR              : the run length in hours
+#   HRLDAS_RESTART     : the LSM restart file to start from
+#   HYDRO_RESTART      : the routing restart file to start from
+#   IO_CONFIG_OUTPUTS  : the hydro.namelist io_config_outputs (default 6)
+#   RESTART_INTERVAL_HOURS : if set, overrides the restart interval of the namelist templates, so a
+#                        run that does not finish can be resumed from a mid-run restart (default 0, unset)
+#
+###########################
+
+HRLDAS_NAMELIST = "namelist.hrldas"
+HYDRO_NAMELIST = "hydro.namelist"
+# links in the run directory the namelists point the model at
+HRLDAS_RESTART_LINK = "HRLDAS.RESTART"
+HYDRO_RESTART_LINK = "HYDRO.RESTART"
+STAGING_RECORD = "staging.json"
+CACHE_INDEX = "index.json"
+HASH_BLOCK = 1 << 20
+
+RUN_DIR = os.environ['WRF_HYDRO_ROOT']
+PARAMS_DIR = os.environ['PARAMS_DIR']
+NAMELIST_DIR = os.environ['NAMELIST_DIR']
+CACHE_DIR = os.environ['PARAM_CACHE_DIR']
+START = datetime.strptime(os.environ['MODEL_START'], "%Y%m%d%H%M")
+KHOUR = int(os.environ['KHOUR'])
+HRLDAS_RESTART = os.environ['HRLDAS_RESTART']
+HYDRO_RESTART = os.environ['HYDRO_RESTART']
+IO_CONFIG_OUTPUTS = int(os.environ.get('IO_CONFIG_OUTPUTS', 6))
+RESTART_INTERVAL_HOURS = int(os.environ.get('RESTART_INTERVAL_HOURS', 0))
+
+
+def sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class ParamCache(object):
+    """
+    Content-addressed copies of parameter tables, stored as <cache>/<sha256>/<name>.
+    Source files are only hashed again when their size or modification time changes.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.index_file = os.path.join(cache_dir, CACHE_INDEX)
+        self.index = {}
+        self.changed = False
+        try:
+            with open(self.index_file) as f:
+                self.index = json.load(f)
+        except (IOError, ValueError):
+            pass
+
+    def digest(self, path):
+        st = os.stat(path)
+        key = [st.st_size, st.st_mtime_ns]
+        entry = self.index.get(path)
+        if entry and entry[:2] == key:
+            return entry[2]
+        digest = sha256(path)
+        self.index[path] = key + [digest]
+        self.changed = True
+        return digest
+
+    def get(self, path):
+        """
+        :param path: A source parameter file
+        :return: A tuple of (the path of its cached copy, its sha256)
+        """
+        digest = self.digest(path)
+        cached = os.path.join(self.cache_dir, digest, os.path.basename(path))
+        if not os.path.isfile(cached):
+            logging.debug("Caching %s as %s" % (path, cached))
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            tmp = "%s.%d.tmp" % (cached, os.getpid())
+            shutil.copyfile(path, tmp)
+            os.chmod(tmp, 0o444)
+            os.replace(tmp, cached)
+        else:
+            # the janitor deletes copies by the time they were last staged
+            os.utime(cached)
+        return cached, digest
+
+    def save(self):
+        if not self.changed:
+            return
+        # concurrent cycles may both save, the last complete index wins
+        tmp = "%s.%d.tmp" % (self.index_file, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(self.index, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.index_file)
+
+
+def link(target, path):
+    """
+    Point path at target, replacing whatever is there, unless it already does
+    """
+    if os.path.islink(path) and os.readlink(path) == target:
+        return
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    os.symlink(target, tmp)
+    os.replace(tmp, path)
+
+
+def write_if_changed(path, text):
+    """
+    Write text to path, unless path already holds exactly that
+    :return: The sha256 of text
+    """
+    data = text.encode()
+    if not os.path.islink(path) and os.path.isfile(path):
+        with open(path, "rb") as f:
+            if f.read() == data:
+                return hashlib.sha256(data).hexdigest()
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+    return hashlib.sha256(data).hexdigest()
+
+
+def namelist_settings():
+    """
+    :return: The values set in each namelist template, by file name and group
+    """
+    settings = {
+        HRLDAS_NAMELIST: {'NOAHLSM_OFFLINE': {
+            'START_YEAR': START.year,
+            'START_MONTH': START.month,
+            'START_DAY': START.day,
+            'START_HOUR': START.hour,
+            'START_MIN': START.minute,
+            'KHOUR': KHOUR,
+            'RESTART_FILENAME_REQUESTED': "./%s" % HRLDAS_RESTART_LINK,
+        }},
+        HYDRO_NAMELIST: {'HYDRO_NLIST': {
+            'RESTART_FILE': "./%s" % HYDRO_RESTART_LINK,
+            'io_config_outputs': IO_CONFIG_OUTPUTS,
+        }},
+    }
+    if RESTART_INTERVAL_HOURS > 0:
+        settings[HRLDAS_NAMELIST]['NOAHLSM_OFFLINE']['RESTART_FREQUENCY_HOURS'] = RESTART_INTERVAL_HOURS
+        settings[HYDRO_NAMELIST]['HYDRO_NLIST']['rst_dt'] = RESTART_INTERVAL_HOURS * 60
+    return settings
+
+
+def run():
+    os.makedirs(RUN_DIR, exist_ok=True)
+    record = {'params': {}, 'namelists': {}, 'restarts': {}}
+
+    cache = ParamCache(CACHE_DIR)
+    for name in sorted(os.listdir(PARAMS_DIR)):
+        source = os.path.join(PARAMS_DIR, name)
+        if not os.path.isfile(source):
+            continue
+        cached, digest = cache.get(source)
+        link(cached, os.path.join(RUN_DIR, name))
+        record['params'][name] = digest
+    cache.save()
+
+    for name, settings in sorted(namelist_settings().items()):
+        template = Namelist.read(os.path.join(NAMELIST_DIR, name))
+        record['namelists'][name] = write_if_changed(os.path.join(RUN_DIR, name), template.render(settings))
+
+    for name, target in [(HRLDAS_RESTART_LINK, HRLDAS_RESTART), (HYDRO_RESTART_LINK, HYDRO_RESTART)]:
+        link(target, os.path.join(RUN_DIR, name))
+        record['restarts'][name] = target
+
+    write_if_changed(os.path.join(RUN_DIR, STAGING_RECORD), json.dumps(record, indent=1, sort_keys=True))
+    logging.info("Staged %d parameter tables and %d namelists in %s" % (len(record['params']),
+                                                                          len(record['namelists']), RUN_DIR))
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,289 @@
+###################################################
+#
+# Split a multi-hour WRF output file into one file
+# per forecast hour for the Forcing Engine. The
+# source is opened once (per worker) and every
+# hourly slice is written from it, instead of one
+# ncks process re-reading the file for each hour.
+#
+###################################################
+
+import os
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import ncheader
+
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+
+TIME_DIM = "Time"
+COPY_CHUNK = 16 * 1024 * 1024
+
+# WRF variables read by the Forcing Engine, plus the coordinates it needs.
+# Used when extracted files are reduced to the forcing variables only.
+FORCING_VARIABLES = ["Times", "XLAT", "XLONG", "T2", "Q2", "U10", "V10", "PSFC",
+                     "RAINC", "RAINNC", "SWDOWN", "GLW"]
+
+
+def output_name(fname, outdir, hour):
+    """
+    :return: The path of the extracted file for the given forecast hour
+    """
+    return "%s/%s_f%02d.nc" % (outdir, os.path.basename(fname)[:-3], hour)
+
+
+def contiguous_hours(fname, outdir, length):
+    """
+    :return: The highest forecast hour up to which every hourly file of fname is in outdir, or -1
+    """
+    for i in range(0, length + 1):
+        if not os.path.isfile(output_name(fname, outdir, i)):
+            return i - 1
+    return length
+
+
+def write_slice(src, outfile, index, variables=None):
+    """
+    Write one Time record of an open dataset to a new file. The file is written under a
+    temporary name and renamed once complete.
+    :param src: The open source netCDF4.Dataset
+    :param outfile: The path of the file to write
+    :param index: The Time index to extract
+    :param variables: Optional list of variable names to keep. Default is all variables
+    """
+    tmp = outfile + ".tmp"
+    with netCDF4.Dataset(tmp, "w", format=src.data_model) as dst:
+        dst.set_auto_maskandscale(False)
+        dst.set_auto_chartostring(False)
+        dst.setncatts({k: src.getncattr(k) for k in src.ncattrs()})
+
+        names = [v for v in src.variables if variables is None or v in variables]
+        used_dims = set(d for v in names for d in src.variables[v].dimensions)
+
+        for name, dim in src.dimensions.items():
+            if variables is not None and name not in used_dims:
+                continue
+            dst.createDimension(name, None if dim.isunlimited() else len(dim))
+
+        for name in names:
+            var = src.variables[name]
+            attrs = {k: var.getncattr(k) for k in var.ncattrs()}
+            fill_value = attrs.pop('_FillValue', None)
+            out = dst.createVariable(name, var.datatype, var.dimensions, fill_value=fill_value)
+            out.setncatts(attrs)
+
+            if var.dimensions and var.dimensions[0] == TIME_DIM:
+                out[0:1] = var[index:index + 1]
+            else:
+                out[:] = var[:]
+
+    os.rename(tmp, outfile)
+
+
+def copy_range(fd, out, offset, length):
+    """
+    Copy length bytes at offset of file descriptor fd to the open file out
+    """
+    while length > 0:
+        chunk = os.pread(fd, min(length, COPY_CHUNK), offset)
+        if not chunk:
+            raise IOError("Unexpected end of file at offset %d" % offset)
+        out.write(chunk)
+        offset += len(chunk)
+        length -= len(chunk)
+
+
+def read_classic_header(f, size):
+    """
+    Read and check the header of a classic-format WRF file
+    :param f: The open file
+    :param size: The number of bytes of the file available
+    :return: An ncheader.Header
+    :raises ncheader.NeedMoreData: if the header is not yet complete
+    :raises ncheader.NotClassicFormat: if the file is not classic-format with a Time record dimension
+    """
+    f.seek(0)
+    header = ncheader.parse_header(f.read(size))
+    idx = header.dim_index(TIME_DIM)
+    if header.rec_begin is None or idx is None or header.dims[idx][1] != 0:
+        raise ncheader.NotClassicFormat("No Time record dimension")
+    return header
+
+
+def write_classic_slice(fd, header, outfile, index, variables=None):
+    """
+    Write one record of a classic or 64-bit offset netCDF file to a new single-record file
+    by copying bytes, without a netCDF library. Only the bytes of the fixed-size variables
+    and of the requested record are read, so the source may still be growing.
+    :param fd: File descriptor of the source
+    :param header: The ncheader.Header of the source
+    :param outfile: The path of the file to write
+    :param index: The record to extract
+    :param variables: Optional list of variable names to keep. Default is all variables
+    """
+    keep = [v for v in header.variables if variables is None or v.name in variables]
+    data, begins, recsize = ncheader.encode_header(header, keep, 1)
+    record_vars = [v for v in keep if v.is_record]
+
+    tmp = outfile + ".tmp"
+    with open(tmp, "wb") as out:
+        out.write(data)
+        for var in keep:
+            if not var.is_record:
+                copy_range(fd, out, var.begin, var.vsize)
+        for var in record_vars:
+            # a lone record variable is stored without padding
+            length = recsize if len(record_vars) == 1 else var.vsize
+            copy_range(fd, out, var.begin + index * header.recsize, length)
+
+    os.rename(tmp, outfile)
+
+
+class StreamingExtractor(object):
+    """
+    Extracts hourly files from a classic-format WRF file while it is being downloaded.
+    Each Time record is written as soon as its bytes are on disk, and each hourly file
+    appears atomically, so its presence signals that the hour is complete. Files in
+    netCDF-4 format cannot be split before they are complete, and are left to
+    extract_files() once the download has finished.
+    """
+
+    def __init__(self, fname, outdir, length, variables=None, on_hour=None):
+        """
+        :param fname: The final path of the file being downloaded, used to name the hourly files
+        :param outdir: Directory to write extracted files to
+        :param length: The last forecast hour to extract
+        :param variables: Optional list of variable names to keep
+        :param on_hour: Optional function called with each forecast hour once its file is written
+        """
+        self.fname = fname
+        self.outdir = outdir
+        self.variables = variables
+        self.on_hour = on_hour
+        self.header = None
+        self.disabled = False
+        self.pending = [i for i in range(0, length + 1) if not os.path.isfile(output_name(fname, outdir, i))]
+
+    def progress(self, path, size):
+        """
+        Called by the downloader as data arrives
+        :param path: The path of the partial file
+        :param size: The number of bytes of the file on disk
+        """
+        if self.disabled or not self.pending:
+            return
+
+        try:
+            with open(path, "rb") as f:
+                if self.header is None:
+                    self.header = read_classic_header(f, size)
+
+                while self.pending and size >= self.header.record_end(self.pending[0]):
+                    i = self.pending.pop(0)
+                    write_classic_slice(f.fileno(), self.header, output_name(self.fname, self.outdir, i),
+                                        i, self.variables)
+                    logging.debug("Hour %d of %s extracted" % (i, self.fname))
+                    if self.on_hour:
+                        self.on_hour(i)
+
+        except ncheader.NeedMoreData:
+            return
+        except Exception as e:
+            logging.debug("Not extracting %s while downloading: %s" % (self.fname, e))
+            self.disabled = True
+
+
+def extract_hours(fname, outdir, hours, variables=None):
+    """
+    Open the source file once and write the requested hourly slices
+    :param fname: The multi-hour WRF output file
+    :param outdir: Directory to write extracted files to
+    :param hours: List of Time indexes (forecast hours) to extract
+    :param variables: Optional list of variable names to keep
+    :return: The list of files written
+    """
+    written = []
+    with netCDF4.Dataset(fname) as src:
+        src.set_auto_maskandscale(False)
+        src.set_auto_chartostring(False)
+        ntimes = len(src.dimensions[TIME_DIM])
+
+        for i in hours:
+            if i >= ntimes:
+                logging.warning("%s has only %d times, cannot extract hour %d" % (fname, ntimes, i))
+                continue
+            outfile = output_name(fname, outdir, i)
+            write_slice(src, outfile, i, variables)
+            written.append(outfile)
+
+    return written
+
+
+def extract_classic(fname, outdir, hours, variables=None):
+    """
+    Extract hourly files by copying bytes, if fname is a classic-format file. Hours whose
+    records are not in the file are skipped.
+    :return: True if the file was classic-format and all hours were extracted
+    """
+    with open(fname, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        try:
+            header = read_classic_header(f, size)
+        except (ncheader.NeedMoreData, ncheader.NotClassicFormat):
+            return False
+
+        complete = True
+        for i in hours:
+            if size < header.record_end(i):
+                logging.warning("%s is too short to extract hour %d" % (fname, i))
+                complete = False
+                continue
+            write_classic_slice(f.fileno(), header, output_name(fname, outdir, i), i, variables)
+
+    return complete
+
+
+def extract_files(fname, outdir, length, variables=None, workers=1):
+    """
+    Extract hours 0 through length from fname into one file per hour in outdir.
+    Hours whose file already exists are skipped. Classic-format files are split by
+    copying bytes; netCDF-4 files need netCDF4-python, or ncks as a last resort.
+    :param fname: The multi-hour WRF output file
+    :param outdir: Directory to write extracted files to
+    :param length: The last forecast hour to extract
+    :param variables: Optional list of variable names to keep. Default is all variables
+    :param workers: Number of processes to split the hours over
+    """
+    hours = [i for i in range(0, length + 1) if not os.path.isfile(output_name(fname, outdir, i))]
+    if not hours:
+        return
+
+    if extract_classic(fname, outdir, hours, variables):
+        return
+    # left to the other methods, which report the hours they cannot extract either
+    hours = [i for i in hours if not os.path.isfile(output_name(fname, outdir, i))]
+
+    if netCDF4 is None:
+        # fall back to NCO if netCDF4-python is not installed
+        logging.debug("netCDF4 not available, extracting with ncks")
+        for i in hours:
+            outfile = output_name(fname, outdir, i)
+            vars_opt = "-v %s " % ",".join(variables) if variables else ""
+            cmd = "ncks -O %s-d Time,%s %s %s" % (vars_opt, i, fname, outfile + ".tmp")
+            if os.system(cmd) == 0:
+                os.rename(outfile + ".tmp", outfile)
+        return
+
+    if workers <= 1:
+        extract_hours(fname, outdir, hours, variables)
+        return
+
+    # each worker opens the source once and handles every n-th hour
+    chunks = [hours[i::workers] for i in range(workers) if hours[i::workers]]
+    with ProcessPoolExecutor(max_workers=len(chunks)) as pool:
+        for result in pool.map(extract_hours, [fname] * len(chunks), [outdir] * len(chunks), chunks,
+                               [variables] * len(chunks)):
+            logging.debug("Extracted %d files" % len(result))